@@ -0,0 +1,217 @@
+# Builds a synthetic collection.db for benchmarking. The output depends only
+# on --seed and --scale, so reports from different machines or commits are
+# comparable.
+#
+#   python bench/generate.py --out bench/bench.db            # full size
+#   python bench/generate.py --out bench/small.db --scale 0.01
+#
+# Full size is 100k users, 10M inventory rows, 1M owned packs (summed over
+# the counted owned_packs rows) and 200k marketplace listings.
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import main  # noqa: E402
+
+USERS = 100_000
+INVENTORY = 10_000_000
+OWNED_PACKS = 1_000_000
+LISTINGS = 200_000
+CARD_LISTING_SHARE = 0.75   # the rest are pack listings
+ACTIVE_LISTING_SHARE = 0.8  # the rest are sold or removed
+BATCH = 50_000
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+SEQ = 1 << main.InventoryIds.SEQ_BITS
+
+def inventory_id(u: int, ms: int, spread: int) -> tuple:
+    # Same layout as main.InventoryIds, built without the shared counter since
+    # users are generated one after another rather than in time order. User u
+    # always uses sequence u % SEQ, and its timestamps are nudged to
+    # ms = u // SEQ (mod spread), so no two users can produce the same ID.
+    ms += (u // SEQ - ms) % spread
+    return main.InventoryIds.encode((ms << main.InventoryIds.SEQ_BITS) | (u % SEQ)), ms
+
+def split_total(rng: random.Random, total: int, n: int, alpha: float) -> list:
+    # Heavy-tailed shares of `total` over `n` buckets: a few whales, a long tail.
+    weights = [rng.paretovariate(alpha) for _ in range(n)]
+    scale = total / sum(weights)
+    counts = [int(w * scale) for w in weights]
+    for i in rng.sample(range(n), total - sum(counts)):
+        counts[i] += 1
+    return counts
+
+def create_schema(path: str) -> None:
+    # Same schema and seed data as the bot; secondary indexes are dropped for
+    # the bulk load and rebuilt at the end.
+    main.DB_PATH = path
+    asyncio.run(main.setup_db())
+    conn = sqlite3.connect(path)
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL").fetchall():
+        conn.execute(f"DROP INDEX {name}")
+    conn.commit()
+    conn.close()
+
+def generate(path: str, seed: int, scale: float) -> dict:
+    if os.path.exists(path):
+        raise SystemExit(f"{path} already exists")
+    rng = random.Random(seed)
+    n_users = max(1, int(USERS * scale))
+    n_inventory = int(INVENTORY * scale)
+    n_owned = int(OWNED_PACKS * scale)
+    n_listings = int(LISTINGS * scale)
+    n_card_listings = int(n_listings * CARD_LISTING_SHARE)
+
+    create_schema(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    cards = conn.execute("SELECT card_id, rarity, base_value FROM cards").fetchall()
+    base_value = {cid: v for cid, _, v in cards}
+    by_rarity = {}
+    for cid, rarity, _ in cards:
+        by_rarity.setdefault(rarity, []).append(cid)
+    drops = main.PACK_DEFS["basic"]["drops"]
+    rarities = [r for r in drops if r in by_rarity]
+    weights = [drops[r] for r in rarities]
+    pack_types = [p for p, meta in main.PACK_DEFS.items() if not meta.get("event_only")]
+
+    timings = {}
+    started = time.perf_counter()
+
+    # Users. Wallet and upgrades now; shop_value once inventory is known.
+    user_ids = [10 ** 17 + i * 7919 for i in range(n_users)]
+    users = []
+    for uid in user_ids:
+        level = rng.choices((1, 2, 3, 4, 5), weights=(50, 25, 13, 8, 4))[0]
+        shelves = rng.choices((0, 1, 2, 4, 8), weights=(40, 25, 20, 10, 5))[0]
+        created = EPOCH + timedelta(seconds=rng.randrange(300 * 86400))
+        users.append([uid, rng.randrange(0, 20_000), level, shelves, main.INVENTORY_BASE_CAPACITY + shelves * main.SHELF_CAPACITY, created])
+    value = [0] * n_users
+
+    # Inventory, with a slice of rows locked into card listings.
+    t = time.perf_counter()
+    per_user = split_total(rng, n_inventory, n_users, 1.3)
+    listing_rate = n_card_listings / n_inventory if n_inventory else 0
+    spread = -(-n_users // SEQ)
+    card_listings = []
+    batch = []
+    for u, count in enumerate(per_user):
+        uid = user_ids[u]
+        ms = main.InventoryIds.millis(users[u][5])
+        for _ in range(count):
+            cid = rng.choice(by_rarity[rng.choices(rarities, weights=weights)[0]])
+            # Steps of at least a second keep each user's IDs increasing after the nudge.
+            inv_id, ms = inventory_id(u, ms + rng.randrange(1000, 3_600_000), spread)
+            clock = main.INVENTORY_ID_EPOCH + timedelta(milliseconds=ms)
+            locked = 0
+            if len(card_listings) < n_card_listings and rng.random() < listing_rate:
+                locked = 1
+                card_listings.append((uid, inv_id, cid, clock))
+            value[u] += base_value[cid]
+            batch.append((inv_id, uid, cid, clock.isoformat(), locked))
+            if len(batch) >= BATCH:
+                conn.executemany("INSERT INTO inventory (inventory_id, user_id, card_id, created_at, locked) VALUES (?, ?, ?, ?, ?)", batch)
+                batch.clear()
+    if batch:
+        conn.executemany("INSERT INTO inventory (inventory_id, user_id, card_id, created_at, locked) VALUES (?, ?, ?, ?, ?)", batch)
+    timings["inventory"] = time.perf_counter() - t
+
+    # Listed cards keep counting towards shop value, as they do in the bot.
+    t = time.perf_counter()
+    conn.executemany(
+        "INSERT INTO users (user_id, wallet, shop_level, shelves, inventory_capacity, lifetime_profit, created_at, shop_value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (uid, wallet, level, shelves, cap, rng.randrange(0, 50_000), created.isoformat(),
+             wallet + level * main.SHOP_LEVEL_VALUE + shelves * main.SHELF_VALUE + value[u])
+            for u, (uid, wallet, level, shelves, cap, created) in enumerate(users)
+        ),
+    )
+    timings["users"] = time.perf_counter() - t
+
+    # Owned packs: counted rows, one per (user, pack type).
+    t = time.perf_counter()
+    rows = []
+    for u, qty in enumerate(split_total(rng, n_owned, n_users, 1.5)):
+        if qty == 0:
+            continue
+        types = rng.sample(pack_types, rng.randint(1, len(pack_types)))
+        shares = split_total(rng, qty, len(types), 3.0)
+        for ord_, (ptype, q) in enumerate(zip(types, shares), start=1):
+            if q:
+                rows.append((user_ids[u], ptype, q, ord_, (users[u][5] + timedelta(days=ord_)).isoformat()))
+    conn.executemany("INSERT INTO owned_packs (user_id, pack_type, quantity, ord, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+    owned_rows = len(rows)
+
+    # Store stock for shops with shelves.
+    rows = [
+        (user_ids[u], ptype, rng.randint(1, 40))
+        for u in range(n_users) if users[u][3] > 0
+        for ptype in rng.sample(pack_types, rng.randint(1, len(pack_types)))
+    ]
+    conn.executemany("INSERT INTO store_stock (user_id, pack_type, quantity) VALUES (?, ?, ?)", rows)
+    timings["packs_and_stock"] = time.perf_counter() - t
+
+    # Marketplace, in creation order so listing_id follows created_at.
+    t = time.perf_counter()
+    listings = []
+    for uid, inv_id, cid, created in card_listings:
+        status = "active" if rng.random() < ACTIVE_LISTING_SHARE else rng.choice(("sold", "removed"))
+        price = max(1, int(base_value[cid] * rng.uniform(0.6, 2.5)))
+        listings.append((created, uid, "card", inv_id, cid, None, 1, price, status))
+    for _ in range(n_listings - len(card_listings)):
+        u = rng.randrange(n_users)
+        ptype = rng.choice(pack_types)
+        status = "active" if rng.random() < ACTIVE_LISTING_SHARE else rng.choice(("sold", "removed"))
+        created = users[u][5] + timedelta(seconds=rng.randrange(30 * 86400))
+        price = max(1, int(main.PACK_DEFS[ptype]["price"] * rng.uniform(0.5, 1.5)))
+        listings.append((created, user_ids[u], "pack", None, None, ptype, rng.randint(1, 10), price, status))
+    listings.sort(key=lambda r: r[0])
+    conn.executemany(
+        "INSERT INTO marketplace (seller_id, item_type, inventory_id, card_id, pack_type, quantity, price, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((*r[1:], r[0].isoformat()) for r in listings),
+    )
+    # Only active card listings hold a lock.
+    conn.execute("UPDATE inventory SET locked = 0 WHERE locked = 1 AND inventory_id NOT IN (SELECT inventory_id FROM marketplace WHERE item_type = 'card' AND status = 'active')")
+    timings["marketplace"] = time.perf_counter() - t
+
+    conn.commit()
+    t = time.perf_counter()
+    for sql in main.CREATE_INDEXES_SQL:
+        conn.execute(sql)
+    conn.execute("ANALYZE")
+    conn.commit()
+    timings["indexes"] = time.perf_counter() - t
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+    return {
+        "seed": seed,
+        "scale": scale,
+        "users": n_users,
+        "inventory": n_inventory,
+        "owned_packs": n_owned,
+        "owned_pack_rows": owned_rows,
+        "listings": len(listings),
+        "seconds": {k: round(v, 2) for k, v in timings.items()} | {"total": round(time.perf_counter() - started, 2)},
+    }
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic database for bench/run.py.")
+    parser.add_argument("--out", default=os.path.join("bench", "bench.db"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scale", type=float, default=1.0, help="fraction of the full dataset size")
+    args = parser.parse_args()
+    summary = generate(args.out, args.seed, args.scale)
+    for key, val in summary.items():
+        print(f"{key}: {val}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,343 @@
+# Headless load test: drives the real command coroutines and view/modal
+# callbacks with stub interactions over a temporary SQLite database, so
+# concurrency and contention can be measured without a gateway connection.
+#
+#   python bench/loadtest.py --users 2000 --ops 10 --out bench/loadtest.json
+#
+# Each simulated user runs /start and then --ops random actions with a short
+# think time between them. The report has p50/p95/p99 latency, DB time and
+# lock waits (reader connection or COMMIT) per action, plus errors and a
+# tally of the replies each action got.
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import discord  # noqa: E402
+import main  # noqa: E402
+
+_ids = itertools.count(1)
+
+class StubMessage:
+    def __init__(self, recorder: "Recorder", channel_id: int, **kw):
+        self.recorder = recorder
+        self.id = next(_ids)
+        self.channel_id = channel_id
+        self.attachments = []
+        self.kw = kw
+
+    async def edit(self, **kw):
+        self.recorder.edits += 1
+        self.kw.update(kw)
+        return self
+
+_masks = [(re.compile(r"`[^`]*`"), "`ID`"), (re.compile(r"\d+"), "N")]
+
+def mask_card_names() -> None:
+    names = sorted((c["name"] for c in main.card_catalog.cards.values()), key=len, reverse=True)
+    if names:
+        _masks.insert(0, (re.compile("|".join(re.escape(n) for n in names)), "CARD"))
+
+class Recorder:
+    # Counts what one interaction sent. `outcome` is the first reply with
+    # names, IDs and numbers masked, e.g. "Sold CARD [Rare] for N coins".
+    def __init__(self):
+        self.sends = 0
+        self.edits = 0
+        self.outcome = ""
+        self.modal = None
+
+    def sent(self, content, kw) -> None:
+        self.sends += 1
+        if not self.outcome:
+            text = content.split(". ")[0] if content else "embed"
+            for pattern, repl in _masks:
+                text = pattern.sub(repl, text)
+            self.outcome = text[:60]
+
+class StubResponse:
+    def __init__(self, it: "StubInteraction"):
+        self.it = it
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, **kw):
+        self._done = True
+
+    async def send_message(self, content=None, **kw):
+        self._done = True
+        self.it.recorder.sent(content, kw)
+
+    async def edit_message(self, **kw):
+        self._done = True
+        self.it.recorder.edits += 1
+
+    async def send_modal(self, modal):
+        self._done = True
+        self.it.recorder.modal = modal
+
+class StubFollowup:
+    def __init__(self, it: "StubInteraction"):
+        self.it = it
+
+    async def send(self, content=None, **kw):
+        self.it.recorder.sent(content, kw)
+        return StubMessage(self.it.recorder, self.it.channel_id, content=content, **kw)
+
+class StubChannel:
+    def __init__(self, it: "StubInteraction", channel_id: int):
+        self.it = it
+        self.id = channel_id
+
+    async def send(self, content=None, **kw):
+        self.it.recorder.sent(content, kw)
+        return StubMessage(self.it.recorder, self.id, content=content, **kw)
+
+class StubInteraction:
+    def __init__(self, user_id: int, channel_id: int, command: str = ""):
+        self.user = types.SimpleNamespace(id=user_id, display_name=f"user{user_id}", mention=f"<@{user_id}>", bot=False)
+        self.channel_id = channel_id
+        self.guild_id = None
+        self.guild = None
+        self.type = discord.InteractionType.application_command
+        self.data = {"name": command}
+        self.command = types.SimpleNamespace(qualified_name=command) if command else None
+        self.extras = {}
+        self.recorder = Recorder()
+        self.response = StubResponse(self)
+        self.followup = StubFollowup(self)
+        self.channel = StubChannel(self, channel_id)
+
+def fill(modal, **values) -> None:
+    for name, value in values.items():
+        getattr(modal, name)._value = str(value)
+
+class Simulation:
+    def __init__(self, bot, rng: random.Random, channels: int):
+        self.bot = bot
+        self.rng = rng
+        self.channels = channels
+        self.buy_group = bot.tree.get_command("buy")
+        self.samples: dict = {}
+        self.errors: dict = {}
+        self.outcomes: dict = {}
+
+    def interaction(self, uid: int, command: str = "") -> StubInteraction:
+        return StubInteraction(uid, 1 + uid % self.channels, command)
+
+    async def command(self, name: str, uid: int, fn, *args, **kwargs) -> StubInteraction:
+        # What TycoonTree.interaction_check and on_app_command_completion do.
+        it = self.interaction(uid, name)
+        inv = main.command_metrics.start(name)
+        try:
+            await fn(it, *args, **kwargs)
+        except Exception:
+            main.command_metrics.finish(inv, error=True)
+            raise
+        main.command_metrics.finish(inv)
+        return it
+
+    async def modal(self, uid: int, button, **values) -> StubInteraction:
+        it = self.interaction(uid)
+        await button.callback(it)
+        modal = it.recorder.modal
+        fill(modal, **values)
+        mi = self.interaction(uid)
+        await modal.on_submit(mi)
+        return mi
+
+    async def unlocked_card(self, uid: int):
+        async with self.bot.reader() as rdb:
+            async with rdb.execute("SELECT inventory_id, card_id FROM inventory WHERE user_id = ? AND locked = 0 LIMIT 20", (uid,)) as c:
+                rows = await c.fetchall()
+        return self.rng.choice(rows) if rows else None
+
+    # Actions: (weight, coroutine). Lookups the user would have done by
+    # reading the screen happen before the timed part.
+
+    async def openpack(self, uid):
+        return self.command("openpack", uid, main.openpack_cmd.callback)
+
+    async def buy_pack(self, uid):
+        ptype = self.rng.choice(("basic", "basic", "rare"))
+        return self.command("buy pack", uid, functools.partial(main.BuyGroup.buy_pack.callback, self.buy_group), type=ptype)
+
+    async def sell(self, uid):
+        row = await self.unlocked_card(uid)
+        return self.command("sell", uid, main.sell.callback, card=row[0] if row else "MISSING")
+
+    async def daily(self, uid):
+        return self.command("daily", uid, main.daily.callback)
+
+    async def profile(self, uid):
+        return self.command("profile", uid, main.profile.callback)
+
+    async def market(self, uid):
+        return self.command("market", uid, main.market.callback)
+
+    async def list_card(self, uid):
+        row = await self.unlocked_card(uid)
+        view = main.MarketView(self.bot, uid)
+        price = self.rng.randint(50, 400)
+        return self.modal(uid, view.list_card, inv_id=row[0] if row else "MISSING", price=price)
+
+    async def market_buy(self, uid):
+        listings = [lst for lst in itertools.islice(reversed(main.order_book.listings.values()), 50) if lst.seller_id != uid]
+        lid = self.rng.choice(listings).listing_id if listings else 0
+        view = main.MarketView(self.bot, uid)
+        return self.modal(uid, view.buy, listing_id=lid, quantity=1)
+
+    ACTIONS = (
+        ("openpack", 25), ("buy_pack", 20), ("sell", 12), ("daily", 3),
+        ("profile", 15), ("market", 8), ("list_card", 7), ("market_buy", 10),
+    )
+
+    async def run_action(self, name: str, uid: int) -> None:
+        coro = await getattr(self, name)(uid)
+        start = time.perf_counter()
+        error = None
+        it = None
+        try:
+            it = await coro
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}".splitlines()[0][:120]
+        ms = (time.perf_counter() - start) * 1000
+        inv = main.current_invocation.get()
+        s = self.samples.setdefault(name, {"ms": [], "db_ms": [], "lock_wait_ms": [], "sends": 0, "edits": 0})
+        s["ms"].append(ms)
+        s["db_ms"].append(inv.db_ms if inv else 0.0)
+        s["lock_wait_ms"].append(inv.lock_wait_ms if inv else 0.0)
+        if error:
+            self.errors.setdefault(name, {}).setdefault(error, 0)
+            self.errors[name][error] += 1
+        elif it is not None:
+            s["sends"] += it.recorder.sends
+            s["edits"] += it.recorder.edits
+            # No reply yet means the command handed off to a background reveal.
+            outcome = it.recorder.outcome or "(background)"
+            outcomes = self.outcomes.setdefault(name, {})
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    async def user(self, uid: int, ops: int, think_ms: float, start_gate: asyncio.Event) -> None:
+        names = [n for n, _ in self.ACTIONS]
+        weights = [w for _, w in self.ACTIONS]
+        await start_gate.wait()
+        for _ in range(ops):
+            await asyncio.sleep(self.rng.uniform(0, think_ms) / 1000)
+            # Own task, like a real dispatch: context variables don't leak between actions.
+            await asyncio.create_task(self.run_action(self.rng.choices(names, weights)[0], uid))
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {}
+    v = sorted(values)
+    pick = lambda q: round(v[min(len(v) - 1, int(round(q * (len(v) - 1))))], 3)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(v[-1], 3), "mean": round(sum(v) / len(v), 3)}
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="packify-load-")
+    main.DB_PATH = args.db or os.path.join(workdir, "load.db")
+    # Read by reveal_pack on every call; gif needs assets/ and mostly measures uploads.
+    main.REVEAL_MODE = args.reveal_mode
+    bot = main.bot
+    bot.readers = main.ReaderPool(main.DB_PATH, args.readers)
+    bot.committer = main.GroupCommitter(args.group_commit_ms, main.DB_GROUP_COMMIT_MAX)
+    await bot.init_storage()
+    main.db_stats.slow_ms = args.slow_ms
+    mask_card_names()
+    rng = random.Random(args.seed)
+    sim = Simulation(bot, rng, args.channels)
+    uids = [10 ** 17 + i for i in range(args.users)]
+
+    setup = time.perf_counter()
+    await asyncio.gather(*(sim.command("start", uid, main.start.callback) for uid in uids))
+    if args.coins:
+        for uid in uids:
+            await main.adjust_wallet(bot.db, uid, args.coins)
+        await bot.commit()
+    setup_s = time.perf_counter() - setup
+
+    gate = asyncio.Event()
+    users = [asyncio.create_task(sim.user(uid, args.ops, args.think_ms, gate)) for uid in uids]
+    started = time.perf_counter()
+    gate.set()
+    await asyncio.gather(*users)
+    elapsed = time.perf_counter() - started
+
+    # Reveal animations run detached from the commands; don't time them.
+    for task in list(bot.background):
+        task.cancel()
+    await asyncio.gather(*bot.background, return_exceptions=True)
+    await bot.close_storage()
+
+    total = sum(len(s["ms"]) for s in sim.samples.values())
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            "users": args.users, "ops_per_user": args.ops, "think_ms": args.think_ms, "seed": args.seed,
+            "readers": args.readers, "group_commit_ms": args.group_commit_ms, "channels": args.channels,
+            "reveal_mode": args.reveal_mode, "sqlite": sqlite3.sqlite_version,
+        },
+        "setup_s": round(setup_s, 3),
+        "elapsed_s": round(elapsed, 3),
+        "actions": total,
+        "actions_per_s": round(total / elapsed, 1) if elapsed else None,
+        "errors": sum(n for e in sim.errors.values() for n in e.values()),
+        "overall": {
+            "ms": summarize([x for s in sim.samples.values() for x in s["ms"]]),
+            "lock_wait_ms": summarize([x for s in sim.samples.values() for x in s["lock_wait_ms"]]),
+        },
+        "by_action": {
+            name: {
+                "count": len(s["ms"]),
+                "ms": summarize(s["ms"]),
+                "db_ms": summarize(s["db_ms"]),
+                "lock_wait_ms": summarize(s["lock_wait_ms"]),
+                "sends": s["sends"],
+                "edits": s["edits"],
+                "errors": sim.errors.get(name, {}),
+                "outcomes": sim.outcomes.get(name, {}),
+            }
+            for name, s in sorted(sim.samples.items())
+        },
+    }
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Load-test the command handlers with simulated concurrent users.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=10, help="actions per user after /start")
+    parser.add_argument("--think-ms", type=float, default=50, help="max random pause before each action")
+    parser.add_argument("--coins", type=int, default=5000, help="extra starting coins per user")
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--readers", type=int, default=main.DB_READERS)
+    parser.add_argument("--group-commit-ms", type=float, default=main.DB_GROUP_COMMIT_MS)
+    parser.add_argument("--reveal-mode", choices=("gif", "batched", "classic"), default="batched")
+    parser.add_argument("--slow-ms", type=float, default=1000, help="slow-query log threshold while under load")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="database path (default: a new temporary file)")
+    parser.add_argument("--out", default=os.path.join("bench", "loadtest.json"))
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{report['actions']} actions in {report['elapsed_s']} s ({report['actions_per_s']}/s), {report['errors']} errors")
+    for name, r in report["by_action"].items():
+        ms, wait = r["ms"], r["lock_wait_ms"]
+        print(f"{name:12} n={r['count']:6}  p50 {ms['p50']:8.2f}  p95 {ms['p95']:8.2f}  p99 {ms['p99']:8.2f} ms  lock wait p95 {wait['p95']:8.2f} ms  errors {sum(r['errors'].values())}")
+    print(f"Report written to {args.out}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,194 @@
+# Times the bot's hot-path helpers against a database from bench/generate.py
+# and writes a JSON report: per benchmark latency percentiles, throughput and
+# peak Python heap.
+#
+#   python bench/run.py --db bench/bench.db --out bench/report.json
+#
+# Write benchmarks run inside a transaction that is rolled back, so the
+# database can be reused.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import aiosqlite  # noqa: E402
+import main  # noqa: E402
+
+MEMORY_ITERATIONS = 20
+
+def percentile(samples: list, q: float) -> float:
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+class Bench:
+    def __init__(self, db, rng: random.Random):
+        self.db = db
+        self.rng = rng
+        self.users: list = []
+        self.whales: list = []
+        self.card_ids: list = []
+
+    async def prepare(self) -> None:
+        async with self.db.execute("SELECT user_id FROM users ORDER BY user_id") as c:
+            self.users = [r[0] for r in await c.fetchall()]
+        async with self.db.execute("SELECT user_id FROM inventory GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 20") as c:
+            self.whales = [r[0] for r in await c.fetchall()]
+        await main.card_catalog.load(self.db)
+        await main.pack_table.load(self.db)
+        await main.order_book.load(self.db)
+        self.card_ids = list(main.card_catalog.cards)
+
+    def user(self) -> int:
+        return self.rng.choice(self.users)
+
+    # Each benchmark is one iteration; `heavy` ones run fewer times.
+
+    async def inventory_items(self, i):
+        await main.inventory_items(self.db, self.user(), limit=10)
+
+    async def inventory_page_first(self, i):
+        await main.inventory_page(self.db, self.rng.choice(self.whales), 10)
+
+    async def inventory_page_deep(self, i):
+        uid = self.rng.choice(self.whales)
+        async with self.db.execute(
+            "SELECT inventory_id FROM inventory WHERE user_id = ? ORDER BY inventory_id LIMIT 1 OFFSET 500", (uid,)
+        ) as c:
+            key = await c.fetchone()
+        await main.inventory_page(self.db, uid, 10, before=key[0] if key else None)
+
+    async def compute_shop_value(self, i):
+        await main.compute_shop_value(self.db, self.user())
+
+    async def top_shop_values(self, i):
+        await main.top_shop_values(self.db, 10)
+
+    async def shop_value_rank(self, i):
+        await main.shop_value_rank(self.db, self.user())
+
+    async def load_profile(self, i):
+        await main.load_profile(self.db, self.user())
+
+    async def roll_pack(self, i):
+        await main.roll_pack_cards(self.db, "rare")
+
+    async def roll_many_packs(self, i):
+        await main.roll_many_packs(self.db, ["basic"] * main.MAX_BULK_OPEN)
+
+    async def change_store_stock(self, i):
+        await self.db.execute("BEGIN")
+        try:
+            await main.change_store_stock(self.db, self.user(), "basic", 5)
+            await main.change_store_stock(self.db, self.user(), "basic", -5)
+        finally:
+            await self.db.rollback()
+
+    async def order_book_load(self, i):
+        await main.order_book.load(self.db)
+    order_book_load.heavy = True
+
+    async def order_book_newest(self, i):
+        main.order_book.query()[:10]
+
+    async def order_book_cheapest_rarity(self, i):
+        main.order_book.query(rarity=self.rng.choice(("Rare", "Epic", "Legendary")), cheapest=True)[:10]
+
+    async def order_book_card(self, i):
+        main.order_book.query(card_ids=self.rng.sample(self.card_ids, 3), max_price=500)[:10]
+
+    async def inventory_search_cold(self, i):
+        main.inventory_search.users.clear()
+        await main.inventory_search.get(self.db, self.rng.choice(self.whales))
+
+BENCHMARKS = [name for name, fn in vars(Bench).items() if callable(fn) and not name.startswith("_") and name not in ("prepare", "user")]
+
+async def measure(fn, iterations: int) -> dict:
+    await fn(-1)  # warm caches and the statement cache
+    samples = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        await fn(i)
+        samples.append((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - start
+    # Separate pass: tracemalloc slows Python code down too much to time under.
+    tracemalloc.start()
+    for i in range(min(iterations, MEMORY_ITERATIONS)):
+        await fn(i)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    samples.sort()
+    return {
+        "iterations": iterations,
+        "mean_ms": round(sum(samples) / len(samples), 4),
+        "p50_ms": round(percentile(samples, 0.50), 4),
+        "p95_ms": round(percentile(samples, 0.95), 4),
+        "p99_ms": round(percentile(samples, 0.99), 4),
+        "max_ms": round(samples[-1], 4),
+        "ops_per_s": round(iterations / elapsed, 1) if elapsed else None,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+def dataset(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    try:
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("users", "inventory", "owned_packs", "marketplace")}
+        counts["owned_pack_quantity"] = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM owned_packs").fetchone()[0]
+        counts["active_listings"] = conn.execute("SELECT COUNT(*) FROM marketplace WHERE status = 'active'").fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+
+async def run(path: str, iterations: int, seed: int, only: list) -> dict:
+    db = await aiosqlite.connect(path)
+    db.row_factory = aiosqlite.Row
+    await db.execute("PRAGMA busy_timeout = 5000")
+    bench = Bench(db, random.Random(seed))
+    results = {}
+    try:
+        await bench.prepare()
+        for name in BENCHMARKS:
+            if only and name not in only:
+                continue
+            fn = getattr(bench, name)
+            n = max(3, iterations // 50) if getattr(fn, "heavy", False) else iterations
+            results[name] = await measure(fn, n)
+            r = results[name]
+            print(f"{name:28} p50 {r['p50_ms']:9.3f} ms  p99 {r['p99_ms']:9.3f} ms  {r['ops_per_s'] or 0:10.1f} ops/s  peak {r['peak_kib']:9.1f} KiB")
+    finally:
+        await db.close()
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "db": os.path.abspath(path),
+        "dataset": dataset(path),
+        "seed": seed,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the bot's data-layer helpers against a generated database.")
+    parser.add_argument("--db", default=os.path.join("bench", "bench.db"))
+    parser.add_argument("--out", default=os.path.join("bench", "report.json"))
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", default=[], choices=BENCHMARKS, metavar="NAME")
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        raise SystemExit(f"{args.db} not found; create it with bench/generate.py")
+    report = asyncio.run(run(args.db, args.iterations, args.seed, args.only))
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.out}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,15 +1,37 @@
+import argparse
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import functools
+import hashlib
+import io
 import json
+import marshal
+import mmap
 import os
 import random
-import string
+import re
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple
 
+import aiohttp
 import aiosqlite
 import discord
+from aiohttp import web
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -19,12 +41,60 @@ INTENTS = discord.Intents.default()
 BOT_PREFIX = "!"  
 
 DB_PATH = "collection.db"
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_GROUP_COMMIT_MS = float(os.getenv("DB_GROUP_COMMIT_MS", "0"))
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "64"))
+# UPDATE ... RETURNING needs 3.35 (UPDATE ... FROM needs 3.33).
+MIN_SQLITE_VERSION = (3, 35, 0)
+DB_SLOW_MS = float(os.getenv("DB_SLOW_MS", "50"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 disables the endpoint; cluster process i uses METRICS_PORT + i
+# Cluster mode (`python main.py --cluster N`) sets these for each process it starts.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))  # 0: as many as Discord recommends
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()]
+CLUSTER_INDEX = int(os.getenv("CLUSTER_INDEX", "0"))
+CLUSTER_SIZE = int(os.getenv("CLUSTER_SIZE", "1"))
+STORAGE_SOCKET = os.getenv("STORAGE_SOCKET", "")  # set: use the storage service instead of opening the DB
+IDENTIFY_CONCURRENCY = int(os.getenv("IDENTIFY_CONCURRENCY", "1"))
 TEST_GUILD_ID = None  
 COLOR_DEFAULT = 0x2F3136
 
 STARTING_COINS = 1000
 STARTING_PACK = "basic"
 INVENTORY_BASE_CAPACITY = 200
+MAX_BULK_OPEN = 200
+SEARCH_INDEX_USERS = 512
+PROFILE_CACHE_USERS = 4096
+SHOP_LEVEL_VALUE = 200
+SHELF_VALUE = 150
+SHELF_PRICE = 500
+SHELF_CAPACITY = 20
+UPGRADE_PRICE = 800
+DAILY_COOLDOWN = timedelta(hours=22)
+NPC_SALES_PER_SHELF = 5
+NPC_MARGIN_PCT = 20
+NPC_SETTLE_SECONDS = float(os.getenv("NPC_SETTLE_SECONDS", "300"))
+REVEAL_BATCHES = int(os.getenv("REVEAL_BATCHES", "3"))
+REVEAL_DELAY = 0.7
+EDIT_BURST = 5           # message edits per channel before throttling
+EDIT_RATE = 1.0          # edits per second each channel earns back
+
+# Local paths or hosted URLs. Local files are uploaded once per channel and
+# the attachment URL is reused for ANIM_URL_TTL seconds.
+ANIM_GIFS = {
+    "basic": "assets/pack_basic.gif",
+    "rare": "assets/pack_rare.gif",
+    "epic": "assets/pack_epic.gif",
+    "halloween": "assets/pack_halloween.gif",
+}
+DEFAULT_ANIM_DELAY = 2.5
+ANIM_URL_TTL = 12 * 3600
+ANIM_MAX_UPLOAD_MB = float(os.getenv("ANIM_MAX_UPLOAD_MB", "8"))
+ANIM_UPLOAD_BUDGET_MB = float(os.getenv("ANIM_UPLOAD_BUDGET_MB", "64"))  # per hour
+# gif | batched | classic. No assets/ ships with the code, so gif is only the
+# default when at least one pack GIF is a URL or present on disk.
+REVEAL_MODE = os.getenv("REVEAL_MODE", "").lower() or (
+    "gif" if any(src.startswith(("http://", "https://")) or os.path.isfile(src) for src in ANIM_GIFS.values()) else "batched"
+)
 
 
 RARITY_META = {
@@ -157,8 +227,65 @@ def readable_ts(ts: Optional[str]) -> str:
     except Exception:
         return ts
 
-def random_id(n: int = 10) -> str:
-    return "".join(random.choices(string.ascii_uppercase + string.digits, k=n))
+INVENTORY_ID_EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+class InventoryIds:
+    # 10-character inventory IDs in Crockford base32: milliseconds since
+    # INVENTORY_ID_EPOCH in the high 41 bits and a sequence in the low 9.
+    # Each ID is greater than the last one handed out, so IDs sort (as text)
+    # in creation order and inserts append to the primary key index.
+    ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+    SEQ_BITS = 9
+    LENGTH = 10
+
+    def __init__(self):
+        self.last = 0
+        self.offset = 0
+        self.stride = 1
+
+    def partition(self, index: int, size: int) -> None:
+        # Cluster processes generate IDs independently; process `index` only
+        # hands out values congruent to it modulo `size`, so they never collide.
+        self.offset = index
+        self.stride = max(1, size)
+
+    @classmethod
+    def encode(cls, n: int) -> str:
+        out = []
+        for _ in range(cls.LENGTH):
+            n, r = divmod(n, 32)
+            out.append(cls.ALPHABET[r])
+        return "".join(reversed(out))
+
+    @classmethod
+    def decode(cls, code: str) -> Optional[int]:
+        if len(code) != cls.LENGTH:
+            return None
+        n = 0
+        for ch in code:
+            i = cls.ALPHABET.find(ch)
+            if i < 0:
+                return None
+            n = n * 32 + i
+        return n
+
+    @staticmethod
+    def millis(at: Optional[datetime] = None) -> int:
+        return max(0, int(((at or datetime.now(timezone.utc)) - INVENTORY_ID_EPOCH).total_seconds() * 1000))
+
+    def next(self, ms: Optional[int] = None) -> str:
+        ms = self.millis() if ms is None else ms
+        n = max(ms << self.SEQ_BITS, self.last + 1)
+        self.last = n + (self.offset - n) % self.stride
+        return self.encode(self.last)
+
+    def observe(self, inventory_id: Optional[str]) -> None:
+        # Never hand out an ID at or below one that is already stored.
+        n = self.decode(inventory_id) if inventory_id else None
+        if n is not None:
+            self.last = max(self.last, n)
+
+inventory_ids = InventoryIds()
 
 def rarity_emoji(r: str) -> str:
     return RARITY_META.get(r, {}).get("emoji", "❔")
@@ -183,7 +310,11 @@ CREATE_TABLES_SQL = [
         inventory_capacity INTEGER NOT NULL DEFAULT 200,
         lifetime_profit INTEGER NOT NULL DEFAULT 0,
         created_at TEXT,
-        last_daily TEXT
+        last_daily TEXT,
+        shop_value INTEGER NOT NULL DEFAULT 0,
+        pending_sales INTEGER NOT NULL DEFAULT 0,   -- NPC sales profit waiting for /daily
+        pending_units INTEGER NOT NULL DEFAULT 0,
+        npc_settled_at TEXT
     );
     """,
     """
@@ -206,6 +337,12 @@ CREATE_TABLES_SQL = [
     );
     """,
     """
+    CREATE TABLE IF NOT EXISTS inventory_aliases (
+        old_id TEXT PRIMARY KEY,      -- random ID a card had before migration 7
+        inventory_id TEXT NOT NULL
+    );
+    """,
+    """
     CREATE TABLE IF NOT EXISTS packs (
         type TEXT PRIMARY KEY,
         name TEXT,
@@ -218,10 +355,12 @@ CREATE_TABLES_SQL = [
     """,
     """
     CREATE TABLE IF NOT EXISTS owned_packs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        pack_type TEXT,
-        created_at TEXT
+        user_id INTEGER NOT NULL,
+        pack_type TEXT NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        ord INTEGER NOT NULL DEFAULT 0,  -- opening order: lowest first
+        created_at TEXT,
+        PRIMARY KEY (user_id, pack_type)
     );
     """,
     """
@@ -238,100 +377,358 @@ CREATE_TABLES_SQL = [
         seller_id INTEGER,
         item_type TEXT,           -- 'card' or 'pack'
         inventory_id TEXT,        -- if card
+        card_id INTEGER,          -- if card
         pack_type TEXT,           -- if pack
         quantity INTEGER,
         price INTEGER,
         status TEXT DEFAULT 'active',
         created_at TEXT
     );
+    """,
     """
+    CREATE TABLE IF NOT EXISTS bot_meta (
+        key TEXT PRIMARY KEY,     -- e.g. command_tree:<app id>:global
+        value TEXT NOT NULL
+    );
+    """,
 ]
 
-async def setup_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        for sql in CREATE_TABLES_SQL:
-            await db.execute(sql)
-        await db.commit()
-
+# Indexes for a freshly created database. Existing databases get the same
+# indexes through MIGRATIONS; keep both lists in step.
+CREATE_INDEXES_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_users_shop_value ON users(shop_value DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_inventory_user_id ON inventory(user_id, inventory_id)",
+    "CREATE INDEX IF NOT EXISTS idx_owned_packs_user_ord ON owned_packs(user_id, ord)",
+    "CREATE INDEX IF NOT EXISTS idx_marketplace_status ON marketplace(status, listing_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_npc_due ON users(npc_settled_at) WHERE shelves > 0",
+]
 
+async def _add_column(db, table: str, column: str, decl: str) -> bool:
+    async with db.execute(f"PRAGMA table_info({table})") as c:
+        cols = {r[1] for r in await c.fetchall()}
+    if column in cols:
+        return False
+    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+async def _migrate_shop_value(db):
+    if await _add_column(db, "users", "shop_value", "INTEGER NOT NULL DEFAULT 0"):
+        await recompute_shop_values(db)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_shop_value ON users(shop_value DESC)")
+
+async def _migrate_counted_owned_packs(db):
+    async with db.execute("PRAGMA table_info(owned_packs)") as c:
+        cols = {r[1] for r in await c.fetchall()}
+    if "id" in cols:
+        await db.execute("""
+            CREATE TABLE owned_packs_counted (
+                user_id INTEGER NOT NULL,
+                pack_type TEXT NOT NULL,
+                quantity INTEGER NOT NULL DEFAULT 0,
+                ord INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT,
+                PRIMARY KEY (user_id, pack_type)
+            )
+        """)
+        await db.execute("""
+            INSERT INTO owned_packs_counted (user_id, pack_type, quantity, ord, created_at)
+            SELECT user_id, pack_type, COUNT(*), MIN(id), MIN(created_at)
+            FROM owned_packs WHERE user_id IS NOT NULL AND pack_type IS NOT NULL
+            GROUP BY user_id, pack_type
+        """)
+        await db.execute("DROP TABLE owned_packs")
+        await db.execute("ALTER TABLE owned_packs_counted RENAME TO owned_packs")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_owned_packs_user_ord ON owned_packs(user_id, ord)")
+
+async def _migrate_npc_settlement(db):
+    await _add_column(db, "users", "pending_sales", "INTEGER NOT NULL DEFAULT 0")
+    await _add_column(db, "users", "pending_units", "INTEGER NOT NULL DEFAULT 0")
+    await _add_column(db, "users", "npc_settled_at", "TEXT")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_npc_due ON users(npc_settled_at) WHERE shelves > 0")
+
+async def _migrate_listing_card_id(db):
+    await _add_column(db, "marketplace", "card_id", "INTEGER")
+    await db.execute("""
+        UPDATE marketplace SET card_id = (SELECT card_id FROM inventory WHERE inventory.inventory_id = marketplace.inventory_id)
+        WHERE item_type = 'card' AND card_id IS NULL
+    """)
+
+async def _migrate_time_ordered_ids(db):
+    # The rebuild is skipped once inventory_aliases has rows, or when every ID
+    # is already in the new format and sorts in created_at order (rows written
+    # after an earlier run over an empty inventory). The index is settled
+    # either way.
+    await db.execute("CREATE TABLE IF NOT EXISTS inventory_aliases (old_id TEXT PRIMARY KEY, inventory_id TEXT NOT NULL)")
+    async with db.execute("SELECT EXISTS (SELECT 1 FROM inventory_aliases)") as c:
+        done = (await c.fetchone())[0]
+    if not done:
+        async with db.execute("SELECT inventory_id, created_at FROM inventory ORDER BY created_at, inventory_id") as c:
+            rows = await c.fetchall()
+        keys = [r[0] for r in rows]
+        done = bool(rows) and keys == sorted(keys) and all(InventoryIds.decode(k) is not None for k in keys)
+        if not done:
+            await _rekey_inventory(db, rows)
+    await db.execute("DROP INDEX IF EXISTS idx_inventory_user_created_id")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_inventory_user_id ON inventory(user_id, inventory_id)")
+
+async def _rekey_inventory(db, rows):
+    # Rebuilds inventory with IDs from InventoryIds, assigned in the old
+    # (created_at, inventory_id) order so the new key order matches it. The
+    # old IDs stay resolvable through inventory_aliases.
+    ids = InventoryIds()
+    mapping = []
+    for old_id, created_at in rows:
+        try:
+            at = datetime.fromisoformat(created_at) if created_at else None
+        except ValueError:
+            at = None
+        if at is not None and at.tzinfo is None:
+            at = at.replace(tzinfo=timezone.utc)
+        mapping.append((old_id, ids.next(InventoryIds.millis(at) if at else 0)))
+    await db.execute("CREATE TEMP TABLE inventory_id_map (old_id TEXT PRIMARY KEY, new_id TEXT NOT NULL)")
+    await db.executemany("INSERT INTO temp.inventory_id_map (old_id, new_id) VALUES (?, ?)", mapping)
+    await db.execute("""
+        CREATE TABLE inventory_rebuilt (
+            inventory_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            card_id INTEGER,
+            created_at TEXT,
+            locked INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (card_id) REFERENCES cards(card_id)
+        )
+    """)
+    await db.execute("""
+        INSERT INTO inventory_rebuilt (inventory_id, user_id, card_id, created_at, locked)
+        SELECT m.new_id, i.user_id, i.card_id, i.created_at, i.locked
+        FROM inventory i JOIN temp.inventory_id_map m ON m.old_id = i.inventory_id
+        ORDER BY m.new_id
+    """)
+    await db.execute("INSERT OR IGNORE INTO inventory_aliases (old_id, inventory_id) SELECT old_id, new_id FROM temp.inventory_id_map")
+    await db.execute("""
+        UPDATE marketplace SET inventory_id = (SELECT new_id FROM temp.inventory_id_map WHERE old_id = marketplace.inventory_id)
+        WHERE inventory_id IN (SELECT old_id FROM temp.inventory_id_map)
+    """)
+    await db.execute("DROP TABLE inventory")
+    await db.execute("ALTER TABLE inventory_rebuilt RENAME TO inventory")
+    await db.execute("DROP TABLE temp.inventory_id_map")
+
+# (version, description, step). A step is a list of SQL statements or an
+# async callable taking the connection. Each step commits together with its
+# PRAGMA user_version bump, and must still be safe to re-run. Indexes that a
+# later step replaces are not created on the way: 2 and 3 only keep what
+# survives migration 4's and 7's table rebuilds.
+MIGRATIONS = [
+    (1, "users.shop_value with leaderboard index", _migrate_shop_value),
+    (2, "marketplace status index", [
+        "CREATE INDEX IF NOT EXISTS idx_marketplace_status ON marketplace(status, listing_id)",
+    ]),
+    # Databases already past 2 may still carry its old (user_id, created_at)
+    # index; the one 3 used to add goes with migration 7's rebuild.
+    (3, "drop the superseded inventory index", [
+        "DROP INDEX IF EXISTS idx_inventory_user_created",
+    ]),
+    (4, "owned_packs as one counted row per (user, pack type)", _migrate_counted_owned_packs),
+    (5, "pending NPC sales columns", _migrate_npc_settlement),
+    (6, "marketplace.card_id", _migrate_listing_card_id),
+    (7, "time-ordered inventory IDs with aliases for the old ones", _migrate_time_ordered_ids),
+    (8, "bot_meta key/value table", [
+        "CREATE TABLE IF NOT EXISTS bot_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+async def get_schema_version(db) -> int:
+    async with db.execute("PRAGMA user_version") as c:
+        return (await c.fetchone())[0]
+
+async def run_migrations(db) -> int:
+    version = await get_schema_version(db)
+    for target, desc, step in MIGRATIONS:
+        if target <= version:
+            continue
+        await db.execute("BEGIN")
+        try:
+            if callable(step):
+                await step(db)
+            else:
+                for sql in step:
+                    await db.execute(sql)
+            await db.execute(f"PRAGMA user_version = {int(target)}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        print(f"Applied migration {target}: {desc}")
+        version = target
+    return version
+
+def catalog_hash() -> str:
+    payload = {"cards": CARD_POOL, "packs": PACK_DEFS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+async def seed_catalog(db) -> bool:
+    # Brings `cards` and `packs` in line with CARD_POOL and PACK_DEFS, in one
+    # transaction and only when their hash has changed since the last run.
+    # Cards are matched by name and never deleted, since inventory rows
+    # point at them; a renamed card is a new card.
+    digest = catalog_hash()
+    if await get_meta(db, "catalog") == digest:
+        return False
+    await db.execute("BEGIN")
+    try:
+        async with db.execute("SELECT name, card_id, rarity, collection, base_value FROM cards") as c:
+            cards = {r[0]: tuple(r[1:]) for r in await c.fetchall()}
+        added, updated, deltas = [], [], []
         for name, rarity, collection, base_value in CARD_POOL:
-            try:
-                await db.execute(
-                    "INSERT OR IGNORE INTO cards (name, rarity, collection, base_value) VALUES (?, ?, ?, ?)",
-                    (name, rarity, collection, base_value),
-                )
-            except Exception:
-                pass
-
-        for ptype, meta in PACK_DEFS.items():
-            drops_json = json.dumps(meta["drops"])
+            old = cards.get(name)
+            if old is None:
+                added.append((name, rarity, collection, base_value))
+            elif old[1:] != (rarity, collection, base_value):
+                updated.append((rarity, collection, base_value, name))
+                if (old[3] or 0) != (base_value or 0):
+                    deltas.append((old[0], (base_value or 0) - (old[3] or 0)))
+        await db.executemany("INSERT INTO cards (name, rarity, collection, base_value) VALUES (?, ?, ?, ?)", added)
+        await db.executemany("UPDATE cards SET rarity = ?, collection = ?, base_value = ? WHERE name = ?", updated)
+        if deltas:
+            # Owned cards count towards shop value, so shift it by the change
+            # per copy: one pass over inventory rather than a full recompute.
+            changes = ",".join(["(?, ?)"] * len(deltas))
             await db.execute(
-                """INSERT OR REPLACE INTO packs (type, name, price, min_cards, max_cards, drops, event_only)
-                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                (
-                    ptype,
-                    meta["name"],
-                    meta["price"],
-                    meta["min_cards"],
-                    meta["max_cards"],
-                    drops_json,
-                    1 if meta.get("event_only") else 0,
-                ),
+                f"""WITH changed(card_id, delta) AS (VALUES {changes})
+                UPDATE users SET shop_value = shop_value + (
+                    SELECT SUM(ch.delta) FROM inventory inv JOIN changed ch ON ch.card_id = inv.card_id
+                    WHERE inv.user_id = users.user_id)
+                WHERE user_id IN (SELECT inv.user_id FROM inventory inv JOIN changed ch ON ch.card_id = inv.card_id)""",
+                [v for d in deltas for v in d],
             )
+
+        async with db.execute("SELECT type, name, price, min_cards, max_cards, drops, event_only FROM packs") as c:
+            packs = {r[0]: tuple(r) for r in await c.fetchall()}
+        rows = [
+            (ptype, meta["name"], meta["price"], meta["min_cards"], meta["max_cards"], json.dumps(meta["drops"]), 1 if meta.get("event_only") else 0)
+            for ptype, meta in PACK_DEFS.items()
+        ]
+        await db.executemany(
+            """INSERT INTO packs (type, name, price, min_cards, max_cards, drops, event_only) VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(type) DO UPDATE SET name = excluded.name, price = excluded.price, min_cards = excluded.min_cards,
+               max_cards = excluded.max_cards, drops = excluded.drops, event_only = excluded.event_only""",
+            [r for r in rows if packs.get(r[0]) != r],
+        )
+        await set_meta(db, "catalog", digest)
         await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    card_catalog.invalidate()
+    pack_table.invalidate()
+    if deltas:
+        profile_cache.clear()
+    if added or updated:
+        print(f"Catalog updated: {len(added)} new and {len(updated)} changed cards.")
+    return True
+
+def check_sqlite_version() -> None:
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        need = ".".join(map(str, MIN_SQLITE_VERSION))
+        raise RuntimeError(f"Packify needs SQLite {need} or newer, but this Python is linked against SQLite {sqlite3.sqlite_version}. Upgrade Python or its SQLite library.")
 
-async def get_user(db, user_id: int) -> Optional[aiosqlite.Row]:
-    db.row_factory = aiosqlite.Row
-    async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as c:
-        return await c.fetchone()
+async def setup_db():
+    check_sqlite_version()
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute("PRAGMA journal_mode = WAL")
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'") as c:
+            fresh = await c.fetchone() is None
+        for sql in CREATE_TABLES_SQL:
+            await db.execute(sql)
+        if fresh:
+            for sql in CREATE_INDEXES_SQL:
+                await db.execute(sql)
+            await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        await db.commit()
+        await run_migrations(db)
+        await seed_catalog(db)
 
-async def create_user(db, user_id: int) -> None:
+async def get_meta(db, key: str) -> Optional[str]:
+    async with db.execute("SELECT value FROM bot_meta WHERE key = ?", (key,)) as c:
+        row = await c.fetchone()
+    return row[0] if row else None
+
+async def set_meta(db, key: str, value: str) -> None:
     await db.execute(
-        "INSERT OR IGNORE INTO users (user_id, wallet, shop_level, shelves, inventory_capacity, lifetime_profit, created_at) VALUES (?, ?, 1, 0, ?, 0, ?)",
-        (user_id, STARTING_COINS, INVENTORY_BASE_CAPACITY, now_iso()),
+        "INSERT INTO bot_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value),
     )
+
+async def create_user(db, user_id: int) -> None:
     await db.execute(
-        "INSERT INTO owned_packs (user_id, pack_type, created_at) VALUES (?, ?, ?)",
-        (user_id, STARTING_PACK, now_iso()),
+        "INSERT OR IGNORE INTO users (user_id, wallet, shop_level, shelves, inventory_capacity, lifetime_profit, created_at, shop_value) VALUES (?, ?, 1, 0, ?, 0, ?, ?)",
+        (user_id, STARTING_COINS, INVENTORY_BASE_CAPACITY, now_iso(), STARTING_COINS + SHOP_LEVEL_VALUE),
     )
-    await db.commit()
-
-async def get_pack_def(db, pack_type: str) -> Optional[Dict]:
-    db.row_factory = aiosqlite.Row
-    async with db.execute("SELECT * FROM packs WHERE type = ?", (pack_type,)) as c:
-        row = await c.fetchone()
-        if not row:
-            return None
-        return {
-            "type": row["type"],
-            "name": row["name"],
-            "price": row["price"],
-            "min_cards": row["min_cards"],
-            "max_cards": row["max_cards"],
-            "drops": json.loads(row["drops"]),
-            "event_only": bool(row["event_only"]),
-        }
+    await give_owned_pack(db, user_id, STARTING_PACK)
+    profile_cache.invalidate(user_id)
+
+def _pack_row_to_def(row) -> Dict:
+    return {
+        "type": row["type"],
+        "name": row["name"],
+        "price": row["price"],
+        "min_cards": row["min_cards"],
+        "max_cards": row["max_cards"],
+        "drops": json.loads(row["drops"]),
+        "event_only": bool(row["event_only"]),
+    }
+
+class CompiledPack:
+    # Pack definition plus a Walker alias table over its drop weights, so a
+    # rarity draw is one randrange and one random() regardless of pack size.
+    def __init__(self, pack: Dict):
+        self.pack = pack
+        self.rarities: List[str] = list(pack["drops"].keys())
+        weights = [float(pack["drops"][r]) for r in self.rarities]
+        k = len(weights)
+        total = sum(weights) or 1.0
+        scaled = [w * k / total for w in weights]
+        self.prob = [1.0] * k
+        self.alias = list(range(k))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+
+    def draw_rarity(self) -> str:
+        i = random.randrange(len(self.rarities))
+        return self.rarities[i] if random.random() < self.prob[i] else self.rarities[self.alias[i]]
+
+class PackTable:
+    # In-memory copy of the `packs` table. setup_db invalidates it after reseeding.
+    def __init__(self):
+        self.packs: Dict[str, CompiledPack] = {}
+        self.loaded = False
 
-async def list_pack_types(db, include_event: bool = False) -> List[Dict]:
-    db.row_factory = aiosqlite.Row
-    if include_event:
+    async def load(self, db) -> None:
+        db.row_factory = aiosqlite.Row
         async with db.execute("SELECT * FROM packs") as c:
             rows = await c.fetchall()
-    else:
-        async with db.execute("SELECT * FROM packs WHERE event_only = 0") as c:
-            rows = await c.fetchall()
-    out = []
-    for row in rows:
-        out.append({
-            "type": row["type"],
-            "name": row["name"],
-            "price": row["price"],
-            "min_cards": row["min_cards"],
-            "max_cards": row["max_cards"],
-            "drops": json.loads(row["drops"]),
-            "event_only": bool(row["event_only"]),
-        })
-    return out
+        self.packs = {row["type"]: CompiledPack(_pack_row_to_def(row)) for row in rows}
+        self.loaded = True
+
+    def invalidate(self) -> None:
+        self.loaded = False
+
+pack_table = PackTable()
+
+async def get_compiled_pack(db, pack_type: str) -> Optional[CompiledPack]:
+    if not pack_table.loaded:
+        await pack_table.load(db)
+    return pack_table.packs.get(pack_type)
+
+async def get_pack_def(db, pack_type: str) -> Optional[Dict]:
+    compiled = await get_compiled_pack(db, pack_type)
+    return compiled.pack if compiled else None
 
 async def inventory_count(db, user_id: int) -> int:
     async with db.execute("SELECT COUNT(*) FROM inventory WHERE user_id = ?", (user_id,)) as c:
@@ -346,12 +743,52 @@ async def inventory_items(db, user_id: int, limit: int = 100, offset: int = 0) -
     FROM inventory AS inv
     JOIN cards ON cards.card_id = inv.card_id
     WHERE inv.user_id = ?
-    ORDER BY inv.created_at DESC
+    ORDER BY inv.inventory_id DESC
     LIMIT ? OFFSET ?
     """
     async with db.execute(q, (user_id, limit, offset)) as c:
         return await c.fetchall()
 
+async def inventory_page(
+    db,
+    user_id: int,
+    limit: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    oldest: bool = False,
+) -> List[aiosqlite.Row]:
+    # Keyset page over inventory_id, which sorts in creation order, always
+    # returned newest first. `before`/`after` are the IDs of the rows
+    # bordering the wanted page; `oldest` returns the final page.
+    db.row_factory = aiosqlite.Row
+    cols = """
+    SELECT inv.inventory_id, inv.created_at, inv.locked,
+           cards.card_id, cards.name, cards.rarity, cards.collection, cards.base_value
+    FROM inventory AS inv
+    JOIN cards ON cards.card_id = inv.card_id
+    WHERE inv.user_id = ?
+    """
+    reverse = False
+    if before:
+        q = cols + " AND inv.inventory_id < ? ORDER BY inv.inventory_id DESC LIMIT ?"
+        args = (user_id, before, limit)
+    elif after:
+        q = cols + " AND inv.inventory_id > ? ORDER BY inv.inventory_id ASC LIMIT ?"
+        args = (user_id, after, limit)
+        reverse = True
+    elif oldest:
+        q = cols + " ORDER BY inv.inventory_id ASC LIMIT ?"
+        args = (user_id, limit)
+        reverse = True
+    else:
+        q = cols + " ORDER BY inv.inventory_id DESC LIMIT ?"
+        args = (user_id, limit)
+    async with db.execute(q, args) as c:
+        rows = await c.fetchall()
+    if reverse:
+        rows.reverse()
+    return rows
+
 async def get_inventory_item(db, user_id: int, inventory_id: str) -> Optional[aiosqlite.Row]:
     db.row_factory = aiosqlite.Row
     q = """
@@ -359,96 +796,241 @@ async def get_inventory_item(db, user_id: int, inventory_id: str) -> Optional[ai
            cards.card_id, cards.name, cards.rarity, cards.collection, cards.base_value
     FROM inventory AS inv
     JOIN cards ON cards.card_id = inv.card_id
-    WHERE inv.user_id = ? AND inv.inventory_id = ?
+    WHERE inv.user_id = ? AND inv.inventory_id IN (?, (SELECT inventory_id FROM inventory_aliases WHERE old_id = ?))
     """
-    async with db.execute(q, (user_id, inventory_id)) as c:
+    async with db.execute(q, (user_id, inventory_id, inventory_id)) as c:
         return await c.fetchone()
 
-async def add_card_to_inventory(db, user_id: int, card_id: int) -> str:
-    inv_id = random_id()
-    await db.execute(
-        "INSERT INTO inventory (inventory_id, user_id, card_id, created_at, locked) VALUES (?, ?, ?, ?, 0)",
-        (inv_id, user_id, card_id, now_iso()),
-    )
-    return inv_id
-
-async def remove_inventory_item(db, user_id: int, inventory_id: str) -> None:
-    await db.execute("DELETE FROM inventory WHERE user_id = ? AND inventory_id = ?", (user_id, inventory_id))
+INVENTORY_INSERT_CHUNK = 500
+
+async def add_cards_to_inventory(db, user_id: int, card_ids: List[int], within_capacity: bool = False) -> Optional[List[str]]:
+    # With within_capacity, all cards go in one statement that inserts
+    # nothing, and this returns None, if they don't fit in inventory_capacity.
+    created = now_iso()
+    inv_ids: List[str] = []
+    step = max(1, len(card_ids)) if within_capacity else INVENTORY_INSERT_CHUNK
+    for start in range(0, len(card_ids), step):
+        chunk = card_ids[start:start + step]
+        for attempt in range(3):
+            ids = [inventory_ids.next() for _ in chunk]
+            params = [v for inv_id, card_id in zip(ids, chunk) for v in (inv_id, user_id, card_id, created)]
+            values = ",".join(["(?, ?, ?, ?, 0)"] * len(chunk))
+            try:
+                # One statement per chunk, so a duplicate key rolls back the whole chunk.
+                if within_capacity:
+                    cur = await db.execute(
+                        f"""INSERT INTO inventory (inventory_id, user_id, card_id, created_at, locked)
+                            SELECT * FROM (VALUES {values})
+                            WHERE (SELECT COUNT(*) FROM inventory WHERE user_id = ?) + ? <= (SELECT inventory_capacity FROM users WHERE user_id = ?)""",
+                        params + [user_id, len(chunk), user_id],
+                    )
+                    if cur.rowcount != len(chunk):
+                        return None
+                else:
+                    await db.execute("INSERT INTO inventory (inventory_id, user_id, card_id, created_at, locked) VALUES " + values, params)
+                break
+            except sqlite3.IntegrityError:
+                # Another writer issued IDs past ours; continue after the highest stored one.
+                if attempt == 2:
+                    raise
+                async with db.execute("SELECT MAX(inventory_id) FROM inventory") as c:
+                    inventory_ids.observe((await c.fetchone())[0])
+        inv_ids.extend(ids)
+    if not card_catalog.loaded:
+        await card_catalog.load(db)
+    value = sum(card_catalog.cards[cid]["base_value"] or 0 for cid in card_ids)
+    await db.execute("UPDATE users SET shop_value = shop_value + ? WHERE user_id = ?", (value, user_id))
+    inventory_search.added(user_id, list(zip(inv_ids, card_ids)))
+    profile_cache.invalidate(user_id)
+    return inv_ids
+
+async def remove_inventory_item(db, user_id: int, inventory_id: str) -> bool:
+    # False if the card is gone or locked in a trade/listing.
+    async with db.execute(
+        "DELETE FROM inventory WHERE user_id = ? AND inventory_id = ? AND locked = 0 RETURNING card_id",
+        (user_id, inventory_id),
+    ) as c:
+        row = await c.fetchone()
+    if not row:
+        return False
+    if not card_catalog.loaded:
+        await card_catalog.load(db)
+    card = card_catalog.get(row[0])
+    await db.execute("UPDATE users SET shop_value = shop_value - ? WHERE user_id = ?", ((card["base_value"] or 0) if card else 0, user_id))
+    inventory_search.removed(user_id, [inventory_id])
+    profile_cache.invalidate(user_id)
+    return True
+
+async def transfer_inventory_items(db, inventory_ids: List[str], from_user_id: int, to_user_id: int, locked: int = 0) -> List[str]:
+    # Moves the cards from_user_id still owns with the given lock state (1 for
+    # trade offers and listings); returns the IDs that actually moved.
+    if not inventory_ids:
+        return []
+    marks = ",".join("?" * len(inventory_ids))
+    async with db.execute(
+        f"""UPDATE inventory SET user_id = ?, locked = 0
+            WHERE user_id = ? AND locked = ? AND inventory_id IN ({marks})
+            RETURNING inventory_id, card_id""",
+        (to_user_id, from_user_id, locked, *inventory_ids),
+    ) as c:
+        rows = await c.fetchall()
+    if not rows:
+        return []
+    if not card_catalog.loaded:
+        await card_catalog.load(db)
+    value = 0
+    for r in rows:
+        card = card_catalog.get(r[1])
+        value += (card["base_value"] or 0) if card else 0
+    await db.execute("UPDATE users SET shop_value = shop_value - ? WHERE user_id = ?", (value, from_user_id))
+    await db.execute("UPDATE users SET shop_value = shop_value + ? WHERE user_id = ?", (value, to_user_id))
+    inventory_search.removed(from_user_id, [r[0] for r in rows])
+    inventory_search.added(to_user_id, [(r[0], r[1]) for r in rows])
+    profile_cache.invalidate(to_user_id, from_user_id)
+    return [r[0] for r in rows]
 
 async def owned_packs_count(db, user_id: int) -> int:
-    async with db.execute("SELECT COUNT(*) FROM owned_packs WHERE user_id = ?", (user_id,)) as c:
+    async with db.execute("SELECT COALESCE(SUM(quantity), 0) FROM owned_packs WHERE user_id = ?", (user_id,)) as c:
         row = await c.fetchone()
         return row[0] if row else 0
 
-async def pop_oldest_owned_pack(db, user_id: int) -> Optional[str]:
-    db.row_factory = aiosqlite.Row
-    async with db.execute("SELECT id, pack_type FROM owned_packs WHERE user_id = ? ORDER BY id ASC LIMIT 1", (user_id,)) as c:
-        row = await c.fetchone()
-        if not row:
-            return None
-        await db.execute("DELETE FROM owned_packs WHERE id = ?", (row["id"],))
-        return row["pack_type"]
-
-async def give_owned_pack(db, user_id: int, pack_type: str):
-    await db.execute("INSERT INTO owned_packs (user_id, pack_type, created_at) VALUES (?, ?, ?)", (user_id, pack_type, now_iso()))
-
-async def adjust_wallet(db, user_id: int, delta: int):
-    await db.execute("UPDATE users SET wallet = wallet + ? WHERE user_id = ?", (delta, user_id))
-
-async def set_last_daily(db, user_id: int):
-    await db.execute("UPDATE users SET last_daily = ? WHERE user_id = ?", (now_iso(), user_id))
-
-async def add_profit(db, user_id: int, delta: int):
-    await db.execute("UPDATE users SET lifetime_profit = lifetime_profit + ? WHERE user_id = ?", (delta, user_id))
-
-async def get_wallet(db, user_id: int) -> int:
-    async with db.execute("SELECT wallet FROM users WHERE user_id = ?", (user_id,)) as c:
-        row = await c.fetchone()
-        return int(row[0]) if row else 0
-
-async def get_card_ids_by_rarity(db, rarity: str, include_halloween: bool = True) -> List[int]:
-    db.row_factory = aiosqlite.Row
-    if include_halloween:
-        q = "SELECT card_id FROM cards WHERE rarity = ?"
-        args = (rarity,)
+async def owned_pack_counts(db, user_id: int, pack_type: Optional[str] = None) -> List[Tuple[str, int]]:
+    # (pack_type, quantity) in opening order.
+    if pack_type:
+        q = "SELECT pack_type, quantity FROM owned_packs WHERE user_id = ? AND pack_type = ? AND quantity > 0"
+        args = (user_id, pack_type)
     else:
-        q = "SELECT card_id FROM cards WHERE rarity = ? AND collection != 'Halloween'"
-        args = (rarity,)
+        q = "SELECT pack_type, quantity FROM owned_packs WHERE user_id = ? AND quantity > 0 ORDER BY ord ASC"
+        args = (user_id,)
     async with db.execute(q, args) as c:
-        rows = await c.fetchall()
-        return [r["card_id"] for r in rows]
+        return [(r[0], r[1]) for r in await c.fetchall()]
 
-async def count_rare_or_better(db, user_id: int) -> int:
-    db.row_factory = aiosqlite.Row
-    q = """
-    SELECT COUNT(*)
-    FROM inventory inv
-    JOIN cards c ON c.card_id = inv.card_id
-    WHERE inv.user_id = ? AND (c.rarity IN ('Rare', 'Epic', 'Legendary'))
-    """
-    async with db.execute(q, (user_id,)) as c:
+async def take_owned_packs(db, user_id: int, pack_type: str, qty: int) -> bool:
+    cur = await db.execute(
+        "UPDATE owned_packs SET quantity = quantity - ? WHERE user_id = ? AND pack_type = ? AND quantity >= ?",
+        (qty, user_id, pack_type, qty),
+    )
+    if cur.rowcount == 0:
+        return False
+    await db.execute("DELETE FROM owned_packs WHERE user_id = ? AND pack_type = ? AND quantity <= 0", (user_id, pack_type))
+    profile_cache.invalidate(user_id)
+    return True
+
+async def consume_owned_packs(db, user_id: int, counts: Dict[str, int]) -> bool:
+    # All or nothing: False, with nothing taken, if any type is short.
+    taken: List[Tuple[str, int]] = []
+    for ptype, n in counts.items():
+        cur = await db.execute(
+            "UPDATE owned_packs SET quantity = quantity - ? WHERE user_id = ? AND pack_type = ? AND quantity >= ?",
+            (n, user_id, ptype, n),
+        )
+        if cur.rowcount != 1:
+            # A concurrent open may already have deleted an emptied row, so give back rather than re-increment.
+            for done, k in taken:
+                await give_owned_pack(db, user_id, done, k)
+            return False
+        taken.append((ptype, n))
+    await db.execute("DELETE FROM owned_packs WHERE user_id = ? AND quantity <= 0", (user_id,))
+    profile_cache.invalidate(user_id)
+    return True
+
+async def give_owned_pack(db, user_id: int, pack_type: str, qty: int = 1):
+    await db.execute(
+        """INSERT INTO owned_packs (user_id, pack_type, quantity, ord, created_at)
+           VALUES (?, ?, ?, (SELECT COALESCE(MAX(ord), 0) + 1 FROM owned_packs WHERE user_id = ?), ?)
+           ON CONFLICT(user_id, pack_type) DO UPDATE SET quantity = quantity + excluded.quantity""",
+        (user_id, pack_type, qty, user_id, now_iso()),
+    )
+    profile_cache.invalidate(user_id)
+
+async def adjust_wallet(db, user_id: int, delta: int, profit: int = 0):
+    await db.execute(
+        "UPDATE users SET wallet = wallet + ?, shop_value = shop_value + ?, lifetime_profit = lifetime_profit + ? WHERE user_id = ?",
+        (delta, delta, profit, user_id),
+    )
+    profile_cache.invalidate(user_id)
+
+async def debit_wallet(db, user_id: int, amount: int) -> Optional[int]:
+    # Takes `amount` only if the wallet covers it; the new balance, or None.
+    async with db.execute(
+        "UPDATE users SET wallet = wallet - ?, shop_value = shop_value - ? WHERE user_id = ? AND wallet >= ? RETURNING wallet",
+        (amount, amount, user_id, amount),
+    ) as c:
         row = await c.fetchone()
-        return row[0] if row else 0
+    if not row:
+        return None
+    profile_cache.invalidate(user_id)
+    return row[0]
+
+def shelf_cost(shelves: int, amount: int) -> int:
+    return SHELF_PRICE * (amount * shelves + amount * (amount + 1) // 2)
+
+async def buy_shelves(db, user_id: int, amount: int) -> Optional[Tuple[int, int]]:
+    # Prices against the stored shelf count in the same statement; (cost, wallet) or None.
+    async with db.execute(
+        """UPDATE users SET wallet = wallet - :price * (:n * shelves + :tri),
+                            shop_value = shop_value - :price * (:n * shelves + :tri) + :n * :value,
+                            shelves = shelves + :n, inventory_capacity = inventory_capacity + :n * :cap
+           WHERE user_id = :uid AND wallet >= :price * (:n * shelves + :tri)
+           RETURNING shelves, wallet""",
+        {"price": SHELF_PRICE, "n": amount, "tri": amount * (amount + 1) // 2, "value": SHELF_VALUE, "cap": SHELF_CAPACITY, "uid": user_id},
+    ) as c:
+        row = await c.fetchone()
+    if not row:
+        return None
+    profile_cache.invalidate(user_id)
+    return shelf_cost(row[0] - amount, amount), row[1]
+
+def upgrade_capacity(level: int) -> int:
+    return 50 + 10 * level
+
+async def upgrade_shop(db, user_id: int) -> Optional[int]:
+    # Charges UPGRADE_PRICE * current level; the new level, or None.
+    async with db.execute(
+        """UPDATE users SET wallet = wallet - :price * shop_level,
+                            shop_value = shop_value - :price * shop_level + :value,
+                            shop_level = shop_level + 1
+           WHERE user_id = :uid AND wallet >= :price * shop_level
+           RETURNING shop_level""",
+        {"price": UPGRADE_PRICE, "value": SHOP_LEVEL_VALUE, "uid": user_id},
+    ) as c:
+        row = await c.fetchone()
+    if not row:
+        return None
+    await db.execute("UPDATE users SET inventory_capacity = inventory_capacity + ? WHERE user_id = ?", (upgrade_capacity(row[0] - 1), user_id))
+    profile_cache.invalidate(user_id)
+    return row[0]
 
 async def compute_shop_value(db, user_id: int) -> int:
-    wallet = await get_wallet(db, user_id)
-    db.row_factory = aiosqlite.Row
+    async with db.execute("SELECT shop_value FROM users WHERE user_id = ?", (user_id,)) as c:
+        row = await c.fetchone()
+        return int(row[0]) if row else 0
+
+async def recompute_shop_values(db, user_id: Optional[int] = None) -> None:
     q = """
-    SELECT SUM(c.base_value) FROM inventory inv
-    JOIN cards c ON c.card_id = inv.card_id
-    WHERE inv.user_id = ?
+    UPDATE users SET shop_value = wallet + shop_level * ? + shelves * ? + COALESCE((
+        SELECT SUM(c.base_value) FROM inventory inv
+        JOIN cards c ON c.card_id = inv.card_id
+        WHERE inv.user_id = users.user_id), 0)
     """
-    async with db.execute(q, (user_id,)) as c:
-        inv_val_row = await c.fetchone()
-        inv_val = int(inv_val_row[0]) if inv_val_row and inv_val_row[0] else 0
-
-    async with db.execute("SELECT shop_level, shelves FROM users WHERE user_id = ?", (user_id,)) as c:
+    if user_id is None:
+        await db.execute(q, (SHOP_LEVEL_VALUE, SHELF_VALUE))
+        profile_cache.clear()
+    else:
+        await db.execute(q + " WHERE user_id = ?", (SHOP_LEVEL_VALUE, SHELF_VALUE, user_id))
+        profile_cache.invalidate(user_id)
+
+async def top_shop_values(db, limit: int = 10) -> List[Tuple[int, int]]:
+    async with db.execute("SELECT user_id, shop_value FROM users ORDER BY shop_value DESC, user_id LIMIT ?", (limit,)) as c:
+        return [(r[0], r[1]) for r in await c.fetchall()]
+
+async def shop_value_rank(db, user_id: int) -> Optional[Tuple[int, int]]:
+    async with db.execute(
+        "SELECT u.shop_value, (SELECT COUNT(*) FROM users o WHERE o.shop_value > u.shop_value) + 1 FROM users u WHERE u.user_id = ?",
+        (user_id,),
+    ) as c:
         row = await c.fetchone()
-        level = row[0] if row else 1
-        shelves = row[1] if row else 0
-
-    upgrade_value = level * 200 + shelves * 150
-    return wallet + inv_val + upgrade_value
+        return (row[1], row[0]) if row else None
 
 async def get_store_stock(db, user_id: int) -> Dict[str, int]:
     db.row_factory = aiosqlite.Row
@@ -457,80 +1039,1775 @@ async def get_store_stock(db, user_id: int) -> Dict[str, int]:
         return {r["pack_type"]: r["quantity"] for r in rows}
 
 async def change_store_stock(db, user_id: int, pack_type: str, delta_qty: int):
-    current = 0
+    await db.execute(
+        """INSERT INTO store_stock (user_id, pack_type, quantity) VALUES (?, ?, MAX(0, ?))
+           ON CONFLICT(user_id, pack_type) DO UPDATE SET quantity = MAX(0, quantity + ?)""",
+        (user_id, pack_type, delta_qty, delta_qty),
+    )
+    profile_cache.invalidate(user_id)
+
+async def take_store_stock(db, user_id: int, pack_type: str, qty: int) -> bool:
+    cur = await db.execute(
+        "UPDATE store_stock SET quantity = quantity - ? WHERE user_id = ? AND pack_type = ? AND quantity >= ?",
+        (qty, user_id, pack_type, qty),
+    )
+    if cur.rowcount == 0:
+        return False
+    profile_cache.invalidate(user_id)
+    return True
+
+async def claim_listing(db, listing_id: int, qty: int = 1) -> bool:
+    # Marks a card listing sold, or takes qty from a pack listing; False if it is no longer available.
+    cur = await db.execute(
+        """UPDATE marketplace SET quantity = quantity - :q,
+                                  status = CASE WHEN item_type = 'card' OR quantity = :q THEN 'sold' ELSE status END
+           WHERE listing_id = :lid AND status = 'active' AND (item_type = 'card' OR quantity >= :q)""",
+        {"q": qty, "lid": listing_id},
+    )
+    if cur.rowcount == 0:
+        return False
+    order_book.take(listing_id, qty)
+    return True
+
+async def withdraw_listing(db, listing_id: int, seller_id: int) -> bool:
+    cur = await db.execute(
+        "UPDATE marketplace SET status = 'removed' WHERE listing_id = ? AND seller_id = ? AND status = 'active'",
+        (listing_id, seller_id),
+    )
+    if cur.rowcount == 0:
+        return False
+    order_book.remove(listing_id)
+    return True
+
+async def create_listing(
+    db,
+    seller_id: int,
+    price: int,
+    inventory_id: Optional[str] = None,
+    card_id: Optional[int] = None,
+    pack_type: Optional[str] = None,
+    quantity: Optional[int] = None,
+) -> int:
     db.row_factory = aiosqlite.Row
-    async with db.execute("SELECT quantity FROM store_stock WHERE user_id = ? AND pack_type = ?", (user_id, pack_type)) as c:
+    async with db.execute(
+        """INSERT INTO marketplace (seller_id, item_type, inventory_id, card_id, pack_type, quantity, price, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING *""",
+        (seller_id, "card" if inventory_id else "pack", inventory_id, card_id, pack_type, quantity, price, now_iso()),
+    ) as c:
         row = await c.fetchone()
-        if row:
-            current = int(row[0])
-    new_q = current + delta_qty
-    if new_q < 0:
-        new_q = 0
-    await db.execute(
-        "INSERT INTO store_stock (user_id, pack_type, quantity) VALUES (?, ?, ?) ON CONFLICT(user_id, pack_type) DO UPDATE SET quantity = excluded.quantity",
-        (user_id, pack_type, new_q),
+    order_book.put(row)
+    return row["listing_id"]
+
+class CardCatalog:
+    # Snapshot of the static `cards` table, loaded once. Rolls and /packinfo
+    # read from here instead of querying. seed_catalog is the only writer of
+    # `cards` and invalidates it; edit CARD_POOL rather than the table.
+    def __init__(self):
+        self.cards: Dict[int, aiosqlite.Row] = {}
+        self.by_rarity: Dict[Tuple[str, bool], array] = {}
+        self.collection_masks: Dict[str, int] = {}
+        self.loaded = False
+
+    async def load(self, db) -> None:
+        db.row_factory = aiosqlite.Row
+        async with db.execute("SELECT * FROM cards ORDER BY card_id") as c:
+            rows = await c.fetchall()
+        cards = {}
+        by_rarity: Dict[Tuple[str, bool], array] = {}
+        masks: Dict[str, int] = {}
+        for row in rows:
+            cards[row["card_id"]] = row
+            masks[row["collection"]] = masks.get(row["collection"], 0) | (1 << row["card_id"])
+            by_rarity.setdefault((row["rarity"], True), array("l")).append(row["card_id"])
+            if row["collection"] != "Halloween":
+                by_rarity.setdefault((row["rarity"], False), array("l")).append(row["card_id"])
+        self.cards = cards
+        self.by_rarity = by_rarity
+        self.collection_masks = masks
+        self.loaded = True
+
+    def invalidate(self) -> None:
+        self.loaded = False
+
+    def get(self, card_id: int) -> Optional[aiosqlite.Row]:
+        return self.cards.get(card_id)
+
+    def ids(self, rarity: str, include_halloween: bool = True) -> array:
+        return self.by_rarity.get((rarity, include_halloween), array("l"))
+
+    def sample_names(self, rarity: str, include_halloween: bool = True, limit: int = 5) -> List[str]:
+        return [self.cards[cid]["name"] for cid in self.ids(rarity, include_halloween)[:limit]]
+
+    # Owned-card sets are int bitsets with bit `card_id` set for each card owned.
+    def progress(self, owned: int) -> List[Tuple[str, int, int]]:
+        return [(coll, (owned & mask).bit_count(), mask.bit_count()) for coll, mask in self.collection_masks.items()]
+
+    def missing(self, owned: int, collection: str) -> List[aiosqlite.Row]:
+        mask = self.collection_masks.get(collection, 0) & ~owned
+        return [row for cid, row in self.cards.items() if mask >> cid & 1]
+
+card_catalog = CardCatalog()
+
+class UserCardIndex:
+    __slots__ = ("ids", "cards", "by_card", "owned")
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.cards: Dict[str, int] = {}
+        self.by_card: Dict[int, List[str]] = {}
+        self.owned = 0
+
+    def add(self, inventory_id: str, card_id: int) -> None:
+        if inventory_id in self.cards:
+            return
+        bisect.insort(self.ids, inventory_id)
+        self.cards[inventory_id] = card_id
+        self.by_card.setdefault(card_id, []).append(inventory_id)
+        self.owned |= 1 << card_id
+
+    def remove(self, inventory_id: str) -> None:
+        card_id = self.cards.pop(inventory_id, None)
+        if card_id is None:
+            return
+        del self.ids[bisect.bisect_left(self.ids, inventory_id)]
+        inv_ids = self.by_card[card_id]
+        inv_ids.remove(inventory_id)
+        if not inv_ids:
+            del self.by_card[card_id]
+            self.owned &= ~(1 << card_id)
+
+    def id_prefix(self, prefix: str) -> List[str]:
+        lo = bisect.bisect_left(self.ids, prefix)
+        hi = bisect.bisect_left(self.ids, prefix + "\uffff")
+        return self.ids[lo:hi]
+
+class InventorySearchIndex:
+    # Per-user inventory index for autocomplete, ID entry and collection
+    # progress, kept for the SEARCH_INDEX_USERS most recently used players. The inventory mutation
+    # helpers update loaded users in place. Loads use a reader unless the
+    # user has writes still waiting to commit (ProfileCache's dirty set), in
+    # which case they go through the writer; either way, mutations that land
+    # while a load is in flight are replayed onto it.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.users: "OrderedDict[int, UserCardIndex]" = OrderedDict()
+        self.readers: Optional["ReaderPool"] = None
+        self._loading: Dict[int, List[Tuple[str, str, int]]] = {}
+        self._stale: set = set()
+
+    @contextlib.asynccontextmanager
+    async def _source(self, db, user_id: int):
+        if self.readers is None or profile_cache.is_dirty(user_id):
+            yield db
+            return
+        async with self.readers.acquire() as rdb:
+            yield rdb
+
+    async def get(self, db, user_id: int) -> UserCardIndex:
+        idx = self.users.get(user_id)
+        if idx is not None:
+            self.users.move_to_end(user_id)
+            return idx
+        self._loading.setdefault(user_id, [])
+        try:
+            async with self._source(db, user_id) as src:
+                async with src.execute("SELECT inventory_id, card_id FROM inventory WHERE user_id = ?", (user_id,)) as c:
+                    rows = await c.fetchall()
+        finally:
+            pending = self._loading.pop(user_id, [])
+        stale = user_id in self._stale
+        self._stale.discard(user_id)
+        idx = UserCardIndex()
+        for r in rows:
+            idx.add(r[0], r[1])
+        for op, inv_id, card_id in pending:
+            if op == "add":
+                idx.add(inv_id, card_id)
+            else:
+                idx.remove(inv_id)
+        if stale:
+            return idx
+        self.users[user_id] = idx
+        while len(self.users) > self.capacity:
+            self.users.popitem(last=False)
+        return idx
+
+    def added(self, user_id: int, items: List[Tuple[str, int]]) -> None:
+        cache_bus.publish("inventory", user_id)
+        idx = self.users.get(user_id)
+        pending = self._loading.get(user_id)
+        for inv_id, card_id in items:
+            if idx is not None:
+                idx.add(inv_id, card_id)
+            if pending is not None:
+                pending.append(("add", inv_id, card_id))
+
+    def removed(self, user_id: int, inventory_ids: List[str]) -> None:
+        cache_bus.publish("inventory", user_id)
+        idx = self.users.get(user_id)
+        pending = self._loading.get(user_id)
+        for inv_id in inventory_ids:
+            if idx is not None:
+                idx.remove(inv_id)
+            if pending is not None:
+                pending.append(("remove", inv_id, 0))
+
+    def forget(self, *user_ids: int) -> None:
+        # Another cluster process changed these inventories: drop them, and
+        # don't install loads that are already in flight.
+        for uid in user_ids:
+            self.users.pop(uid, None)
+            if uid in self._loading:
+                self._stale.add(uid)
+
+    async def search(self, db, user_id: int, query: str, limit: int = 20) -> List[Tuple[str, aiosqlite.Row]]:
+        idx = await self.get(db, user_id)
+        q_id = query.strip().upper()
+        q_name = query.strip().lower()
+        out: List[str] = []
+        seen = set()
+
+        def take(inv_ids) -> bool:
+            for inv_id in inv_ids:
+                if inv_id not in seen:
+                    seen.add(inv_id)
+                    out.append(inv_id)
+                    if len(out) >= limit:
+                        return True
+            return False
+
+        if not take(idx.id_prefix(q_id)):
+            names = [(card_catalog.cards[cid]["name"].lower(), inv_ids) for cid, inv_ids in idx.by_card.items() if cid in card_catalog.cards]
+            if not any(take(inv_ids) for nm, inv_ids in names if nm.startswith(q_name)):
+                if not any(take(inv_ids) for nm, inv_ids in names if q_name in nm):
+                    take(i for i in idx.ids if q_id in i)
+        return [(inv_id, card_catalog.cards.get(idx.cards[inv_id])) for inv_id in out]
+
+    async def resolve(self, db, user_id: int, token: str) -> str:
+        # Exact ID, a pre-migration ID, or a unique ID prefix or suffix of at
+        # least 4 characters; otherwise the token unchanged. IDs issued close
+        # together share a prefix, so the suffix is usually what people type.
+        idx = await self.get(db, user_id)
+        token = token.strip().upper()
+        matches = idx.id_prefix(token)
+        if token in matches:
+            return token
+        async with self._source(db, user_id) as src:
+            async with src.execute("SELECT inventory_id FROM inventory_aliases WHERE old_id = ?", (token,)) as c:
+                row = await c.fetchone()
+        if row and row[0] in idx.cards:
+            return row[0]
+        if len(token) >= 4 and len(matches) == 1:
+            return matches[0]
+        if len(token) >= 4:
+            matches = [inv_id for inv_id in idx.ids if inv_id.endswith(token)]
+            if len(matches) == 1:
+                return matches[0]
+        return token
+
+inventory_search = InventorySearchIndex(SEARCH_INDEX_USERS)
+
+class ProfileSnapshot:
+    # Everything /profile and the command guards read for one player.
+    # Indexing by column name keeps `user["wallet"]` call sites working.
+    __slots__ = (
+        "user_id", "wallet", "shop_level", "shelves", "inventory_capacity", "lifetime_profit",
+        "created_at", "last_daily", "shop_value", "packs", "rare_count", "inventory_count", "stock",
     )
 
-def choose_rarity(drops: Dict[str, int]) -> str:
-    rarities = list(drops.keys())
-    weights = [drops[r] for r in rarities]
-    return random.choices(rarities, weights=weights, k=1)[0]
+    def __init__(self, row):
+        for name in self.__slots__[:-1]:
+            setattr(self, name, row[name])
+        self.stock: Dict[str, int] = json.loads(row["stock"]) if row["stock"] else {}
+
+    def __getitem__(self, name: str):
+        return getattr(self, name)
+
+PROFILE_SQL = """
+SELECT u.user_id, u.wallet, u.shop_level, u.shelves, u.inventory_capacity, u.lifetime_profit,
+       u.created_at, u.last_daily, u.shop_value,
+       (SELECT COALESCE(SUM(quantity), 0) FROM owned_packs WHERE user_id = u.user_id) AS packs,
+       (SELECT COUNT(*) FROM inventory inv JOIN cards c ON c.card_id = inv.card_id
+         WHERE inv.user_id = u.user_id AND c.rarity IN ('Rare', 'Epic', 'Legendary')) AS rare_count,
+       (SELECT COUNT(*) FROM inventory WHERE user_id = u.user_id) AS inventory_count,
+       (SELECT json_group_object(pack_type, quantity) FROM store_stock WHERE user_id = u.user_id) AS stock
+FROM users u WHERE u.user_id = ?
+"""
+
+async def load_profile(db, user_id: int) -> Optional[ProfileSnapshot]:
+    db.row_factory = aiosqlite.Row
+    async with db.execute(PROFILE_SQL, (user_id,)) as c:
+        row = await c.fetchone()
+    return ProfileSnapshot(row) if row else None
+
+class ProfileCache:
+    # LRU of ProfileSnapshots for the PROFILE_CACHE_USERS most recent players.
+    # Snapshots are built from a reader, so they only see committed state: the
+    # mutation helpers call `invalidate`, and until a commit issued after that
+    # write completes the user is "dirty" and is loaded through the writer
+    # without caching. A load that raced with a write to the same user is
+    # discarded rather than installed.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: "OrderedDict[int, ProfileSnapshot]" = OrderedDict()
+        self.seq = 0
+        self.dirty: Dict[int, int] = {}
+        self.changed: "OrderedDict[int, int]" = OrderedDict()
+        self.floor = 0
+        self.all_dirty = 0
+
+    def is_dirty(self, user_id: int) -> bool:
+        return bool(self.all_dirty) or user_id in self.dirty
+
+    def peek(self, user_id: int) -> Optional[ProfileSnapshot]:
+        snap = self.entries.get(user_id)
+        if snap is not None:
+            self.entries.move_to_end(user_id)
+        return snap
+
+    async def load(self, db, user_id: int) -> Optional[ProfileSnapshot]:
+        start = self.seq
+        snap = await load_profile(db, user_id)
+        if snap is not None and start >= self.floor and self.changed.get(user_id, 0) <= start and not self.is_dirty(user_id):
+            self.entries[user_id] = snap
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return snap
+
+    def invalidate(self, *user_ids: int) -> None:
+        cache_bus.publish("profile", *user_ids)
+        self.seq += 1
+        for uid in user_ids:
+            self.entries.pop(uid, None)
+            self.dirty[uid] = self.seq
+            self.changed[uid] = self.seq
+            self.changed.move_to_end(uid)
+        # Forgetting a change record means any load older than it may be stale.
+        while len(self.changed) > self.capacity * 4:
+            _, s = self.changed.popitem(last=False)
+            self.floor = max(self.floor, s)
+
+    def clear(self) -> None:
+        # For bulk rewrites that touch every user.
+        cache_bus.publish("profile_all")
+        self.seq += 1
+        self.entries.clear()
+        self.floor = self.all_dirty = self.seq
+
+    def checkpoint(self) -> int:
+        return self.seq
+
+    def committed(self, mark: int) -> None:
+        if self.all_dirty and self.all_dirty <= mark:
+            self.all_dirty = 0
+        if self.dirty:
+            self.dirty = {uid: s for uid, s in self.dirty.items() if s > mark}
+
+profile_cache = ProfileCache(PROFILE_CACHE_USERS)
+
+class Listing:
+    __slots__ = ("listing_id", "seller_id", "item_type", "inventory_id", "pack_type", "card_id", "quantity", "price", "created_at", "rarity")
+
+    def __init__(self, row):
+        for name in self.__slots__[:-1]:
+            setattr(self, name, row[name])
+        card = card_catalog.get(self.card_id) if self.card_id is not None else None
+        self.rarity: Optional[str] = card["rarity"] if card else None
+
+    @classmethod
+    def from_values(cls, values, rarity: Optional[str]) -> "Listing":
+        # `values` in __slots__ order, without rarity.
+        lst = cls.__new__(cls)
+        (lst.listing_id, lst.seller_id, lst.item_type, lst.inventory_id, lst.pack_type,
+         lst.card_id, lst.quantity, lst.price, lst.created_at) = values
+        lst.rarity = rarity
+        return lst
+
+    def __getitem__(self, name: str):
+        return getattr(self, name)
+
+class OrderBook:
+    # Active marketplace listings, indexed by card, rarity, pack type and
+    # price. The listing helpers update it as they write, so like the
+    # inventory index it follows the writer connection.
+    def __init__(self):
+        self.listings: Dict[int, Listing] = {}
+        self.by_card: Dict[int, set] = {}
+        self.by_rarity: Dict[str, set] = {}
+        self.by_pack: Dict[str, set] = {}
+        self.by_price: List[Tuple[int, int]] = []
+
+    async def load(self, db) -> None:
+        # On the startup path, so it reads plain tuples, fills the indexes in
+        # one flat pass and sorts by_price once rather than going through
+        # _put per row.
+        db.row_factory = None
+        try:
+            async with db.execute(
+                f"SELECT {', '.join(Listing.__slots__[:-1])} FROM marketplace WHERE status = 'active' ORDER BY listing_id"
+            ) as c:
+                rows = await c.fetchall()
+        finally:
+            db.row_factory = aiosqlite.Row
+        self.__init__()
+        rarities = {cid: card["rarity"] for cid, card in card_catalog.cards.items()}
+        listings, by_card, by_rarity, by_pack = self.listings, self.by_card, self.by_rarity, self.by_pack
+        for r in rows:
+            card_id = r[5]
+            rarity = rarities.get(card_id)
+            lst = Listing.from_values(r, rarity)
+            listings[lst.listing_id] = lst
+            if card_id is not None:
+                by_card.setdefault(card_id, set()).add(lst.listing_id)
+            if rarity is not None:
+                by_rarity.setdefault(rarity, set()).add(lst.listing_id)
+            if lst.pack_type is not None:
+                by_pack.setdefault(lst.pack_type, set()).add(lst.listing_id)
+        self.by_price = sorted((lst.price, lid) for lid, lst in listings.items())
+
+    def _keys(self, lst: Listing):
+        for index, key in ((self.by_card, lst.card_id), (self.by_rarity, lst.rarity), (self.by_pack, lst.pack_type)):
+            if key is not None:
+                yield index, key
+
+    def put(self, row) -> Listing:
+        cache_bus.publish("listing", {k: row[k] for k in row.keys()})
+        return self._put(row)
+
+    def _put(self, row) -> Listing:
+        # `listings` is kept in ID order. New listings usually have the
+        # highest ID; one relayed late from another cluster process is
+        # slotted in by re-inserting the few newer ones after it.
+        lst = Listing(row)
+        if lst.listing_id in self.listings:
+            self._drop(lst.listing_id)
+        newer = []
+        for lid in reversed(self.listings):
+            if lid < lst.listing_id:
+                break
+            newer.append(lid)
+        self.listings[lst.listing_id] = lst
+        for lid in reversed(newer):
+            self.listings[lid] = self.listings.pop(lid)
+        for index, key in self._keys(lst):
+            index.setdefault(key, set()).add(lst.listing_id)
+        bisect.insort(self.by_price, (lst.price, lst.listing_id))
+        return lst
+
+    def remove(self, listing_id: int) -> None:
+        cache_bus.publish("listing_left", listing_id, 0)
+        self._drop(listing_id)
+
+    def _drop(self, listing_id: int) -> None:
+        lst = self.listings.pop(listing_id, None)
+        if lst is None:
+            return
+        for index, key in self._keys(lst):
+            ids = index[key]
+            ids.discard(listing_id)
+            if not ids:
+                del index[key]
+        i = bisect.bisect_left(self.by_price, (lst.price, listing_id))
+        if i < len(self.by_price) and self.by_price[i] == (lst.price, listing_id):
+            del self.by_price[i]
+
+    def take(self, listing_id: int, qty: int) -> None:
+        lst = self.listings.get(listing_id)
+        if lst is None:
+            return
+        if lst.item_type == "card" or lst.quantity <= qty:
+            self.remove(listing_id)
+        else:
+            lst.quantity -= qty
+            cache_bus.publish("listing_left", listing_id, lst.quantity)
+
+    def settle(self, listing_id: int, remaining: int) -> None:
+        # Relayed take/remove: the quantity left rather than a delta, so
+        # applying it twice is harmless.
+        lst = self.listings.get(listing_id)
+        if lst is None:
+            return
+        if remaining <= 0:
+            self._drop(listing_id)
+        else:
+            lst.quantity = remaining
+
+    def query(
+        self,
+        item_type: Optional[str] = None,
+        rarity: Optional[str] = None,
+        pack_type: Optional[str] = None,
+        card_ids: Optional[List[int]] = None,
+        max_price: Optional[int] = None,
+        cheapest: bool = False,
+    ) -> List[Listing]:
+        sets = []
+        if rarity:
+            sets.append(self.by_rarity.get(rarity, set()))
+        if pack_type:
+            sets.append(self.by_pack.get(pack_type, set()))
+        if card_ids is not None:
+            sets.append(set().union(*(self.by_card.get(cid, ()) for cid in card_ids)))
+        candidates = set.intersection(*sets) if sets else None
+        if candidates is None and cheapest:
+            end = len(self.by_price) if max_price is None else bisect.bisect_right(self.by_price, (max_price, float("inf")))
+            ids = (lid for _, lid in self.by_price[:end])
+        elif candidates is None:
+            ids = reversed(self.listings)
+        elif cheapest:
+            ids = sorted(candidates, key=lambda lid: (self.listings[lid].price, lid))
+        else:
+            ids = sorted(candidates, reverse=True)
+        out = []
+        for lid in ids:
+            lst = self.listings[lid]
+            if item_type and lst.item_type != item_type:
+                continue
+            if max_price is not None and lst.price > max_price:
+                continue
+            out.append(lst)
+        return out
+
+order_book = OrderBook()
 
-async def roll_pack_cards(db, pack_type: str) -> List[aiosqlite.Row]:
-    pack = await get_pack_def(db, pack_type)
-    if not pack:
-        return []
-    n = random.randint(pack["min_cards"], pack["max_cards"])
+class CacheBus:
+    # In cluster mode each shard process keeps its own profile cache,
+    # inventory indexes and order book. Changes made through one process's
+    # helpers are batched per loop iteration and sent to the storage
+    # service, which relays them to the other processes to `apply`.
+    def __init__(self):
+        self.link: Optional["RemoteConnection"] = None
+        self.pending: List[Tuple[str, tuple]] = []
+        self.applying = False
 
-    results = []
+    def publish(self, kind: str, *args) -> None:
+        if self.link is None or self.applying:
+            return
+        if not self.pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self.pending.append((kind, args))
+
+    def flush(self) -> None:
+        events, self.pending = self.pending, []
+        if events and self.link is not None:
+            self.link.publish(events)
+
+    def apply(self, events: List[Tuple[str, tuple]]) -> None:
+        self.applying = True
+        try:
+            for kind, args in events:
+                if kind == "profile":
+                    profile_cache.invalidate(*args)
+                elif kind == "profile_all":
+                    profile_cache.clear()
+                elif kind == "inventory":
+                    inventory_search.forget(*args)
+                elif kind == "listing":
+                    order_book._put(args[0])
+                elif kind == "listing_left":
+                    order_book.settle(*args)
+        finally:
+            self.applying = False
+
+    def committed(self) -> None:
+        # The storage service committed: every change relayed before this
+        # notice is now visible to this process's readers.
+        profile_cache.committed(profile_cache.checkpoint())
+
+cache_bus = CacheBus()
+
+async def settle_npc_sales(db) -> int:
+    # One set-based pass over every shop whose NPC sales are due: each sells up
+    # to shelves * NPC_SALES_PER_SHELF packs from stock, priciest first, and the
+    # profit accrues in users.pending_sales for /daily to collect.
+    now = datetime.now(timezone.utc)
+    due = (now - DAILY_COOLDOWN).isoformat()
+    await db.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS npc_sales (
+            user_id INTEGER, pack_type TEXT, sold INTEGER, price INTEGER
+        )
+    """)
+    await db.execute("DELETE FROM npc_sales")
+    await db.execute(
+        """
+        INSERT INTO npc_sales (user_id, pack_type, sold, price)
+        WITH ranked AS (
+            SELECT s.user_id, s.pack_type, s.quantity, p.price, u.shelves * ? AS cap,
+                   SUM(s.quantity) OVER (
+                       PARTITION BY s.user_id ORDER BY p.price DESC, s.pack_type
+                       ROWS UNBOUNDED PRECEDING
+                   ) AS cum
+            FROM users u
+            JOIN store_stock s ON s.user_id = u.user_id AND s.quantity > 0
+            JOIN packs p ON p.type = s.pack_type
+            WHERE u.shelves > 0 AND (u.npc_settled_at IS NULL OR u.npc_settled_at <= ?)
+        )
+        SELECT user_id, pack_type, MIN(quantity, cap - (cum - quantity)), price
+        FROM ranked WHERE cum - quantity < cap
+        """,
+        (NPC_SALES_PER_SHELF, due),
+    )
+    await db.execute("""
+        UPDATE store_stock SET quantity = store_stock.quantity - n.sold
+        FROM npc_sales n
+        WHERE store_stock.user_id = n.user_id AND store_stock.pack_type = n.pack_type
+    """)
+    cur = await db.execute(
+        """
+        UPDATE users SET pending_sales = pending_sales + t.profit,
+                         pending_units = pending_units + t.units,
+                         npc_settled_at = ?
+        FROM (
+            SELECT user_id, SUM((price * ? / 100) * sold) AS profit, SUM(sold) AS units
+            FROM npc_sales GROUP BY user_id
+        ) AS t
+        WHERE users.user_id = t.user_id
+        """,
+        (now.isoformat(), NPC_MARGIN_PCT),
+    )
+    async with db.execute("SELECT DISTINCT user_id FROM npc_sales") as c:
+        profile_cache.invalidate(*[r[0] for r in await c.fetchall()])
+    return cur.rowcount
+
+async def collect_daily(db, user_id: int, bonus: int) -> Optional[Tuple[int, int]]:
+    # Pays the bonus plus pending NPC sales; None if the cooldown hasn't passed.
+    async with db.execute("SELECT pending_sales, pending_units FROM users WHERE user_id = ?", (user_id,)) as c:
+        row = await c.fetchone()
+    if not row:
+        return None
+    sales, units = int(row[0]), int(row[1])
+    gain = bonus + sales
+    cur = await db.execute(
+        """UPDATE users SET wallet = wallet + ?, shop_value = shop_value + ?, lifetime_profit = lifetime_profit + ?,
+                            pending_sales = pending_sales - ?, pending_units = pending_units - ?, last_daily = ?
+           WHERE user_id = ? AND (last_daily IS NULL OR last_daily <= ?)""",
+        (gain, gain, gain, sales, units, now_iso(), user_id, (datetime.now(timezone.utc) - DAILY_COOLDOWN).isoformat()),
+    )
+    if cur.rowcount == 0:
+        return None
+    profile_cache.invalidate(user_id)
+    return sales, units
+
+async def roll_many_packs(db, pack_types: List[str]) -> List[List[aiosqlite.Row]]:
+    if not card_catalog.loaded:
+        await card_catalog.load(db)
     include_halloween = is_october()
-    for _ in range(n):
-        rarity = choose_rarity(pack["drops"])
-        ids = await get_card_ids_by_rarity(db, rarity, include_halloween=include_halloween)
-        if not ids:
-            ids = await get_card_ids_by_rarity(db, "Common", include_halloween=True)
-        card_id = random.choice(ids)
-        db.row_factory = aiosqlite.Row
-        async with db.execute("SELECT * FROM cards WHERE card_id = ?", (card_id,)) as c:
-            row = await c.fetchone()
-            results.append(row)
+    fallback = card_catalog.ids("Common", True)
+    results = []
+    for pack_type in pack_types:
+        compiled = await get_compiled_pack(db, pack_type)
+        if not compiled:
+            results.append([])
+            continue
+        n = random.randint(compiled.pack["min_cards"], compiled.pack["max_cards"])
+        cards = []
+        for _ in range(n):
+            ids = card_catalog.ids(compiled.draw_rarity(), include_halloween) or fallback
+            cards.append(card_catalog.cards[random.choice(ids)])
+        results.append(cards)
     return results
 
-class TycoonBot(commands.Bot):
+async def roll_pack_cards(db, pack_type: str) -> List[aiosqlite.Row]:
+    return (await roll_many_packs(db, [pack_type]))[0]
+
+current_command: contextvars.ContextVar[str] = contextvars.ContextVar("current_command", default="-")
+
+class LatencyStat:
+    __slots__ = ("count", "total", "max", "hist")
+    BOUNDS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
     def __init__(self):
-        super().__init__(command_prefix=BOT_PREFIX, intents=INTENTS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = [0] * (len(self.BOUNDS_MS) + 1)
+
+    def add(self, ms: float) -> None:
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.hist[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max, 3),
+            "hist": {(f"<={b}" if i < len(self.BOUNDS_MS) else f">{self.BOUNDS_MS[-1]}"): n
+                     for i, (b, n) in enumerate(zip(self.BOUNDS_MS + (self.BOUNDS_MS[-1],), self.hist)) if n},
+        }
+
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+class QueryStats:
+    # Latency per normalized statement and per calling command, plus the
+    # EXPLAIN QUERY PLAN of every statement that crossed `slow_ms`.
+    def __init__(self, slow_ms: float):
+        self.slow_ms = slow_ms
+        self.by_sql: Dict[str, LatencyStat] = {}
+        self.by_command: Dict[str, LatencyStat] = {}
+        self.plans: Dict[str, List[str]] = {}
+        self.slow: "deque[Dict]" = deque(maxlen=50)
+        self._normalized: Dict[str, str] = {}
+        self.since = now_iso()
+
+    def normalize(self, sql: str) -> str:
+        norm = self._normalized.get(sql)
+        if norm is None:
+            norm = " ".join(_SQL_LITERAL.sub("?", sql).split())
+            norm = _SQL_IN_LIST.sub("(?...)", norm)
+            if len(self._normalized) < 4096:
+                self._normalized[sql] = norm
+        return norm
+
+    def record(self, sql: str, ms: float) -> Tuple[str, bool]:
+        norm = self.normalize(sql)
+        self.by_sql.setdefault(norm, LatencyStat()).add(ms)
+        self.by_command.setdefault(current_command.get(), LatencyStat()).add(ms)
+        return norm, ms >= self.slow_ms
+
+    def reset(self) -> None:
+        self.__init__(self.slow_ms)
+
+    def top(self, n: int = 10, key: str = "total") -> List[Tuple[str, LatencyStat]]:
+        return sorted(self.by_sql.items(), key=lambda kv: getattr(kv[1], key), reverse=True)[:n]
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "since": self.since,
+            "slow_ms": self.slow_ms,
+            "statements": {sql: st.to_dict() for sql, st in self.top(len(self.by_sql))},
+            "commands": {cmd: st.to_dict() for cmd, st in sorted(self.by_command.items(), key=lambda kv: -kv[1].total)},
+            "slow": list(self.slow),
+            "plans": self.plans,
+        }, indent=2)
+
+db_stats = QueryStats(DB_SLOW_MS)
+
+class Histogram:
+    # Cumulative-bucket histogram in the Prometheus exposition format.
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = "") -> List[str]:
+        sep = "," if labels else ""
+        lines = []
+        running = 0
+        for bound, n in zip(self.bounds, self.counts):
+            running += n
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {running}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        wrapped = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{wrapped} {self.sum:.6f}")
+        lines.append(f"{name}_count{wrapped} {self.count}")
+        return lines
+
+class Invocation:
+    __slots__ = ("name", "start", "first_response", "db_ms", "lock_wait_ms", "http_calls", "error")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.first_response: Optional[float] = None
+        self.db_ms = 0.0
+        self.lock_wait_ms = 0.0  # waiting for a reader connection or for COMMIT
+        self.http_calls = 0
+        self.error = False
+
+current_invocation: contextvars.ContextVar[Optional[Invocation]] = contextvars.ContextVar("current_invocation", default=None)
+
+def note_lock_wait(start: float) -> None:
+    inv = current_invocation.get()
+    if inv is not None:
+        inv.lock_wait_ms += (time.perf_counter() - start) * 1000
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+class CommandMetrics:
+    # Per slash command / component callback: wall time, time until Discord
+    # got the first response, DB time and Discord API calls made.
+    SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    CALLS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+    def __init__(self):
+        self.duration: Dict[str, Histogram] = {}
+        self.first_response: Dict[str, Histogram] = {}
+        self.db: Dict[str, Histogram] = {}
+        self.lock_wait: Dict[str, Histogram] = {}
+        self.http: Dict[str, Histogram] = {}
+        self.errors: Dict[str, int] = {}
+        self.http_total = 0
+        self.loop_lag = Histogram((0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+    def start(self, name: str) -> Invocation:
+        inv = Invocation(name)
+        current_invocation.set(inv)
+        current_command.set(name)
+        return inv
+
+    def finish(self, inv: Invocation, error: bool = False) -> None:
+        inv.error = error
+        name = inv.name
+        self.duration.setdefault(name, Histogram(self.SECONDS)).observe(time.perf_counter() - inv.start)
+        if inv.first_response is not None:
+            self.first_response.setdefault(name, Histogram(self.SECONDS)).observe(inv.first_response - inv.start)
+        self.db.setdefault(name, Histogram(self.SECONDS)).observe(inv.db_ms / 1000)
+        self.lock_wait.setdefault(name, Histogram(self.SECONDS)).observe(inv.lock_wait_ms / 1000)
+        self.http.setdefault(name, Histogram(self.CALLS)).observe(inv.http_calls)
+        if error:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for metric, series, help_text in (
+            ("packify_command_duration_seconds", self.duration, "Wall time of a command or component callback."),
+            ("packify_command_first_response_seconds", self.first_response, "Time until the interaction was first acknowledged."),
+            ("packify_command_db_seconds", self.db, "Time spent in database statements per invocation."),
+            ("packify_command_lock_wait_seconds", self.lock_wait, "Time spent waiting for a reader connection or for COMMIT."),
+            ("packify_command_http_calls", self.http, "Discord API requests made per invocation."),
+        ):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+            for name, hist in sorted(series.items()):
+                lines += hist.render(metric, f'command="{_label(name)}"')
+        lines += ["# HELP packify_command_errors_total Invocations that raised.", "# TYPE packify_command_errors_total counter"]
+        lines += [f'packify_command_errors_total{{command="{_label(n)}"}} {c}' for n, c in sorted(self.errors.items())]
+        lines += ["# HELP packify_http_requests_total Discord API requests, including those outside commands.", "# TYPE packify_http_requests_total counter",
+                  f"packify_http_requests_total {self.http_total}"]
+        lines += ["# HELP packify_event_loop_lag_seconds Event loop scheduling delay.", "# TYPE packify_event_loop_lag_seconds histogram"]
+        lines += self.loop_lag.render("packify_event_loop_lag_seconds")
+        return lines
+
+command_metrics = CommandMetrics()
+
+class _FetchedRows:
+    # Cursor stand-in over rows that were fetched in the same worker-thread
+    # call as the execute. A cursor left mid-result on the shared writer
+    # (SELECT or RETURNING) makes any COMMIT issued meanwhile fail with
+    # "SQL statements in progress".
+    def __init__(self, rows):
+        self.rows = rows
+        self.pos = 0
+
+    async def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    async def fetchmany(self, size: int = 1):
+        out = self.rows[self.pos:self.pos + size]
+        self.pos += len(out)
+        return out
+
+    async def fetchall(self):
+        out = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return out
+
+class _TimedResult:
+    # Mirrors aiosqlite's Result: usable with `await` or `async with`.
+    def __init__(self, owner: "InstrumentedConnection", method, sql: str, params, many: bool = False):
+        self.owner = owner
+        self.method = method
+        self.sql = sql
+        self.params = params
+        self.many = many
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def _run(self):
+        start = time.perf_counter()
+        try:
+            cursor = await self.method(self.sql, self.params)
+            # Close on the connection's thread: a cursor freed on the loop
+            # thread resets its (cached, shared) statement there, racing the
+            # worker and failing with "bad parameter or other API misuse".
+            # rowcount and lastrowid stay readable.
+            await cursor.close()
+            return cursor
+        finally:
+            self.owner.record(self.sql, self.params, start, self.many)
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        try:
+            return _FetchedRows(await self.owner.conn.execute_fetchall(self.sql, self.params))
+        finally:
+            self.owner.record(self.sql, self.params, start, self.many)
+
+    async def __aexit__(self, *exc):
+        pass
+
+class InstrumentedConnection:
+    # Wraps an aiosqlite connection and times every statement, including the
+    # fetch when used as `async with db.execute(...)`, which reads all rows in
+    # one call. Anything else is passed through to the connection.
+    def __init__(self, conn: aiosqlite.Connection, stats: QueryStats):
+        object.__setattr__(self, "conn", conn)
+        object.__setattr__(self, "stats", stats)
+        # EXPLAIN tasks still running; the loop itself only keeps weak references.
+        object.__setattr__(self, "explains", set())
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.conn, name, value)
+
+    def execute(self, sql: str, parameters=None) -> _TimedResult:
+        return _TimedResult(self, self.conn.execute, sql, parameters)
+
+    def executemany(self, sql: str, parameters) -> _TimedResult:
+        return _TimedResult(self, self.conn.executemany, sql, parameters, many=True)
+
+    async def commit(self) -> None:
+        start = time.perf_counter()
+        await self.conn.commit()
+        self.record("COMMIT", None, start)
+
+    def record(self, sql: str, params, start: float, many: bool = False) -> None:
+        ms = (time.perf_counter() - start) * 1000
+        norm, slow = self.stats.record(sql, ms)
+        inv = current_invocation.get()
+        if inv is not None:
+            inv.db_ms += ms
+        if not slow:
+            return
+        self.stats.slow.append({"sql": norm, "ms": round(ms, 3), "command": current_command.get(), "at": now_iso()})
+        print(f"Slow query ({ms:.1f} ms, {current_command.get()}): {norm}")
+        if norm not in self.stats.plans and sql != "COMMIT" and not many:
+            self.stats.plans[norm] = []
+            task = asyncio.get_running_loop().create_task(self._explain(norm, sql, params))
+            self.explains.add(task)
+            task.add_done_callback(self._explain_done)
+
+    def _explain_done(self, task: asyncio.Task) -> None:
+        self.explains.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"EXPLAIN task failed: {task.exception()!r}")
+
+    async def _explain(self, norm: str, sql: str, params) -> None:
+        try:
+            # One worker-thread call, so no cursor is left open for a concurrent COMMIT.
+            plan = [r[-1] for r in await self.conn.execute_fetchall("EXPLAIN QUERY PLAN " + sql, params or ())]
+        except Exception as e:
+            plan = [f"unavailable: {e}"]
+        self.stats.plans[norm] = plan
+        print("  plan: " + " | ".join(plan))
+
+class ReaderPool:
+    # Read-only connections for queries that don't need to see the writer's
+    # uncommitted work. With WAL they run alongside the writer instead of
+    # queueing behind it on one connection.
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.fallback: Optional[aiosqlite.Connection] = None
+        self._conns: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    async def open(self, fallback: aiosqlite.Connection) -> None:
+        self.fallback = fallback
+        self._idle = asyncio.Queue()
+        uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        for _ in range(self.size):
+            conn = InstrumentedConnection(await aiosqlite.connect(uri, uri=True), db_stats)
+            conn.row_factory = aiosqlite.Row
+            await conn.execute("PRAGMA query_only = 1")
+            await conn.execute("PRAGMA busy_timeout = 5000")
+            self._conns.append(conn)
+            self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        if not self._conns:
+            yield self.fallback
+            return
+        if self._idle.empty():
+            start = time.perf_counter()
+            conn = await self._idle.get()
+            note_lock_wait(start)
+        else:
+            conn = self._idle.get_nowait()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self) -> None:
+        for conn in self._conns:
+            await conn.close()
+        self._conns = []
+
+class GroupCommitter:
+    # Coalesces commits from concurrent interactions on the shared writer.
+    # Every caller's writes are already in the connection's open transaction,
+    # so one COMMIT (one fsync) per window or per max_ops callers covers them
+    # all; each caller returns only once a commit issued after its writes
+    # has completed. window_ms <= 0 commits immediately.
+    def __init__(self, window_ms: float, max_ops: int):
+        self.window = window_ms / 1000
+        self.max_ops = max(1, max_ops)
+        self._waiters: List[asyncio.Future] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set = set()
+        self._lock = asyncio.Lock()
         self.db: Optional[aiosqlite.Connection] = None
 
-    async def setup_hook(self) -> None:
+    async def commit(self, db: aiosqlite.Connection) -> None:
+        if self.window <= 0:
+            await db.commit()
+            return
+        self.db = db
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        if len(self._waiters) >= self.max_ops:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._start_flush)
+        await fut
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        waiters, self._waiters = self._waiters, []
+        if not waiters:
+            return
+        task = asyncio.create_task(self._flush(waiters))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, waiters: List[asyncio.Future]) -> None:
+        async with self._lock:
+            try:
+                await self.db.commit()
+            except Exception as e:
+                for w in waiters:
+                    if not w.done():
+                        w.set_exception(e)
+                return
+        for w in waiters:
+            if not w.done():
+                w.set_result(None)
+
+    async def drain(self) -> None:
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+# Cluster RPC between shard processes and the storage service: a 9-byte
+# header (payload length, call id, op) followed by a marshal payload. The
+# socket file is created owner-only since marshal data is trusted.
+RPC_HEADER = struct.Struct("!IIB")
+RPC_EXECUTE, RPC_EXECUTEMANY, RPC_COMMIT, RPC_ROLLBACK, RPC_IDENTIFY, RPC_PUBLISH = range(1, 7)
+RPC_REPLY, RPC_ERROR, RPC_EVENT, RPC_COMMITTED = range(7, 11)
+IDENTIFY_INTERVAL = 5.0  # Discord allows one IDENTIFY per 5 s per concurrency bucket
+
+def rpc_frame(op: int, call_id: int, body: bytes = b"") -> bytes:
+    return RPC_HEADER.pack(len(body), call_id, op) + body
+
+def rpc_error(payload) -> Exception:
+    name, message = payload
+    cls = getattr(sqlite3, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, sqlite3.Error)):
+        cls = sqlite3.Error
+    return cls(message)
+
+_row_classes: Dict[Tuple[str, ...], type] = {}
+
+def remote_row_class(columns: Tuple[str, ...]) -> type:
+    # Tuple rows that also index by column name, like sqlite3.Row.
+    cls = _row_classes.get(columns)
+    if cls is None:
+        index = {name: i for i, name in enumerate(columns)}
+
+        def __getitem__(self, key, _get=tuple.__getitem__):
+            return _get(self, index[key] if isinstance(key, str) else key)
+
+        cls = type("RemoteRow", (tuple,), {"__slots__": (), "__getitem__": __getitem__, "keys": lambda self: list(columns)})
+        _row_classes[columns] = cls
+    return cls
+
+class _RemoteCursor(_FetchedRows):
+    def __init__(self, rows, rowcount: int, lastrowid: Optional[int]):
+        super().__init__(rows)
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    async def close(self) -> None:
+        pass
+
+class RemoteConnection:
+    # Stands in for the writer's aiosqlite connection in a cluster shard
+    # process: statements run on the storage service, rows are fetched in the
+    # same call. Also carries cache events both ways (see CacheBus); events
+    # that arrive before `release` are held, so startup loads aren't undone.
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.row_factory = None
+        self.calls: Dict[int, asyncio.Future] = {}
+        self.call_id = 0
+        self.held: Optional[List[Tuple[int, bytes]]] = []
+        self.closed = False
+        self.pump = asyncio.create_task(self._read_loop())
+
+    @classmethod
+    async def open(cls, path: str, attempts: int = 50) -> "RemoteConnection":
+        for attempt in range(attempts):
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+                return cls(reader, writer)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def _call(self, op: int, payload=None):
+        if self.closed:
+            raise ConnectionError("storage service connection closed")
+        self.call_id = self.call_id % 0xFFFFFFFF + 1
+        fut = asyncio.get_running_loop().create_future()
+        self.calls[self.call_id] = fut
+        self.writer.write(rpc_frame(op, self.call_id, marshal.dumps(payload)))
+        await self.writer.drain()
+        return await fut
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                length, call_id, op = RPC_HEADER.unpack(await self.reader.readexactly(RPC_HEADER.size))
+                body = await self.reader.readexactly(length)
+                if op in (RPC_EVENT, RPC_COMMITTED):
+                    if self.held is not None:
+                        self.held.append((op, body))
+                    else:
+                        self._event(op, body)
+                    continue
+                fut = self.calls.pop(call_id, None)
+                if fut is None or fut.done():
+                    continue
+                if op == RPC_ERROR:
+                    fut.set_exception(rpc_error(marshal.loads(body)))
+                else:
+                    fut.set_result(marshal.loads(body))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            if not self.closed:
+                print(f"Storage service connection lost: {e!r}")
+        finally:
+            self.closed = True
+            for fut in self.calls.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("storage service connection lost"))
+            self.calls.clear()
+
+    def _event(self, op: int, body: bytes) -> None:
+        if op == RPC_COMMITTED:
+            cache_bus.committed()
+        else:
+            cache_bus.apply(marshal.loads(body))
+
+    def release(self) -> None:
+        held, self.held = self.held or [], None
+        for op, body in held:
+            self._event(op, body)
+
+    def publish(self, events: List[Tuple[str, tuple]]) -> None:
+        if not self.closed:
+            self.writer.write(rpc_frame(RPC_PUBLISH, 0, marshal.dumps(events)))
+
+    def _cursor(self, result) -> _RemoteCursor:
+        rowcount, lastrowid, columns, rows = result
+        if columns and self.row_factory is not None:
+            cls = remote_row_class(columns)
+            rows = [cls(r) for r in rows]
+        return _RemoteCursor(rows, rowcount, lastrowid)
+
+    async def execute(self, sql: str, parameters=None) -> _RemoteCursor:
+        if parameters is not None and not isinstance(parameters, (tuple, dict)):
+            parameters = tuple(parameters)
+        return self._cursor(await self._call(RPC_EXECUTE, (sql, parameters)))
+
+    async def executemany(self, sql: str, parameters) -> _RemoteCursor:
+        return self._cursor(await self._call(RPC_EXECUTEMANY, (sql, [p if isinstance(p, (tuple, dict)) else tuple(p) for p in parameters])))
+
+    async def execute_fetchall(self, sql: str, parameters=None):
+        return (await self.execute(sql, parameters)).rows
+
+    async def commit(self) -> None:
+        await self._call(RPC_COMMIT)
+
+    async def rollback(self) -> None:
+        await self._call(RPC_ROLLBACK)
+
+    async def identify(self, shard_id: int) -> None:
+        await self._call(RPC_IDENTIFY, shard_id)
+
+    async def close(self) -> None:
+        self.closed = True
+        if cache_bus.link is self:
+            cache_bus.link = None
+        self.writer.close()
+        with contextlib.suppress(Exception):
+            await self.writer.wait_closed()
+        self.pump.cancel()
+
+class StorageService:
+    # The cluster's only writer. Statements from every shard process run one
+    # at a time, in arrival order, on one sqlite3 connection in a worker
+    # thread; each returns its rows from that same call, so no cursor is left
+    # open across a COMMIT. Commits are coalesced across processes like
+    # GroupCommitter does within one, and each one is announced to every
+    # process (see CacheBus.committed). Cache events are relayed as-is.
+    def __init__(self, path: str, socket_path: str):
+        self.path = path
+        self.socket_path = socket_path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.worker = ThreadPoolExecutor(1, thread_name_prefix="storage")
+        self.committer = GroupCommitter(DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX)
+        self.clients: set = set()
+        self.outbox: Dict[asyncio.StreamWriter, List[bytes]] = {}
+        self.tasks: set = set()
+        self.identify_at: Dict[int, float] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
         await setup_db()
-        self.db = await aiosqlite.connect(DB_PATH)
-        self.db.row_factory = aiosqlite.Row
+        self.conn = await self._run(self._connect)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+        old_umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self._serve, self.socket_path)
+        finally:
+            os.umask(old_umask)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        return conn
+
+    def _run(self, fn, *args) -> asyncio.Future:
+        return asyncio.get_running_loop().run_in_executor(self.worker, fn, *args)
+
+    def _execute(self, sql: str, params, many: bool) -> Tuple[bytes, float]:
+        start = time.perf_counter()
+        cur = self.conn.executemany(sql, params) if many else self.conn.execute(sql, params or ())
+        rows = cur.fetchall()
+        columns = tuple(d[0] for d in cur.description) if cur.description else None
+        ms = (time.perf_counter() - start) * 1000
+        return marshal.dumps((cur.rowcount, cur.lastrowid, columns, rows)), ms
+
+    async def commit(self) -> None:
+        await self._run(self.conn.commit)
+        # Sent before any reply to a later statement, so a shard that sees
+        # this notice has seen every change relayed ahead of it committed.
+        self._broadcast(rpc_frame(RPC_COMMITTED, 0))
+
+    async def identify(self, shard_id: int) -> None:
+        bucket = shard_id % max(1, IDENTIFY_CONCURRENCY)
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.identify_at.get(bucket, 0.0))
+        self.identify_at[bucket] = slot + IDENTIFY_INTERVAL
+        await asyncio.sleep(slot - now)
+
+    def _write(self, writer: asyncio.StreamWriter, frame: bytes) -> None:
+        # Frames go out once per loop iteration, one write per client,
+        # in the order they were queued.
+        if writer.is_closing():
+            return
+        if not self.outbox:
+            asyncio.get_running_loop().call_soon(self._flush)
+        self.outbox.setdefault(writer, []).append(frame)
+
+    def _flush(self) -> None:
+        outbox, self.outbox = self.outbox, {}
+        for writer, frames in outbox.items():
+            if not writer.is_closing():
+                writer.write(b"".join(frames))
+
+    def _broadcast(self, frame: bytes, skip=None) -> None:
+        for writer in self.clients:
+            if writer is not skip:
+                self._write(writer, frame)
+
+    def _send(self, writer: asyncio.StreamWriter, call_id: int, op: int, body: bytes) -> None:
+        self._write(writer, rpc_frame(op, call_id, body))
+
+    def _reply(self, writer: asyncio.StreamWriter, call_id: int, sql: Optional[str], fut: asyncio.Future) -> None:
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        if exc is not None:
+            self._send(writer, call_id, RPC_ERROR, marshal.dumps((type(exc).__name__, str(exc))))
+            return
+        result = fut.result()
+        if sql is None:
+            self._send(writer, call_id, RPC_REPLY, marshal.dumps(None))
+            return
+        body, ms = result
+        self._send(writer, call_id, RPC_REPLY, body)
+        norm, slow = db_stats.record(sql, ms)
+        if slow:
+            print(f"Slow query ({ms:.1f} ms, storage): {norm}")
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.clients.add(writer)
+        try:
+            while True:
+                length, call_id, op = RPC_HEADER.unpack(await reader.readexactly(RPC_HEADER.size))
+                body = await reader.readexactly(length)
+                if op == RPC_PUBLISH:
+                    self._broadcast(rpc_frame(RPC_EVENT, 0, body), skip=writer)
+                    continue
+                payload = marshal.loads(body)
+                sql = None
+                if op in (RPC_EXECUTE, RPC_EXECUTEMANY):
+                    # Submitted to the worker here, so statements keep arrival order.
+                    sql = payload[0]
+                    fut = self._run(self._execute, payload[0], payload[1], op == RPC_EXECUTEMANY)
+                elif op == RPC_COMMIT:
+                    fut = asyncio.ensure_future(self.committer.commit(self))
+                elif op == RPC_ROLLBACK:
+                    fut = self._run(self.conn.rollback)
+                elif op == RPC_IDENTIFY:
+                    fut = asyncio.ensure_future(self.identify(payload))
+                else:
+                    self._send(writer, call_id, RPC_ERROR, marshal.dumps(("ProgrammingError", f"unknown op {op}")))
+                    continue
+                self.tasks.add(fut)
+                fut.add_done_callback(self.tasks.discard)
+                fut.add_done_callback(functools.partial(self._reply, writer, call_id, sql))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def stop(self) -> None:
+        if self.server:
+            self.server.close()
+        self._flush()
+        for writer in list(self.clients):
+            writer.close()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.committer.drain()
+        await self._run(self.conn.commit)
+        await self._run(self.conn.close)
+        self.worker.shutdown()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.socket_path)
+
+class EditScheduler:
+    # Token bucket per channel for message edits. Intermediate frames are
+    # dropped when the channel's bucket is empty; final frames wait for a
+    # token so the end state always lands.
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.buckets: Dict[int, List[float]] = {}
+
+    def _tokens(self, channel_id: int) -> List[float]:
+        now = asyncio.get_running_loop().time()
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            if len(self.buckets) >= 1024:
+                # Full buckets carry no state; forget them.
+                self.buckets = {k: b for k, b in self.buckets.items() if b[0] + (now - b[1]) * self.rate < self.burst}
+            bucket = self.buckets[channel_id] = [float(self.burst), now]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        return bucket
+
+    def try_take(self, channel_id: int) -> bool:
+        bucket = self._tokens(channel_id)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    async def take(self, channel_id: int) -> None:
+        while not self.try_take(channel_id):
+            await asyncio.sleep((1 - self._tokens(channel_id)[0]) / self.rate)
+
+    async def edit(self, msg: discord.Message, channel_id: int, final: bool = False, **kwargs) -> bool:
+        if final:
+            await self.take(channel_id)
+        elif not self.try_take(channel_id):
+            return False
+        await msg.edit(**kwargs)
+        return True
+
+edit_scheduler = EditScheduler(EDIT_RATE, EDIT_BURST)
+
+class AnimationCache:
+    # Pack GIF bytes and their uploaded URLs. Each local file is memory-mapped
+    # on first use; after one upload to a channel, later openings there embed
+    # the attachment's CDN URL. Uploads past the hourly byte budget are
+    # refused so the reveal falls back to text.
+    def __init__(self, url_ttl: float, max_upload: int, budget: int):
+        self.url_ttl = url_ttl
+        self.max_upload = max_upload
+        self.budget = budget
+        self.files: Dict[str, Optional[mmap.mmap]] = {}
+        self.urls: Dict[Tuple[int, str], Tuple[str, float]] = {}
+        self.uploading: Dict[Tuple[int, str], asyncio.Future] = {}
+        self.window_start = 0.0
+        self.uploaded = 0
+
+    def data(self, path: str) -> Optional[mmap.mmap]:
+        if path not in self.files:
+            self.files[path] = None
+            try:
+                with open(path, "rb") as f:
+                    self.files[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                print(f"Animation asset unavailable: {path}")
+        return self.files[path]
+
+    async def url(self, channel_id: int, pack_type: str) -> Optional[str]:
+        key = (channel_id, pack_type)
+        if key in self.uploading:
+            await asyncio.shield(self.uploading[key])
+        entry = self.urls.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= asyncio.get_running_loop().time():
+            del self.urls[key]
+            return None
+        return entry[0]
+
+    def reserve(self, size: int) -> bool:
+        now = asyncio.get_running_loop().time()
+        if now - self.window_start >= 3600:
+            self.window_start, self.uploaded = now, 0
+        if size > self.max_upload or self.uploaded + size > self.budget:
+            return False
+        self.uploaded += size
+        return True
+
+    def remember(self, channel_id: int, pack_type: str, url: str) -> None:
+        now = asyncio.get_running_loop().time()
+        if len(self.urls) >= 4096:
+            self.urls = {k: v for k, v in self.urls.items() if v[1] > now}
+        self.urls[(channel_id, pack_type)] = (url, now + self.url_ttl)
+
+    def close(self) -> None:
+        for mm in self.files.values():
+            if mm is not None:
+                mm.close()
+        self.files.clear()
+
+anim_cache = AnimationCache(ANIM_URL_TTL, int(ANIM_MAX_UPLOAD_MB * 1024 * 1024), int(ANIM_UPLOAD_BUDGET_MB * 1024 * 1024))
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    # Counts Discord API requests against the invocation that made them. The
+    # interaction callback (reply or defer) marks the first response.
+    async def on_request_start(session, ctx, params):
+        command_metrics.http_total += 1
+        inv = current_invocation.get()
+        if inv is not None:
+            inv.http_calls += 1
+
+    async def on_request_end(session, ctx, params):
+        inv = current_invocation.get()
+        if inv is not None and inv.first_response is None and params.url.path.endswith("/callback"):
+            inv.first_response = time.perf_counter()
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+def timed(name: str):
+    # For view buttons and modal submits, which bypass the command tree.
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, interaction: discord.Interaction, *args):
+            inv = command_metrics.start(name)
+            try:
+                result = await func(self, interaction, *args)
+            except Exception:
+                command_metrics.finish(inv, error=True)
+                raise
+            command_metrics.finish(inv)
+            return result
+        return wrapper
+    return decorator
+
+open_views: "weakref.WeakSet[discord.ui.View]" = weakref.WeakSet()
+
+async def sample_loop_lag(interval: float = 0.5) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        command_metrics.loop_lag.observe(max(0.0, loop.time() - start - interval))
+
+def render_metrics(bot: "TycoonBot") -> str:
+    lines = command_metrics.render()
+    views: Dict[str, int] = {}
+    for view in list(open_views):
+        if not view.is_finished():
+            views[type(view).__name__] = views.get(type(view).__name__, 0) + 1
+    lines += ["# HELP packify_open_views Views still accepting interactions.", "# TYPE packify_open_views gauge"]
+    lines += [f'packify_open_views{{view="{n}"}} {c}' for n, c in sorted(views.items())]
+    lines += ["# HELP packify_background_tasks Running reveal animations and other detached tasks.", "# TYPE packify_background_tasks gauge",
+              f"packify_background_tasks {len(bot.background)}"]
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server(bot: "TycoonBot", port: int) -> web.AppRunner:
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(bot), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+def command_tree_hash(tree: app_commands.CommandTree, guild: Optional[discord.abc.Snowflake] = None) -> str:
+    # Digest of the payload tree.sync(guild=guild) would upload.
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands(guild=guild)), key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+class TycoonTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Runs in the task that invokes the command, so everything it awaits
+        # (including DB statements) is attributed to this command.
+        cmd = interaction.command
+        name = cmd.qualified_name if cmd else (interaction.data or {}).get("name", "?")
+        if interaction.type is discord.InteractionType.autocomplete:
+            current_command.set(name + ":autocomplete")
+            return True
+        interaction.extras["invocation"] = command_metrics.start(name)
+        return True
 
-        if TEST_GUILD_ID:
-            guild = discord.Object(id=TEST_GUILD_ID)
+class TycoonBot(commands.AutoShardedBot):
+    def __init__(self):
+        super().__init__(
+            command_prefix=BOT_PREFIX, intents=INTENTS, tree_cls=TycoonTree, http_trace=http_trace_config(),
+            shard_count=SHARD_COUNT or None, shard_ids=SHARD_IDS or None,
+        )
+        self.db: Optional[aiosqlite.Connection] = None
+        self.storage: Optional[RemoteConnection] = None
+        self.readers = ReaderPool(DB_PATH, DB_READERS)
+        self.committer = GroupCommitter(DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX)
+        self.background: set = set()
+        self.metrics: Optional[web.AppRunner] = None
+        self.lag_sampler: Optional[asyncio.Task] = None
+        self.force_sync = False
+
+    async def commit(self) -> None:
+        mark = profile_cache.checkpoint()
+        start = time.perf_counter()
+        await self.committer.commit(self.db)
+        note_lock_wait(start)
+        profile_cache.committed(mark)
+
+    def reader(self):
+        return self.readers.acquire()
+
+    async def read(self, fn, *args, **kwargs):
+        async with self.readers.acquire() as rdb:
+            return await fn(rdb, *args, **kwargs)
+
+    def spawn(self, coro) -> asyncio.Task:
+        # Fire-and-forget work (reveal animations) that must not hold the command or a transaction.
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self._background_done)
+        return task
+
+    def _background_done(self, task: asyncio.Task) -> None:
+        self.background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Background task failed: {task.exception()!r}")
+
+    async def profile(self, user_id: int) -> Optional[ProfileSnapshot]:
+        snap = profile_cache.peek(user_id)
+        if snap is not None:
+            return snap
+        if profile_cache.is_dirty(user_id):
+            return await load_profile(self.db, user_id)
+        async with self.readers.acquire() as rdb:
+            return await profile_cache.load(rdb, user_id)
+
+    async def init_storage(self) -> None:
+        # Everything setup_hook needs except Discord: also used by bench/loadtest.py.
+        if STORAGE_SOCKET:
+            # Cluster shard process: the storage service has already set up
+            # the database and owns the writer; readers still open the file.
+            check_sqlite_version()
+            self.storage = await RemoteConnection.open(STORAGE_SOCKET)
+            cache_bus.link = self.storage
+            inventory_ids.partition(CLUSTER_INDEX, CLUSTER_SIZE)
+            self.db = InstrumentedConnection(self.storage, db_stats)
+            self.db.row_factory = aiosqlite.Row
+        else:
+            await setup_db()
+            self.db = InstrumentedConnection(await aiosqlite.connect(DB_PATH), db_stats)
+            self.db.row_factory = aiosqlite.Row
+            await self.db.execute("PRAGMA busy_timeout = 5000")
+        self.readers.path = DB_PATH
+        await self.readers.open(self.db)
+        inventory_search.readers = self.readers
+        await card_catalog.load(self.db)
+        await pack_table.load(self.db)
+        await order_book.load(self.db)
+        async with self.db.execute("SELECT MAX(inventory_id) FROM inventory") as c:
+            inventory_ids.observe((await c.fetchone())[0])
+        if self.storage:
+            self.storage.release()
+
+    async def setup_hook(self) -> None:
+        await self.init_storage()
+        self.lag_sampler = asyncio.create_task(sample_loop_lag())
+        if METRICS_PORT:
+            self.metrics = await start_metrics_server(self, METRICS_PORT + CLUSTER_INDEX)
+        # Cluster-wide jobs run in the first process only.
+        if CLUSTER_INDEX:
+            return
+        self.npc_settlement.start()
+
+        guild = discord.Object(id=TEST_GUILD_ID) if TEST_GUILD_ID else None
+        if guild:
             self.tree.copy_global_to(guild=guild)
-            await self.tree.sync(guild=guild)
+        await self.sync_commands(guild)
+
+    async def sync_commands(self, guild: Optional[discord.abc.Snowflake] = None) -> bool:
+        # tree.sync is a rate-limited global round trip, so only upload when
+        # the commands differ from what this application last synced. If
+        # they were changed from elsewhere, start with --force-sync.
+        key = f"command_tree:{self.application_id}:{guild.id if guild else 'global'}"
+        digest = command_tree_hash(self.tree, guild)
+        if not self.force_sync and await get_meta(self.db, key) == digest:
+            print("Slash commands unchanged; skipped sync.")
+            return False
+        await self.tree.sync(guild=guild)
+        await set_meta(self.db, key, digest)
+        await self.commit()
+        print("Slash commands synced.")
+        return True
+
+    async def before_identify_hook(self, shard_id: Optional[int], *, initial: bool = False) -> None:
+        # Shard processes take turns through the storage service, so the
+        # cluster as a whole stays within Discord's IDENTIFY rate limit.
+        if self.storage is not None and not self.storage.closed:
+            await self.storage.identify(shard_id or 0)
         else:
-            await self.tree.sync()
+            await super().before_identify_hook(shard_id, initial=initial)
+
+    @tasks.loop(seconds=NPC_SETTLE_SECONDS)
+    async def npc_settlement(self):
+        try:
+            await settle_npc_sales(self.db)
+            await self.commit()
+        except Exception as e:
+            print(f"NPC settlement failed: {e}")
 
     async def close(self) -> None:
+        self.npc_settlement.cancel()
+        for task in list(self.background):
+            task.cancel()
+        anim_cache.close()
+        if self.lag_sampler:
+            self.lag_sampler.cancel()
+        if self.metrics:
+            await self.metrics.cleanup()
+        await self.close_storage()
+        await super().close()
+
+    async def close_storage(self) -> None:
+        await self.committer.drain()
+        await self.readers.close()
         if self.db:
             await self.db.close()
-        await super().close()
 
 bot = TycoonBot()
 
 class InventoryView(discord.ui.View):
-    def __init__(self, user_id: int, items: List[aiosqlite.Row], page_size: int = 10, timeout: float = 120):
+    # Pages are fetched on demand with keyset queries; only the last few
+    # pages the viewer touched are kept.
+    def __init__(self, bot: TycoonBot, user_id: int, total: int, page_size: int = 10, timeout: float = 120, cache_pages: int = 3):
         super().__init__(timeout=timeout)
+        open_views.add(self)
+        self.bot = bot
         self.user_id = user_id
-        self.items = items
+        self.total = total
         self.page_size = page_size
+        self.cache_pages = cache_pages
         self.page = 0
-
-    def format_page(self) -> discord.Embed:
-        start = self.page * self.page_size
-        chunk = self.items[start:start+self.page_size]
+        self.pages: "OrderedDict[int, List[aiosqlite.Row]]" = OrderedDict()
+        self._prefetch: Optional[asyncio.Task] = None
+
+    @property
+    def last_page(self) -> int:
+        return max(0, (self.total - 1) // self.page_size)
+
+    @staticmethod
+    def _key(row: aiosqlite.Row) -> str:
+        return row["inventory_id"]
+
+    async def _fetch(self, page: int) -> List[aiosqlite.Row]:
+        prev_rows = self.pages.get(page - 1)
+        next_rows = self.pages.get(page + 1)
+        if page == 0:
+            return await self.bot.read(inventory_page, self.user_id, self.page_size)
+        if prev_rows:
+            return await self.bot.read(inventory_page, self.user_id, self.page_size, before=self._key(prev_rows[-1]))
+        if page == self.last_page:
+            size = self.total - page * self.page_size
+            return await self.bot.read(inventory_page, self.user_id, size, oldest=True)
+        if next_rows:
+            return await self.bot.read(inventory_page, self.user_id, self.page_size, after=self._key(next_rows[0]))
+        return await self.bot.read(inventory_items, self.user_id, limit=self.page_size, offset=page * self.page_size)
+
+    async def load(self, page: int) -> List[aiosqlite.Row]:
+        rows = self.pages.get(page)
+        if rows is None:
+            rows = await self._fetch(page)
+            self.pages[page] = rows
+            while len(self.pages) > self.cache_pages:
+                far = max(self.pages, key=lambda p: abs(p - page))
+                del self.pages[far]
+        self.pages.move_to_end(page)
+        return rows
+
+    def _schedule_prefetch(self) -> None:
+        nxt = self.page + 1
+        if nxt > self.last_page or nxt in self.pages or (self._prefetch and not self._prefetch.done()):
+            return
+        self._prefetch = asyncio.create_task(self.load(nxt))
+
+    async def show(self, page: int, recount: bool = False) -> discord.Embed:
+        if recount:
+            self.total = await self.bot.read(inventory_count, self.user_id)
+            self.pages.clear()
+            page = self.last_page if page < 0 else page
+        self.page = clamp(page, 0, self.last_page)
+        rows = await self.load(self.page)
+        self._schedule_prefetch()
+        return self.format_page(rows)
+
+    def format_page(self, chunk: List[aiosqlite.Row]) -> discord.Embed:
         embed = discord.Embed(title="🎒 Inventory", color=COLOR_DEFAULT)
         if not chunk:
             embed.description = "No cards found."
@@ -547,25 +2824,31 @@ class InventoryView(discord.ui.View):
                 value=f"ID: `{inv_id}` • Collection: {coll} • Base value: {val}",
                 inline=False
             )
-        total_pages = max(1, (len(self.items) + self.page_size - 1) // self.page_size)
-        embed.set_footer(text=f"Page {self.page+1}/{total_pages} • Use buttons to navigate")
+        embed.set_footer(text=f"Page {self.page+1}/{self.last_page+1} • {self.total} cards • Use buttons to navigate")
         return embed
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         return interaction.user.id == self.user_id
 
+    @discord.ui.button(label="First", style=discord.ButtonStyle.secondary)
+    @timed("inventory:first")
+    async def first_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.edit_message(embed=await self.show(0, recount=True), view=self)
+
     @discord.ui.button(label="Prev", style=discord.ButtonStyle.secondary)
+    @timed("inventory:prev")
     async def prev_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.page > 0:
-            self.page -= 1
-        await interaction.response.edit_message(embed=self.format_page(), view=self)
+        await interaction.response.edit_message(embed=await self.show(max(0, self.page - 1)), view=self)
 
     @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    @timed("inventory:next")
     async def next_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        max_page = max(0, (len(self.items) - 1) // self.page_size)
-        if self.page < max_page:
-            self.page += 1
-        await interaction.response.edit_message(embed=self.format_page(), view=self)
+        await interaction.response.edit_message(embed=await self.show(min(self.last_page, self.page + 1)), view=self)
+
+    @discord.ui.button(label="Last", style=discord.ButtonStyle.secondary)
+    @timed("inventory:last")
+    async def last_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.edit_message(embed=await self.show(-1, recount=True), view=self)
 
 class TradeState:
     def __init__(self, a_id: int, b_id: int):
@@ -580,6 +2863,7 @@ class TradeState:
 class TradeView(discord.ui.View):
     def __init__(self, bot: TycoonBot, state: TradeState, timeout: float = 300):
         super().__init__(timeout=timeout)
+        open_views.add(self)
         self.bot = bot
         self.state = state
         self.msg: Optional[discord.Message] = None
@@ -600,6 +2884,7 @@ class TradeView(discord.ui.View):
             ids = discord.ui.TextInput(
                 label="Inventory IDs (comma separated)", placeholder="ABC123, DEF456, ...", required=True
             )
+            @timed("trade:offer")
             async def on_submit(self, modal_interaction: discord.Interaction):
                 offers = [x.strip() for x in str(self.ids.value).split(",") if x.strip()]
                 await modal_interaction.response.defer(thinking=False)
@@ -615,6 +2900,7 @@ class TradeView(discord.ui.View):
             await interaction.followup.send("This button isn't for you.", ephemeral=True)
             return
 
+        offers = [await inventory_search.resolve(self.bot.db, uid, oid) for oid in offers]
         valid_ids = []
         async with self.bot.db.execute("SELECT inventory_id, locked FROM inventory WHERE user_id = ? AND inventory_id IN (%s)" %
                                        ",".join("?"*len(offers)), (uid, *offers)) as c:
@@ -640,7 +2926,7 @@ class TradeView(discord.ui.View):
             self.state.b_offers.extend(valid_ids)
             self.state.b_confirmed = False
 
-        await self.bot.db.commit()
+        await self.bot.commit()
 
         await interaction.followup.send(f"Added {len(valid_ids)} items to your offer and locked them.", ephemeral=True)
         if self.msg:
@@ -654,23 +2940,19 @@ class TradeView(discord.ui.View):
             "UPDATE inventory SET locked = 0 WHERE inventory_id IN (%s)" % ",".join("?"*len(ids)),
             (*ids,)
         )
-        await self.bot.db.commit()
+        await self.bot.commit()
 
     async def _finalize_trade(self, interaction: discord.Interaction):
         ids_a = self.state.a_offers
         ids_b = self.state.b_offers
-        if ids_a:
-            await self.bot.db.execute(
-                "UPDATE inventory SET user_id = ?, locked = 0 WHERE inventory_id IN (%s)" % ",".join("?"*len(ids_a)),
-                (self.state.b_id, *ids_a)
-            )
-        if ids_b:
-            await self.bot.db.execute(
-                "UPDATE inventory SET user_id = ?, locked = 0 WHERE inventory_id IN (%s)" % ",".join("?"*len(ids_b)),
-                (self.state.a_id, *ids_b)
-            )
-        await self.bot.db.commit()
-        await interaction.followup.send("Trade complete ✅", ephemeral=True)
+        moved = await transfer_inventory_items(self.bot.db, ids_a, self.state.a_id, self.state.b_id, locked=1)
+        moved += await transfer_inventory_items(self.bot.db, ids_b, self.state.b_id, self.state.a_id, locked=1)
+        await self.bot.commit()
+        missing = len(ids_a) + len(ids_b) - len(moved)
+        if missing:
+            await interaction.followup.send(f"Trade complete, but {missing} offered item(s) were no longer available ⚠️", ephemeral=True)
+        else:
+            await interaction.followup.send("Trade complete ✅", ephemeral=True)
         if self.msg:
             await self.msg.edit(content="Trade complete ✅", embed=self._summary(), view=None)
 
@@ -678,14 +2960,17 @@ class TradeView(discord.ui.View):
         return interaction.user.id in {self.state.a_id, self.state.b_id}
 
     @discord.ui.button(label="Add (A)", style=discord.ButtonStyle.primary)
+    @timed("trade:add")
     async def add_a(self, interaction: discord.Interaction, button: discord.ui.Button):
         await self._add_items_modal(interaction, "A")
 
     @discord.ui.button(label="Add (B)", style=discord.ButtonStyle.primary)
+    @timed("trade:add")
     async def add_b(self, interaction: discord.Interaction, button: discord.ui.Button):
         await self._add_items_modal(interaction, "B")
 
     @discord.ui.button(label="Confirm (A)", style=discord.ButtonStyle.success)
+    @timed("trade:confirm")
     async def confirm_a(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.state.a_id:
             await interaction.response.send_message("This is for the other trader.", ephemeral=True)
@@ -698,6 +2983,7 @@ class TradeView(discord.ui.View):
             await self._finalize_trade(interaction)
 
     @discord.ui.button(label="Confirm (B)", style=discord.ButtonStyle.success)
+    @timed("trade:confirm")
     async def confirm_b(self, interaction: discord.Interaction, button: discord.ui.Button):
         if interaction.user.id != self.state.b_id:
             await interaction.response.send_message("This is for the other trader.", ephemeral=True)
@@ -710,6 +2996,7 @@ class TradeView(discord.ui.View):
             await self._finalize_trade(interaction)
 
     @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
+    @timed("trade:cancel")
     async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
         await self._unlock_all()
         await interaction.response.send_message("Trade canceled.", ephemeral=True)
@@ -726,27 +3013,40 @@ class TradeView(discord.ui.View):
             pass
 
 class MarketView(discord.ui.View):
-    def __init__(self, bot: TycoonBot, viewer_id: int, timeout: float = 180):
+    def __init__(self, bot: TycoonBot, viewer_id: int, filters: Optional[Dict] = None, page_size: int = 10, timeout: float = 180):
         super().__init__(timeout=timeout)
+        open_views.add(self)
         self.bot = bot
         self.viewer_id = viewer_id
+        self.filters = filters or {}
+        self.page_size = page_size
+        self.page = 0
         self.message: Optional[discord.Message] = None
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         return True
 
-    def _render_embed(self, listings: List[aiosqlite.Row]) -> discord.Embed:
+    def _listings(self) -> List[Listing]:
+        listings = order_book.query(**self.filters)
+        pages = max(1, (len(listings) + self.page_size - 1) // self.page_size)
+        self.page = clamp(self.page, 0, pages - 1)
+        return listings
+
+    def _render_embed(self, listings: List[Listing]) -> discord.Embed:
         embed = discord.Embed(title="🌐 Marketplace", color=0xFFB347)
         if not listings:
-            embed.description = "No active listings. Use the buttons to list or buy."
+            embed.description = "No listings match. Use the buttons to list or buy." if self.filters else "No active listings. Use the buttons to list or buy."
             return embed
-        for row in listings[:10]:
+        start = self.page * self.page_size
+        for row in listings[start:start + self.page_size]:
             lid = row["listing_id"]
             seller = f"<@{row['seller_id']}>"
             if row["item_type"] == "card":
+                card = card_catalog.get(row["card_id"]) if row["card_id"] is not None else None
+                what = f"{rarity_emoji(card['rarity'])} {card['name']} [{card['rarity']}] • " if card else ""
                 embed.add_field(
                     name=f"#{lid} • Card • Price: {row['price']}",
-                    value=f"Seller: {seller} • Card ID: `{row['inventory_id']}`",
+                    value=f"Seller: {seller} • {what}Card ID: `{row['inventory_id']}`",
                     inline=False
                 )
             else:
@@ -755,24 +3055,40 @@ class MarketView(discord.ui.View):
                     value=f"Seller: {seller} • Type: `{row['pack_type']}`",
                     inline=False
                 )
-        embed.set_footer(text="Use List Card/List Pack/Buy/Remove to interact.")
+        pages = (len(listings) + self.page_size - 1) // self.page_size
+        embed.set_footer(text=f"Page {self.page + 1}/{pages} • {len(listings)} listings • Use List Card/List Pack/Buy/Remove to interact.")
         return embed
 
-    async def refresh(self):
-        self.bot.db.row_factory = aiosqlite.Row
-        async with self.bot.db.execute("SELECT * FROM marketplace WHERE status = 'active' ORDER BY listing_id DESC LIMIT 20") as c:
-            rows = await c.fetchall()
-        if self.message:
-            await self.message.edit(embed=self._render_embed(rows), view=self)
+    async def refresh(self, interaction: Optional[discord.Interaction] = None):
+        embed = self._render_embed(self._listings())
+        if interaction is not None:
+            await interaction.response.edit_message(embed=embed, view=self)
+        elif self.message:
+            await self.message.edit(embed=embed, view=self)
+
+    @discord.ui.button(label="◀ Prev", style=discord.ButtonStyle.secondary, row=1)
+    @timed("market:prev")
+    async def prev_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self.refresh(interaction)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary, row=1)
+    @timed("market:next")
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self.refresh(interaction)
 
     @discord.ui.button(label="List Card", style=discord.ButtonStyle.primary)
+    @timed("market:list_card")
     async def list_card(self, interaction: discord.Interaction, button: discord.ui.Button):
         class ListCardModal(discord.ui.Modal, title="List Card on Marketplace"):
             inv_id = discord.ui.TextInput(label="Inventory ID", placeholder="ABC123...", required=True, max_length=32)
             price = discord.ui.TextInput(label="Price", placeholder="e.g., 300", required=True)
+            @timed("market:list_card:submit")
             async def on_submit(self, mi: discord.Interaction):
                 await mi.response.defer()
-                inv = await get_inventory_item(self_view.bot.db, mi.user.id, str(self.inv_id.value).strip())
+                inv_id = await inventory_search.resolve(self_view.bot.db, mi.user.id, str(self.inv_id.value))
+                inv = await get_inventory_item(self_view.bot.db, mi.user.id, inv_id)
                 if not inv:
                     await mi.followup.send("You don't own that card, or it doesn't exist.", ephemeral=True)
                     return
@@ -785,12 +3101,14 @@ class MarketView(discord.ui.View):
                 except:
                     await mi.followup.send("Invalid price.", ephemeral=True)
                     return
-                await self_view.bot.db.execute("UPDATE inventory SET locked = 1 WHERE inventory_id = ?", (inv["inventory_id"],))
-                await self_view.bot.db.execute(
-                    "INSERT INTO marketplace (seller_id, item_type, inventory_id, price, created_at) VALUES (?, 'card', ?, ?, ?)",
-                    (mi.user.id, inv["inventory_id"], p, now_iso())
+                cur = await self_view.bot.db.execute(
+                    "UPDATE inventory SET locked = 1 WHERE inventory_id = ? AND user_id = ? AND locked = 0", (inv["inventory_id"], mi.user.id)
                 )
-                await self_view.bot.db.commit()
+                if cur.rowcount == 0:
+                    await mi.followup.send("That card is locked (maybe in a trade).", ephemeral=True)
+                    return
+                await create_listing(self_view.bot.db, mi.user.id, p, inventory_id=inv["inventory_id"], card_id=inv["card_id"])
+                await self_view.bot.commit()
                 await mi.followup.send(f"Listed card `{inv['inventory_id']}` for {p}.", ephemeral=True)
                 await self_view.refresh()
 
@@ -798,11 +3116,13 @@ class MarketView(discord.ui.View):
         await interaction.response.send_modal(ListCardModal())
 
     @discord.ui.button(label="List Pack", style=discord.ButtonStyle.primary)
+    @timed("market:list_pack")
     async def list_pack(self, interaction: discord.Interaction, button: discord.ui.Button):
         class ListPackModal(discord.ui.Modal, title="List Pack(s) on Marketplace"):
             ptype = discord.ui.TextInput(label="Pack Type", placeholder="basic / rare / epic", required=True)
             qty = discord.ui.TextInput(label="Quantity", placeholder="e.g., 1", required=True)
             price = discord.ui.TextInput(label="Price per pack", placeholder="e.g., 150", required=True)
+            @timed("market:list_pack:submit")
             async def on_submit(self, mi: discord.Interaction):
                 await mi.response.defer()
                 ptype_s = str(self.ptype.value).strip().lower()
@@ -816,17 +3136,12 @@ class MarketView(discord.ui.View):
                 except:
                     await mi.followup.send("Invalid quantity/price.", ephemeral=True)
                     return
-                stock = await get_store_stock(self_view.bot.db, mi.user.id)
-                available = stock.get(ptype_s, 0)
-                if available < q:
+                if not await take_store_stock(self_view.bot.db, mi.user.id, ptype_s, q):
+                    available = (await get_store_stock(self_view.bot.db, mi.user.id)).get(ptype_s, 0)
                     await mi.followup.send(f"Not enough in store stock. You have {available} of {ptype_s}.", ephemeral=True)
                     return
-                await change_store_stock(self_view.bot.db, mi.user.id, ptype_s, -q)
-                await self_view.bot.db.execute(
-                    "INSERT INTO marketplace (seller_id, item_type, pack_type, quantity, price, created_at) VALUES (?, 'pack', ?, ?, ?, ?)",
-                    (mi.user.id, ptype_s, q, p, now_iso())
-                )
-                await self_view.bot.db.commit()
+                await create_listing(self_view.bot.db, mi.user.id, p, pack_type=ptype_s, quantity=q)
+                await self_view.bot.commit()
                 await mi.followup.send(f"Listed {q}x {ptype_s} pack(s) at {p} each.", ephemeral=True)
                 await self_view.refresh()
 
@@ -834,10 +3149,12 @@ class MarketView(discord.ui.View):
         await interaction.response.send_modal(ListPackModal())
 
     @discord.ui.button(label="Buy", style=discord.ButtonStyle.success)
+    @timed("market:buy")
     async def buy(self, interaction: discord.Interaction, button: discord.ui.Button):
         class BuyModal(discord.ui.Modal, title="Buy from Marketplace"):
             listing_id = discord.ui.TextInput(label="Listing ID", placeholder="Number", required=True)
             quantity = discord.ui.TextInput(label="Quantity (packs only)", placeholder="1 (ignored for cards)", required=False, default="1")
+            @timed("market:buy:submit")
             async def on_submit(self, mi: discord.Interaction):
                 await mi.response.defer()
                 try:
@@ -850,57 +3167,48 @@ class MarketView(discord.ui.View):
                     qty_req = max(1, int(str(self.quantity.value)))
                 except:
                     qty_req = 1
-                self_view.bot.db.row_factory = aiosqlite.Row
-                async with self_view.bot.db.execute("SELECT * FROM marketplace WHERE listing_id = ? AND status = 'active'", (lid,)) as c:
-                    listing = await c.fetchone()
+                listing = order_book.listings.get(lid)
                 if not listing:
                     await mi.followup.send("Listing not found.", ephemeral=True)
                     return
                 if listing["seller_id"] == mi.user.id:
                     await mi.followup.send("You can't buy your own listing.", ephemeral=True)
                     return
-                if listing["item_type"] == "card":
-                    price = listing["price"]
-                    wallet = await get_wallet(self_view.bot.db, mi.user.id)
-                    if wallet < price:
-                        await mi.followup.send("Not enough coins.", ephemeral=True)
+                db = self_view.bot.db
+                is_card = listing["item_type"] == "card"
+                q_buy = 1 if is_card else clamp(qty_req, 1, listing["quantity"])
+                price_total = q_buy * listing["price"]
+                if await debit_wallet(db, mi.user.id, price_total) is None:
+                    await mi.followup.send("Not enough coins." if is_card else f"Not enough coins for {q_buy} pack(s).", ephemeral=True)
+                    return
+                if not await claim_listing(db, lid, q_buy):
+                    # Sold or withdrawn since we read it.
+                    await adjust_wallet(db, mi.user.id, price_total)
+                    await self_view.bot.commit()
+                    await mi.followup.send("That listing is no longer available.", ephemeral=True)
+                    return
+                if is_card:
+                    if not await transfer_inventory_items(db, [listing["inventory_id"]], listing["seller_id"], mi.user.id, locked=1):
+                        await adjust_wallet(db, mi.user.id, price_total)
+                        await self_view.bot.commit()
+                        await mi.followup.send("That card is no longer available.", ephemeral=True)
                         return
-                    await adjust_wallet(self_view.bot.db, mi.user.id, -price)
-                    await adjust_wallet(self_view.bot.db, listing["seller_id"], price)
-                    await self_view.bot.db.execute(
-                        "UPDATE inventory SET user_id = ?, locked = 0 WHERE inventory_id = ?",
-                        (mi.user.id, listing["inventory_id"])
-                    )
-                    await self_view.bot.db.execute("UPDATE marketplace SET status = 'sold' WHERE listing_id = ?", (lid,))
-                    await self_view.bot.db.commit()
-                    await mi.followup.send("Purchased card successfully.", ephemeral=True)
                 else:
-                    q_avail = listing["quantity"]
-                    q_buy = clamp(qty_req, 1, q_avail)
-                    price_total = q_buy * listing["price"]
-                    wallet = await get_wallet(self_view.bot.db, mi.user.id)
-                    if wallet < price_total:
-                        await mi.followup.send(f"Not enough coins for {q_buy} pack(s).", ephemeral=True)
-                        return
-                    await adjust_wallet(self_view.bot.db, mi.user.id, -price_total)
-                    await adjust_wallet(self_view.bot.db, listing["seller_id"], price_total)
-                    for _ in range(q_buy):
-                        await give_owned_pack(self_view.bot.db, mi.user.id, listing["pack_type"])
-                    if q_buy == q_avail:
-                        await self_view.bot.db.execute("UPDATE marketplace SET status = 'sold' WHERE listing_id = ?", (lid,))
-                    else:
-                        await self_view.bot.db.execute("UPDATE marketplace SET quantity = quantity - ? WHERE listing_id = ?", (q_buy, lid))
-                    await self_view.bot.db.commit()
-                    await mi.followup.send(f"Purchased {q_buy} pack(s).", ephemeral=True)
+                    await give_owned_pack(db, mi.user.id, listing["pack_type"], q_buy)
+                await adjust_wallet(db, listing["seller_id"], price_total)
+                await self_view.bot.commit()
+                await mi.followup.send("Purchased card successfully." if is_card else f"Purchased {q_buy} pack(s).", ephemeral=True)
                 await self_view.refresh()
 
         self_view = self
         await interaction.response.send_modal(BuyModal())
 
     @discord.ui.button(label="Remove Listing", style=discord.ButtonStyle.secondary)
+    @timed("market:remove")
     async def remove_listing(self, interaction: discord.Interaction, button: discord.ui.Button):
         class RemoveModal(discord.ui.Modal, title="Remove My Listing"):
             listing_id = discord.ui.TextInput(label="Listing ID", required=True)
+            @timed("market:remove:submit")
             async def on_submit(self, mi: discord.Interaction):
                 await mi.response.defer()
                 try:
@@ -908,22 +3216,22 @@ class MarketView(discord.ui.View):
                 except:
                     await mi.followup.send("Invalid listing ID.", ephemeral=True)
                     return
-                self_view.bot.db.row_factory = aiosqlite.Row
-                async with self_view.bot.db.execute("SELECT * FROM marketplace WHERE listing_id = ? AND status = 'active'", (lid,)) as c:
-                    listing = await c.fetchone()
+                listing = order_book.listings.get(lid)
                 if not listing:
                     await mi.followup.send("Listing not found or not active.", ephemeral=True)
                     return
                 if listing["seller_id"] != mi.user.id:
                     await mi.followup.send("That's not your listing.", ephemeral=True)
                     return
+                if not await withdraw_listing(self_view.bot.db, lid, mi.user.id):
+                    await mi.followup.send("Listing not found or not active.", ephemeral=True)
+                    return
                 # Return item
                 if listing["item_type"] == "card":
                     await self_view.bot.db.execute("UPDATE inventory SET locked = 0 WHERE inventory_id = ?", (listing["inventory_id"],))
                 else:
                     await change_store_stock(self_view.bot.db, mi.user.id, listing["pack_type"], listing["quantity"])
-                await self_view.bot.db.execute("UPDATE marketplace SET status = 'removed' WHERE listing_id = ?", (lid,))
-                await self_view.bot.db.commit()
+                await self_view.bot.commit()
                 await mi.followup.send("Listing removed.", ephemeral=True)
                 await self_view.refresh()
 
@@ -940,102 +3248,237 @@ class MarketView(discord.ui.View):
 @bot.tree.command(description="Create your account and shop")
 async def start(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True, thinking=True)
-    async with bot.db.execute("SELECT 1 FROM users WHERE user_id = ?", (interaction.user.id,)) as c:
-        row = await c.fetchone()
-    if row:
+    if await bot.profile(interaction.user.id):
         await interaction.followup.send("You already have an account.", ephemeral=True)
         return
     await create_user(bot.db, interaction.user.id)
-    await bot.db.commit()
+    await bot.commit()
     await interaction.followup.send(f"Account created! You received {STARTING_COINS} coins and a {STARTING_PACK} pack. Use /openpack to open it!", ephemeral=True)
 
 @bot.tree.command(description="Show your shop profile")
 async def profile(interaction: discord.Interaction):
     await interaction.response.defer(thinking=False, ephemeral=False)
-    user = await get_user(bot.db, interaction.user.id)
+    user = await bot.profile(interaction.user.id)
     if not user:
         await interaction.followup.send("Use /start first.", ephemeral=True)
         return
-    packs = await owned_packs_count(bot.db, interaction.user.id)
-    rare_count = await count_rare_or_better(bot.db, interaction.user.id)
-    shop_val = await compute_shop_value(bot.db, interaction.user.id)
-    stock = await get_store_stock(bot.db, interaction.user.id)
-    stock_summary = ", ".join(f"{k}:{v}" for k, v in stock.items()) or "None"
+    stock_summary = ", ".join(f"{k}:{v}" for k, v in user.stock.items()) or "None"
 
     embed = discord.Embed(title=f"🏪 {interaction.user.display_name}'s Shop", color=0x00BFFF)
     embed.add_field(name="Level", value=str(user["shop_level"]))
     embed.add_field(name="Wallet", value=str(user["wallet"]))
-    embed.add_field(name="Packs owned", value=str(packs))
-    embed.add_field(name="Rare+ cards", value=str(rare_count))
+    embed.add_field(name="Packs owned", value=str(user.packs))
+    embed.add_field(name="Rare+ cards", value=str(user.rare_count))
     embed.add_field(name="Shelves", value=str(user["shelves"]))
     embed.add_field(name="Inventory Cap", value=str(user["inventory_capacity"]))
     embed.add_field(name="Lifetime Profit", value=str(user["lifetime_profit"]), inline=False)
     embed.add_field(name="Store Stock", value=stock_summary, inline=False)
-    embed.add_field(name="Shop Value", value=str(shop_val), inline=False)
+    embed.add_field(name="Shop Value", value=str(user.shop_value), inline=False)
     embed.set_footer(text=f"Created {readable_ts(user['created_at'])} • Last daily {readable_ts(user['last_daily'])}")
     await interaction.followup.send(embed=embed)
 
 @bot.tree.command(description="Show all cards you own")
 async def inventory(interaction: discord.Interaction):
     await interaction.response.defer()
-    user = await get_user(bot.db, interaction.user.id)
+    user = await bot.profile(interaction.user.id)
     if not user:
         await interaction.followup.send("Use /start first.", ephemeral=True)
         return
-    items = await inventory_items(bot.db, interaction.user.id, limit=400, offset=0)
-    view = InventoryView(interaction.user.id, items)
-    embed = view.format_page()
+    view = InventoryView(bot, interaction.user.id, total=0)
+    embed = await view.show(0, recount=True)
     msg = await interaction.followup.send(embed=embed, view=view)
     view.message = msg
 
-@bot.tree.command(name="openpack", description="Open one of your packs")
-async def openpack_cmd(interaction: discord.Interaction):
+def bulk_open_embed(pack_types: List[str], obtained: List[Tuple[aiosqlite.Row, str]], skipped: int = 0, over_cap: int = 0) -> discord.Embed:
+    pack_counts: Dict[str, int] = {}
+    for ptype in pack_types:
+        pack_counts[ptype] = pack_counts.get(ptype, 0) + 1
+    by_rarity: Dict[str, Dict[str, int]] = {}
+    for c, _ in obtained:
+        names = by_rarity.setdefault(c["rarity"], {})
+        names[c["name"]] = names.get(c["name"], 0) + 1
+
+    embed = discord.Embed(title=f"✨ Opened {len(pack_types)} pack{'s' if len(pack_types) != 1 else ''}", color=0x2ECC71)
+    embed.description = "Packs: " + ", ".join(f"{k}x{v}" for k, v in pack_counts.items()) + f"\nCards: {len(obtained)}"
+    if skipped:
+        embed.description += f"\n{skipped} pack(s) left unopened — not enough inventory space. Use /shop upgrade."
+    if over_cap:
+        embed.description += f"\n{over_cap} more pack(s) left unopened — at most {MAX_BULK_OPEN} open per command. Run it again to continue."
+    for rarity in reversed(list(RARITY_META.keys())):
+        names = by_rarity.get(rarity)
+        if not names:
+            continue
+        value = ", ".join(f"{nm} x{n}" if n > 1 else nm for nm, n in sorted(names.items(), key=lambda kv: -kv[1]))
+        if len(value) > 1024:
+            value = value[:1021] + "..."
+        embed.add_field(name=f"{rarity_emoji(rarity)} {rarity} x{sum(names.values())}", value=value, inline=False)
+    embed.set_footer(text="Use /inventory to see the new cards and their IDs.")
+    return embed
+
+def reveal_line(c, inv_id: str) -> str:
+    return f"{rarity_emoji(c['rarity'])} {c['name']} [{c['rarity']}] • {c['collection']} (ID: `{inv_id}`)"
+
+def pack_results_embed(obtained: List[Tuple[aiosqlite.Row, str]]) -> discord.Embed:
+    return discord.Embed(
+        title="✨ Pack Results",
+        description="\n".join(
+            f"{rarity_emoji(c['rarity'])} {c['name']} [{c['rarity']}] • {c['collection']} • Base {c['base_value']} (ID: `{inv}`)"
+            for c, inv in obtained
+        ),
+        color=0x2ECC71
+    )
+
+def reveal_groups(obtained: List[Tuple[aiosqlite.Row, str]], mode: str) -> List[List[Tuple[aiosqlite.Row, str]]]:
+    # Cards shown by each intermediate frame; the results embed reveals the rest.
+    if mode == "classic":
+        return [[o] for o in obtained]
+    if mode == "batched" and REVEAL_BATCHES > 1:
+        size = -(-len(obtained) // REVEAL_BATCHES)
+        return [obtained[i:i + size] for i in range(0, len(obtained), size)][:-1]
+    return []
+
+async def send_pack_animation_gif(interaction: discord.Interaction, pack_type: str, embed: discord.Embed) -> Optional[Tuple[discord.Message, str]]:
+    # Sends `embed` with the pack's GIF as its image. Returns the message and
+    # the image reference later frames can reuse, or None if there is no GIF
+    # or it can't be uploaded right now.
+    source = ANIM_GIFS.get(pack_type)
+    if not source:
+        return None
+    if source.startswith(("http://", "https://")):
+        embed.set_image(url=source)
+        return await interaction.followup.send(embed=embed), source
+    channel_id = interaction.channel_id
+    url = await anim_cache.url(channel_id, pack_type)
+    if url:
+        embed.set_image(url=url)
+        return await interaction.followup.send(embed=embed), url
+    data = anim_cache.data(source)
+    if data is None or not anim_cache.reserve(len(data)):
+        return None
+    filename = os.path.basename(source)
+    embed.set_image(url=f"attachment://{filename}")
+    key = (channel_id, pack_type)
+    done = anim_cache.uploading[key] = asyncio.get_running_loop().create_future()
+    try:
+        msg = await interaction.followup.send(embed=embed, file=discord.File(io.BytesIO(data), filename=filename))
+        if msg.attachments:
+            anim_cache.remember(channel_id, pack_type, msg.attachments[0].url)
+    finally:
+        anim_cache.uploading.pop(key, None)
+        done.set_result(None)
+    return msg, f"attachment://{filename}"
+
+async def reveal_pack(interaction: discord.Interaction, pack_def: Dict, obtained: List[Tuple[aiosqlite.Row, str]], mode: Optional[str] = None) -> None:
+    # gif: the pack GIF, then results (1 send + 1 edit); falls back to batched
+    # without one. batched: REVEAL_BATCHES grouped frames. classic: one frame
+    # per card. Intermediate frames go through edit_scheduler and are skipped
+    # when the channel is busy.
+    mode = mode or REVEAL_MODE
+    embed = discord.Embed(title=f"🎁 Opening {pack_def['name']}...", color=0xE67E22)
+    if mode == "gif":
+        sent = await send_pack_animation_gif(interaction, pack_def["type"], embed)
+        if sent is not None:
+            msg, image = sent
+            await asyncio.sleep(DEFAULT_ANIM_DELAY)
+            results = pack_results_embed(obtained)
+            results.set_thumbnail(url=image)
+            await edit_scheduler.edit(msg, interaction.channel_id, final=True, embed=results)
+            return
+        mode = "batched"
+    embed.description = "Rolling cards..."
+    msg = await interaction.followup.send(embed=embed)
+    groups = reveal_groups(obtained, mode)
+    for group in groups:
+        await asyncio.sleep(REVEAL_DELAY * (1 if mode == "classic" else 2))
+        for c, inv_id in group:
+            embed.description = (embed.description or "") + f"\n{reveal_line(c, inv_id)}"
+            embed.color = rarity_color(c["rarity"])
+        await edit_scheduler.edit(msg, interaction.channel_id, embed=embed)
+    await asyncio.sleep(REVEAL_DELAY * (1 if groups else 2))
+    await edit_scheduler.edit(msg, interaction.channel_id, final=True, embed=pack_results_embed(obtained))
+
+@bot.tree.command(name="openpack", description="Open one or more of your packs")
+@app_commands.describe(
+    count=f"How many packs to open (default 1, max {MAX_BULK_OPEN})",
+    type="Only open packs of this type",
+    open_all=f"Open all your packs (of the given type, if set), up to {MAX_BULK_OPEN}",
+)
+@app_commands.rename(open_all="all")
+async def openpack_cmd(
+    interaction: discord.Interaction,
+    count: app_commands.Range[int, 1, MAX_BULK_OPEN] = 1,
+    type: Optional[str] = None,
+    open_all: bool = False,
+):
     await interaction.response.defer(thinking=True)
-    user = await get_user(bot.db, interaction.user.id)
+    user = await bot.profile(interaction.user.id)
     if not user:
         await interaction.followup.send("Use /start first.", ephemeral=True)
         return
-    pack_type = await pop_oldest_owned_pack(bot.db, interaction.user.id)
-    if not pack_type:
-        await interaction.followup.send("You have no packs to open. Use /buy pack <type>.", ephemeral=True)
+    ptype_filter = type.lower() if type else None
+    limit = MAX_BULK_OPEN if open_all else count
+    owned = []
+    total_owned = 0
+    for ptype, qty in await owned_pack_counts(bot.db, interaction.user.id, ptype_filter):
+        owned.extend([ptype] * min(qty, limit - len(owned)))
+        total_owned += qty
+    if not owned:
+        what = f"no {ptype_filter} packs" if ptype_filter else "no packs"
+        await interaction.followup.send(f"You have {what} to open. Use /buy pack <type>.", ephemeral=True)
         return
 
-    pack_def = await get_pack_def(bot.db, pack_type)
+    # Counted on the writer, so cards from opens still waiting to commit are
+    # included; each pack reserves the most cards it can roll.
     inv_count = await inventory_count(bot.db, interaction.user.id)
-    to_open_preview = pack_def["max_cards"]
-    if inv_count + pack_def["min_cards"] > user["inventory_capacity"]:
-        await interaction.followup.send(f"Not enough inventory space. You need at least {pack_def['min_cards']} empty slots. Use /shop upgrade.", ephemeral=True)
-        await give_owned_pack(bot.db, interaction.user.id, pack_type)
-        await bot.db.commit()
+    selected = []
+    needed = 0
+    first_def = None
+    for ptype in owned:
+        pack_def = await get_pack_def(bot.db, ptype)
+        if not pack_def:
+            continue
+        first_def = first_def or pack_def
+        if inv_count + needed + pack_def["max_cards"] > user["inventory_capacity"]:
+            break
+        needed += pack_def["max_cards"]
+        selected.append(ptype)
+    if not selected:
+        if first_def:
+            await interaction.followup.send(f"Not enough inventory space. You need {first_def['max_cards']} empty slots to open a {first_def['name']}. Use /shop upgrade.", ephemeral=True)
+        else:
+            await interaction.followup.send("Those packs can no longer be opened.", ephemeral=True)
         return
 
-    embed = discord.Embed(title=f"🎁 Opening {pack_def['name']}...", color=0xE67E22)
-    embed.description = "Rolling cards..."
-    msg = await interaction.followup.send(embed=embed)
-
-    cards = await roll_pack_cards(bot.db, pack_type)
-    obtained = []
-    for idx, c in enumerate(cards, start=1):
-        inv_id = await add_card_to_inventory(bot.db, interaction.user.id, c["card_id"])
-        obtained.append((c, inv_id))
-
-        reveal = f"{rarity_emoji(c['rarity'])} {c['name']} [{c['rarity']}] • {c['collection']} (ID: `{inv_id}`)"
-        embed.description = (embed.description or "") + f"\n{reveal}"
-        embed.color = rarity_color(c["rarity"])
-        await msg.edit(embed=embed)
-        await asyncio.sleep(0.7)
-
-    await bot.db.commit()
+    pack_types = selected
+    consumed: Dict[str, int] = {}
+    for ptype in pack_types:
+        consumed[ptype] = consumed.get(ptype, 0) + 1
+    if not await consume_owned_packs(bot.db, interaction.user.id, consumed):
+        await interaction.followup.send("Those packs were already opened. Check /profile and try again.", ephemeral=True)
+        return
+    rolls = await roll_many_packs(bot.db, pack_types)
+    cards = [c for rolled in rolls for c in rolled]
+    # Concurrent opens can pass the check above together; the insert re-checks.
+    inv_ids = await add_cards_to_inventory(bot.db, interaction.user.id, [c["card_id"] for c in cards], within_capacity=True)
+    if inv_ids is None:
+        for ptype, n in consumed.items():
+            await give_owned_pack(bot.db, interaction.user.id, ptype, n)
+        await bot.commit()
+        await interaction.followup.send("Not enough inventory space for those packs any more. Use /shop upgrade.", ephemeral=True)
+        return
+    obtained = list(zip(cards, inv_ids))
+    # The cards are the user's once this returns; presentation only reads `obtained`.
+    await bot.commit()
+
+    # Decided by what was asked for, so a bulk open that only fit one pack
+    # still says why the rest were left.
+    if open_all or count > 1:
+        over_cap = total_owned - len(owned) if open_all else 0
+        await interaction.followup.send(embed=bulk_open_embed(pack_types, obtained, skipped=len(owned) - len(selected), over_cap=over_cap))
+        return
 
-    summary = discord.Embed(
-        title="✨ Pack Results",
-        description="\n".join(
-            f"{rarity_emoji(c['rarity'])} {c['name']} [{c['rarity']}] • {c['collection']} • Base {c['base_value']} (ID: `{inv}`)"
-            for c, inv in obtained
-        ),
-        color=0x2ECC71
-    )
-    await msg.edit(embed=summary)
+    pack_def = await get_pack_def(bot.db, pack_types[0])
+    bot.spawn(reveal_pack(interaction, pack_def, obtained))
 
 
 class BuyGroup(app_commands.Group):
@@ -1046,7 +3489,7 @@ class BuyGroup(app_commands.Group):
     @app_commands.command(name="pack", description="Buy a pack")
     async def buy_pack(self, interaction: discord.Interaction, type: str):
         await interaction.response.defer()
-        user = await get_user(bot.db, interaction.user.id)
+        user = await bot.profile(interaction.user.id)
         if not user:
             await interaction.followup.send("Use /start first.", ephemeral=True)
             return
@@ -1058,45 +3501,35 @@ class BuyGroup(app_commands.Group):
         if pack.get("event_only") and not is_october():
             await interaction.followup.send("That pack is event-only and not currently available.", ephemeral=True)
             return
-        wallet = await get_wallet(bot.db, interaction.user.id)
         price = pack["price"]
-        if wallet < price:
+        if await debit_wallet(bot.db, interaction.user.id, price) is None:
             await interaction.followup.send("Not enough coins.", ephemeral=True)
             return
-        await adjust_wallet(bot.db, interaction.user.id, -price)
         await give_owned_pack(bot.db, interaction.user.id, ptype)
-        await bot.db.commit()
+        await bot.commit()
         await interaction.followup.send(f"Purchased 1x {pack['name']} for {price} coins.")
 
     @app_commands.describe(amount="Number of shelves to buy (default 1)")
     @app_commands.command(name="shelf", description="Buy a shelf (increases capacity, boosts store)")
     async def buy_shelf(self, interaction: discord.Interaction, amount: Optional[int] = 1):
         await interaction.response.defer()
-        user = await get_user(bot.db, interaction.user.id)
+        user = await bot.profile(interaction.user.id)
         if not user:
             await interaction.followup.send("Use /start first.", ephemeral=True)
             return
         amount = max(1, int(amount or 1))
-        total_cost = 0
-        shelves = user["shelves"]
-        for i in range(amount):
-            cost = 500 * (shelves + 1 + i)
-            total_cost += cost
-        wallet = await get_wallet(bot.db, interaction.user.id)
-        if wallet < total_cost:
-            await interaction.followup.send(f"Not enough coins. Need {total_cost}.", ephemeral=True)
+        bought = await buy_shelves(bot.db, interaction.user.id, amount)
+        if bought is None:
+            await interaction.followup.send(f"Not enough coins. Need {shelf_cost(user['shelves'], amount)}.", ephemeral=True)
             return
-        await adjust_wallet(bot.db, interaction.user.id, -total_cost)
-        await bot.db.execute("UPDATE users SET shelves = shelves + ?, inventory_capacity = inventory_capacity + ? WHERE user_id = ?",
-                             (amount, amount * 20, interaction.user.id))
-        await bot.db.commit()
-        await interaction.followup.send(f"Bought {amount} shelf/shelves for {total_cost}. Capacity +{amount*20}.")
+        await bot.commit()
+        await interaction.followup.send(f"Bought {amount} shelf/shelves for {bought[0]}. Capacity +{amount * SHELF_CAPACITY}.")
 
     @app_commands.describe(type="Pack type for store stock", quantity="Quantity to buy for store stock")
     @app_commands.command(name="stock", description="Buy stock for your store (NPC sales via /daily)")
     async def buy_stock(self, interaction: discord.Interaction, type: str, quantity: int):
         await interaction.response.defer()
-        user = await get_user(bot.db, interaction.user.id)
+        user = await bot.profile(interaction.user.id)
         if not user:
             await interaction.followup.send("Use /start first.", ephemeral=True)
             return
@@ -1107,33 +3540,36 @@ class BuyGroup(app_commands.Group):
             return
         quantity = max(1, int(quantity))
         cost = pack["price"] * quantity
-        wallet = await get_wallet(bot.db, interaction.user.id)
-        if wallet < cost:
+        if await debit_wallet(bot.db, interaction.user.id, cost) is None:
             await interaction.followup.send(f"Not enough coins. Need {cost}.", ephemeral=True)
             return
-        await adjust_wallet(bot.db, interaction.user.id, -cost)
         await change_store_stock(bot.db, interaction.user.id, ptype, quantity)
-        await bot.db.commit()
+        await bot.commit()
         await interaction.followup.send(f"Bought {quantity}x {pack['name']} for store stock.")
 
 bot.tree.add_command(BuyGroup())
 
 async def sell_card_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
-    bot.db.row_factory = aiosqlite.Row
-    query = f"%{current}%"
-    q = """
-    SELECT inv.inventory_id, c.name, c.rarity
-    FROM inventory inv
-    JOIN cards c ON c.card_id = inv.card_id
-    WHERE inv.user_id = ? AND (c.name LIKE ? OR inv.inventory_id LIKE ?)
-    LIMIT 20
-    """
     choices = []
-    async with bot.db.execute(q, (interaction.user.id, query, query)) as c:
-        rows = await c.fetchall()
-    for r in rows:
-        label = f"{r['name']} [{r['rarity']}] • {r['inventory_id']}"
-        choices.append(app_commands.Choice(name=label[:100], value=r["inventory_id"]))
+    for inv_id, card in await inventory_search.search(bot.db, interaction.user.id, current, limit=20):
+        label = f"{card['name']} [{card['rarity']}] • {inv_id}" if card else inv_id
+        choices.append(app_commands.Choice(name=label[:100], value=inv_id))
+    return choices
+
+async def gift_item_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    text = current.strip()
+    low = text.lower()
+    if low.startswith("pack:") or (low and "pack:".startswith(low)):
+        if not pack_table.loaded:
+            await pack_table.load(bot.db)
+        wanted = low[5:].split(":")[0]
+        return [app_commands.Choice(name=f"pack:{t}", value=f"pack:{t}") for t in pack_table.packs if t.startswith(wanted)][:25]
+    if text.lower().startswith("card:"):
+        text = text[5:]
+    choices = []
+    for inv_id, card in await inventory_search.search(bot.db, interaction.user.id, text, limit=20):
+        label = f"card:{inv_id} • {card['name']} [{card['rarity']}]" if card else f"card:{inv_id}"
+        choices.append(app_commands.Choice(name=label[:100], value=f"card:{inv_id}"))
     return choices
 
 @bot.tree.command(description="Sell a card from your inventory")
@@ -1141,11 +3577,11 @@ async def sell_card_autocomplete(interaction: discord.Interaction, current: str)
 @app_commands.autocomplete(card=sell_card_autocomplete)
 async def sell(interaction: discord.Interaction, card: str):
     await interaction.response.defer()
-    user = await get_user(bot.db, interaction.user.id)
+    user = await bot.profile(interaction.user.id)
     if not user:
         await interaction.followup.send("Use /start first.", ephemeral=True)
         return
-    inv = await get_inventory_item(bot.db, interaction.user.id, card.strip())
+    inv = await get_inventory_item(bot.db, interaction.user.id, await inventory_search.resolve(bot.db, interaction.user.id, card))
     if not inv:
         await interaction.followup.send("Card not found.", ephemeral=True)
         return
@@ -1153,10 +3589,11 @@ async def sell(interaction: discord.Interaction, card: str):
         await interaction.followup.send("This card is locked (maybe in a trade/market).", ephemeral=True)
         return
     value = calc_sell_price(inv["base_value"], inv["rarity"])
-    await remove_inventory_item(bot.db, interaction.user.id, inv["inventory_id"])
-    await adjust_wallet(bot.db, interaction.user.id, value)
-    await add_profit(bot.db, interaction.user.id, value)
-    await bot.db.commit()
+    if not await remove_inventory_item(bot.db, interaction.user.id, inv["inventory_id"]):
+        await interaction.followup.send("Card not found.", ephemeral=True)
+        return
+    await adjust_wallet(bot.db, interaction.user.id, value, profit=value)
+    await bot.commit()
     await interaction.followup.send(f"Sold {inv['name']} [{inv['rarity']}] for {value} coins.")
 
 class ShopGroup(app_commands.Group):
@@ -1166,100 +3603,100 @@ class ShopGroup(app_commands.Group):
     @app_commands.command(name="upgrade", description="Upgrade your shop (more space, better prestige)")
     async def upgrade(self, interaction: discord.Interaction):
         await interaction.response.defer()
-        user = await get_user(bot.db, interaction.user.id)
+        user = await bot.profile(interaction.user.id)
         if not user:
             await interaction.followup.send("Use /start first.", ephemeral=True)
             return
-        level = user["shop_level"]
-        cost = 800 * level
-        wallet = await get_wallet(bot.db, interaction.user.id)
-        if wallet < cost:
-            await interaction.followup.send(f"Not enough coins. Upgrade to level {level+1} costs {cost}.", ephemeral=True)
+        level = await upgrade_shop(bot.db, interaction.user.id)
+        if level is None:
+            level = user["shop_level"]
+            await interaction.followup.send(f"Not enough coins. Upgrade to level {level+1} costs {UPGRADE_PRICE * level}.", ephemeral=True)
             return
-        cap_increase = 50 + 10 * level
-        await adjust_wallet(bot.db, interaction.user.id, -cost)
-        await bot.db.execute("UPDATE users SET shop_level = shop_level + 1, inventory_capacity = inventory_capacity + ? WHERE user_id = ?",
-                             (cap_increase, interaction.user.id))
-        await bot.db.commit()
-        await interaction.followup.send(f"Upgraded shop to level {level+1}! Capacity +{cap_increase}.")
+        await bot.commit()
+        await interaction.followup.send(f"Upgraded shop to level {level}! Capacity +{upgrade_capacity(level - 1)}.")
 
 bot.tree.add_command(ShopGroup())
 
+class DebugGroup(app_commands.Group):
+    def __init__(self):
+        # Hidden from everyone but server admins (and in DMs); the owner check still decides.
+        super().__init__(name="debug", description="Owner diagnostics", guild_only=True, default_permissions=discord.Permissions(administrator=True))
+
+    @app_commands.describe(top="How many statements to list", sort="Rank by total time, call count or max time", dump="Attach the full stats as JSON", reset="Clear the counters afterwards")
+    @app_commands.choices(sort=[app_commands.Choice(name=k, value=k) for k in ("total", "count", "max")])
+    @app_commands.command(name="dbstats", description="Database statement latency (owner only)")
+    async def dbstats(
+        self,
+        interaction: discord.Interaction,
+        top: app_commands.Range[int, 1, 15] = 10,
+        sort: Optional[app_commands.Choice[str]] = None,
+        dump: bool = False,
+        reset: bool = False,
+    ):
+        if not await bot.is_owner(interaction.user):
+            await interaction.response.send_message("Owner only.", ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True)
+        embed = discord.Embed(title="🗄️ DB stats", color=COLOR_DEFAULT)
+        embed.description = f"Since {readable_ts(db_stats.since)} • slow ≥ {db_stats.slow_ms:g} ms"
+        for sql, st in db_stats.top(top, sort.value if sort else "total"):
+            embed.add_field(
+                name=f"{st.count}x • avg {st.total / st.count:.2f} ms • max {st.max:.1f} ms • total {st.total:.0f} ms",
+                value=f"`{sql[:300]}`",
+                inline=False,
+            )
+        by_cmd = sorted(db_stats.by_command.items(), key=lambda kv: -kv[1].total)[:10]
+        if by_cmd:
+            embed.add_field(name="By command (total ms)", value="\n".join(f"{cmd}: {st.total:.0f} ({st.count})" for cmd, st in by_cmd), inline=False)
+        files = [discord.File(io.BytesIO(db_stats.to_json().encode()), filename="dbstats.json")] if dump else []
+        if reset:
+            db_stats.reset()
+        await interaction.followup.send(embed=embed, files=files, ephemeral=True)
+
+bot.tree.add_command(DebugGroup())
+
 
 @bot.tree.command(description="Show top shops by value")
 async def leaderboard(interaction: discord.Interaction):
     await interaction.response.defer()
-    bot.db.row_factory = aiosqlite.Row
-    async with bot.db.execute("SELECT user_id FROM users") as c:
-        rows = await c.fetchall()
-    scores = []
-    for r in rows:
-        uid = r["user_id"]
-        val = await compute_shop_value(bot.db, uid)
-        scores.append((uid, val))
-    scores.sort(key=lambda x: x[1], reverse=True)
-    top = scores[:10]
+    top = await bot.read(top_shop_values, 10)
     embed = discord.Embed(title="🏆 Leaderboard: Shop Value", color=0xFEE75C)
     if not top:
         embed.description = "No players yet. Use /start!"
     else:
         for idx, (uid, val) in enumerate(top, start=1):
             embed.add_field(name=f"#{idx} • {val}", value=f"<@{uid}>", inline=False)
+        mine = await bot.read(shop_value_rank, interaction.user.id)
+        if mine:
+            embed.set_footer(text=f"Your rank: #{mine[0]} • {mine[1]}")
     await interaction.followup.send(embed=embed)
 
 @bot.tree.command(description="Claim your daily bonus and store sales")
 async def daily(interaction: discord.Interaction):
     await interaction.response.defer()
-    user = await get_user(bot.db, interaction.user.id)
+    user = await bot.profile(interaction.user.id)
     if not user:
         await interaction.followup.send("Use /start first.", ephemeral=True)
         return
-    ok = True
-    msg = ""
     if user["last_daily"]:
-        last = datetime.fromisoformat(user["last_daily"])
-        if datetime.now(timezone.utc) - last < timedelta(hours=22):
-            ok = False
-            rem = timedelta(hours=22) - (datetime.now(timezone.utc) - last)
+        elapsed = datetime.now(timezone.utc) - datetime.fromisoformat(user["last_daily"])
+        if elapsed < DAILY_COOLDOWN:
+            rem = DAILY_COOLDOWN - elapsed
             hrs = int(rem.total_seconds() // 3600)
             mins = int((rem.total_seconds() % 3600) // 60)
-            msg = f"Daily not ready. Try again in {hrs}h {mins}m."
-    if not ok:
-        await interaction.followup.send(msg, ephemeral=True)
-        return
+            await interaction.followup.send(f"Daily not ready. Try again in {hrs}h {mins}m.", ephemeral=True)
+            return
 
     base = random.randint(100, 200)
+    collected = await collect_daily(bot.db, interaction.user.id, base)
+    if collected is None:
+        await interaction.followup.send("Daily already claimed.", ephemeral=True)
+        return
+    await bot.commit()
 
-    shelves = user["shelves"]
-    stock = await get_store_stock(bot.db, interaction.user.id)
-    sales_capacity = shelves * 5
-    total_sales_profit = 0
-    total_sold = {}
-    if sales_capacity > 0 and stock:
-        for ptype, qty in sorted(stock.items(), key=lambda kv: PACK_DEFS[kv[0]]["price"] if kv[0] in PACK_DEFS else 0, reverse=True):
-            if sales_capacity <= 0:
-                break
-            if qty <= 0:
-                continue
-            sell_units = min(qty, sales_capacity)
-            pack = await get_pack_def(bot.db, ptype)
-            if not pack:
-                continue
-            margin = 0.2
-            profit_per = int(pack["price"] * margin)
-            total_sales_profit += profit_per * sell_units
-            await change_store_stock(bot.db, interaction.user.id, ptype, -sell_units)
-            total_sold[ptype] = sell_units
-            sales_capacity -= sell_units
-
-    total_gain = base + total_sales_profit
-    await adjust_wallet(bot.db, interaction.user.id, total_gain)
-    await add_profit(bot.db, interaction.user.id, total_gain)
-    await set_last_daily(bot.db, interaction.user.id)
-    await bot.db.commit()
-
-    sold_str = ", ".join(f"{k}x{v}" for k, v in total_sold.items()) if total_sold else "No sales"
-    await interaction.followup.send(f"Daily claimed! +{base} bonus. Store sales: {sold_str} → +{total_sales_profit}. Total +{total_gain}.")
+    sales, units = collected
+    sold_str = f"{units} pack(s)" if units else "No sales"
+    await interaction.followup.send(f"Daily claimed! +{base} bonus. Store sales: {sold_str} → +{sales}. Total +{base + sales}.")
 
 @bot.tree.command(description="Trade cards with another player")
 @app_commands.describe(user="The user to trade with")
@@ -1268,8 +3705,8 @@ async def trade(interaction: discord.Interaction, user: discord.User):
     if user.bot or user.id == interaction.user.id:
         await interaction.followup.send("Choose a valid trading partner.", ephemeral=True)
         return
-    u1 = await get_user(bot.db, interaction.user.id)
-    u2 = await get_user(bot.db, user.id)
+    u1 = await bot.profile(interaction.user.id)
+    u2 = await bot.profile(user.id)
     if not u1 or not u2:
         await interaction.followup.send("Both players need to /start first.", ephemeral=True)
         return
@@ -1281,19 +3718,20 @@ async def trade(interaction: discord.Interaction, user: discord.User):
 
 @bot.tree.command(description="Gift a card or pack to someone")
 @app_commands.describe(user="Recipient", item="card:<InvID> or pack:<type>[:qty]")
+@app_commands.autocomplete(item=gift_item_autocomplete)
 async def gift(interaction: discord.Interaction, user: discord.User, item: str):
     await interaction.response.defer(ephemeral=True)
     if user.bot or user.id == interaction.user.id:
         await interaction.followup.send("Choose a valid recipient.", ephemeral=True)
         return
-    giver = await get_user(bot.db, interaction.user.id)
-    receiver = await get_user(bot.db, user.id)
+    giver = await bot.profile(interaction.user.id)
+    receiver = await bot.profile(user.id)
     if not giver or not receiver:
         await interaction.followup.send("Both players need to /start first.", ephemeral=True)
         return
     item = item.strip().lower()
     if item.startswith("card:"):
-        inv_id = item.split("card:", 1)[1].strip().upper()
+        inv_id = await inventory_search.resolve(bot.db, interaction.user.id, item.split("card:", 1)[1])
         inv = await get_inventory_item(bot.db, interaction.user.id, inv_id)
         if not inv:
             await interaction.followup.send("Card not found or not yours.", ephemeral=True)
@@ -1301,8 +3739,10 @@ async def gift(interaction: discord.Interaction, user: discord.User, item: str):
         if inv["locked"]:
             await interaction.followup.send("That card is locked.", ephemeral=True)
             return
-        await bot.db.execute("UPDATE inventory SET user_id = ? WHERE inventory_id = ?", (user.id, inv_id))
-        await bot.db.commit()
+        if not await transfer_inventory_items(bot.db, [inv_id], interaction.user.id, user.id):
+            await interaction.followup.send("That card was sold, listed or traded meanwhile; nothing was given.", ephemeral=True)
+            return
+        await bot.commit()
         await interaction.followup.send(f"Gave card `{inv_id}` to {user.mention}.", ephemeral=True)
     elif item.startswith("pack:"):
         rest = item.split("pack:", 1)[1]
@@ -1314,63 +3754,93 @@ async def gift(interaction: discord.Interaction, user: discord.User, item: str):
                 qty = max(1, int(parts[1]))
             except:
                 qty = 1
-        bot.db.row_factory = aiosqlite.Row
-        async with bot.db.execute("SELECT id FROM owned_packs WHERE user_id = ? AND pack_type = ? LIMIT ?", (interaction.user.id, ptype, qty)) as c:
-            pack_rows = await c.fetchall()
-        if len(pack_rows) < qty:
+        if not await take_owned_packs(bot.db, interaction.user.id, ptype, qty):
             await interaction.followup.send("You don't have enough owned packs of that type.", ephemeral=True)
             return
-        ids = [r["id"] for r in pack_rows]
-        await bot.db.execute(
-            "DELETE FROM owned_packs WHERE id IN (%s)" % ",".join("?"*len(ids)),
-            (*ids,)
-        )
-        for _ in range(qty):
-            await give_owned_pack(bot.db, user.id, ptype)
-        await bot.db.commit()
+        await give_owned_pack(bot.db, user.id, ptype, qty)
+        await bot.commit()
         await interaction.followup.send(f"Gave {qty}x {ptype} pack(s) to {user.mention}.", ephemeral=True)
     else:
         await interaction.followup.send("Invalid item format. Use card:<InvID> or pack:<type>[:qty].", ephemeral=True)
 
+async def collection_theme_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    return [
+        app_commands.Choice(name=coll, value=coll)
+        for coll in card_catalog.collection_masks if current.lower() in coll.lower()
+    ][:25]
+
 @bot.tree.command(description="Show your thematic collection progress")
-async def collection(interaction: discord.Interaction):
+@app_commands.describe(theme="Show the cards you are still missing from this collection")
+@app_commands.autocomplete(theme=collection_theme_autocomplete)
+async def collection(interaction: discord.Interaction, theme: Optional[str] = None):
     await interaction.response.defer()
-    user = await get_user(bot.db, interaction.user.id)
+    user = await bot.profile(interaction.user.id)
     if not user:
         await interaction.followup.send("Use /start first.", ephemeral=True)
         return
-    bot.db.row_factory = aiosqlite.Row
-    async with bot.db.execute("SELECT DISTINCT collection FROM cards") as c:
-        collections = [r[0] for r in await c.fetchall()]
+    owned = (await inventory_search.get(bot.db, interaction.user.id)).owned
+    if theme:
+        coll = next((c for c in card_catalog.collection_masks if c.lower() == theme.strip().lower()), None)
+        if not coll:
+            await interaction.followup.send("Unknown collection.", ephemeral=True)
+            return
+        missing = card_catalog.missing(owned, coll)
+        desc = "\n".join(f"{rarity_emoji(c['rarity'])} {c['name']} [{c['rarity']}]" for c in missing) or "Complete! ✅"
+        embed = discord.Embed(title=f"🗂️ {coll}: missing cards", description=desc[:4096], color=0x95A5A6)
+        await interaction.followup.send(embed=embed)
+        return
     desc_lines = []
-    for coll in collections:
-        async with bot.db.execute(
-            """
-            SELECT COUNT(DISTINCT c.card_id) FROM inventory inv
-            JOIN cards c ON c.card_id = inv.card_id
-            WHERE inv.user_id = ? AND c.collection = ?
-            """,
-            (interaction.user.id, coll)
-        ) as c:
-            have_row = await c.fetchone()
-        async with bot.db.execute("SELECT COUNT(*) FROM cards WHERE collection = ?", (coll,)) as c:
-            total_row = await c.fetchone()
-        have = int(have_row[0] or 0)
-        total = int(total_row[0] or 0)
+    for coll, have, total in card_catalog.progress(owned):
         pct = 0 if total == 0 else int(have * 100 / total)
         bars = "█" * (pct // 10) + "░" * (10 - pct // 10)
-        desc_lines.append(f"{coll}: [{bars}] {have}/{total} ({pct}%)")
+        done = " ✅" if total and have == total else ""
+        desc_lines.append(f"{coll}: [{bars}] {have}/{total} ({pct}%){done}")
     embed = discord.Embed(title="🗂️ Collection Progress", description="\n".join(desc_lines) or "No cards yet.", color=0x95A5A6)
     await interaction.followup.send(embed=embed)
 
+async def market_pack_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    if not pack_table.loaded:
+        await pack_table.load(bot.db)
+    return [app_commands.Choice(name=t, value=t) for t in pack_table.packs if current.lower() in t][:25]
+
 @bot.tree.command(description="Open the global marketplace")
-async def market(interaction: discord.Interaction):
+@app_commands.describe(
+    rarity="Only card listings of this rarity",
+    pack="Only pack listings of this type",
+    card="Only card listings whose name contains this",
+    max_price="Only listings at or below this price",
+    sort="Newest first (default) or cheapest first",
+)
+@app_commands.choices(
+    rarity=[app_commands.Choice(name=r, value=r) for r in RARITY_META],
+    sort=[app_commands.Choice(name="newest", value="newest"), app_commands.Choice(name="cheapest", value="cheapest")],
+)
+@app_commands.autocomplete(pack=market_pack_autocomplete)
+async def market(
+    interaction: discord.Interaction,
+    rarity: Optional[app_commands.Choice[str]] = None,
+    pack: Optional[str] = None,
+    card: Optional[str] = None,
+    max_price: Optional[int] = None,
+    sort: Optional[app_commands.Choice[str]] = None,
+):
     await interaction.response.defer()
-    view = MarketView(bot, interaction.user.id)
-    bot.db.row_factory = aiosqlite.Row
-    async with bot.db.execute("SELECT * FROM marketplace WHERE status = 'active' ORDER BY listing_id DESC LIMIT 20") as c:
-        rows = await c.fetchall()
-    embed = view._render_embed(rows)
+    filters = {}
+    if rarity:
+        filters["rarity"] = rarity.value
+    if pack:
+        filters["pack_type"] = pack.strip().lower()
+    if card:
+        name = card.strip().lower()
+        filters["card_ids"] = [cid for cid, c in card_catalog.cards.items() if name in c["name"].lower()]
+    if rarity or card:
+        filters["item_type"] = "card"
+    if max_price is not None:
+        filters["max_price"] = max_price
+    if sort and sort.value == "cheapest":
+        filters["cheapest"] = True
+    view = MarketView(bot, interaction.user.id, filters)
+    embed = view._render_embed(view._listings())
     msg = await interaction.followup.send(embed=embed, view=view)
     view.message = msg
 
@@ -1384,13 +3854,9 @@ async def packinfo(interaction: discord.Interaction, type: str):
         return
     odds = pack["drops"]
     odds_str = "\n".join(f"{rarity_emoji(r)} {r}: {pct}%" for r, pct in odds.items())
-    bot.db.row_factory = aiosqlite.Row
     sample_lines = []
     for r in ["Legendary", "Epic", "Rare", "Uncommon", "Common"]:
-        async with bot.db.execute("SELECT name FROM cards WHERE rarity = ? AND (? OR collection != 'Halloween') LIMIT 5",
-                                  (r, 1 if is_october() else 0)) as c:
-            rows = await c.fetchall()
-        names = ", ".join([rw[0] for rw in rows]) or "—"
+        names = ", ".join(card_catalog.sample_names(r, include_halloween=is_october(), limit=5)) or "—"
         sample_lines.append(f"{rarity_emoji(r)} {r}: {names}")
     embed = discord.Embed(
         title=f"📦 {pack['name']}",
@@ -1429,6 +3895,7 @@ INVITE_PERMISSIONS.update(
 class SupportView(discord.ui.View):
     def __init__(self, invite_url: str, support_url: Optional[str], timeout: float = 120):
         super().__init__(timeout=timeout)
+        open_views.add(self)
         self.add_item(discord.ui.Button(
             label="Invite Bot",
             style=discord.ButtonStyle.link,
@@ -1465,7 +3932,7 @@ async def help_cmd(interaction: discord.Interaction):
             "/start — Create your account and shop",
             "/profile — Shop level, wallet, packs, rare+",
             "/inventory — View your cards (with IDs)",
-            "/openpack — Open a pack with animation",
+            "/openpack [count] [type] [all] — Open packs (one with animation, or many at once)",
             "/buy pack <type> — Buy a pack",
             "/sell <card> — Sell a card by inventory ID",
             "/shop upgrade — Upgrade your shop",
@@ -1491,8 +3958,8 @@ async def help_cmd(interaction: discord.Interaction):
         name="💎 Additional / Interactive",
         value="\n".join([
             "/gift @user <item> — Gift card:<ID> or pack:<type>[:qty]",
-            "/collection — Collection progress",
-            "/market — Global marketplace",
+            "/collection [theme] — Collection progress / missing cards",
+            "/market [rarity] [pack] [card] [max_price] [sort] — Global marketplace, filterable and sortable by price",
             "/support — Invite link + support server",
         ]),
         inline=False
@@ -1530,16 +3997,113 @@ async def on_app_command_error(interaction: discord.Interaction, error: app_comm
         await interaction.response.send_message(f"Error: {error}", ephemeral=True)
     except:
         await interaction.followup.send(f"Error: {error}", ephemeral=True)
+    finally:
+        inv = interaction.extras.get("invocation")
+        if inv is not None:
+            command_metrics.finish(inv, error=True)
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    inv = interaction.extras.get("invocation")
+    if inv is not None:
+        command_metrics.finish(inv)
 
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
-    print("Slash commands synced.")
+
+async def run_storage_service() -> None:
+    service = StorageService(DB_PATH, STORAGE_SOCKET)
+    await service.start()
+    print(f"Storage service listening on {STORAGE_SOCKET}")
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await service.stop()
+
+async def recommended_shards() -> Tuple[int, int]:
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(TOKEN)
+        shards, _, limits = await http.get_bot_gateway()
+        return shards, limits["max_concurrency"]
+    finally:
+        await http.close()
+
+def run_cluster(processes: int, force_sync: bool = False) -> int:
+    # One storage service plus `processes` bot processes, each running every
+    # processes-th shard. Returns once any of them exits (after stopping the
+    # rest), so a process supervisor can restart the whole cluster.
+    socket_path = STORAGE_SOCKET or os.path.abspath("packify-storage.sock")
+    shard_count, concurrency = SHARD_COUNT, IDENTIFY_CONCURRENCY
+    if not shard_count:
+        shard_count, concurrency = asyncio.run(recommended_shards())
+    shard_count = max(shard_count, processes)
+    env = dict(
+        os.environ, STORAGE_SOCKET=socket_path, SHARD_COUNT=str(shard_count),
+        CLUSTER_SIZE=str(processes), IDENTIFY_CONCURRENCY=str(concurrency),
+    )
+    script = os.path.abspath(__file__)
+
+    def interrupt(*_):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, interrupt)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    # Own sessions, so Ctrl+C reaches only this launcher, which stops the
+    # shards before the storage service they commit through.
+    storage = subprocess.Popen([sys.executable, script, "--storage"], env=env, start_new_session=True)
+    shards: List[subprocess.Popen] = []
+    names = {storage.pid: "storage service"}
+    try:
+        while not os.path.exists(socket_path):
+            if storage.poll() is not None:
+                return storage.returncode or 1
+            time.sleep(0.1)
+        for i in range(processes):
+            shard_ids = ",".join(str(sid) for sid in range(i, shard_count, processes))
+            print(f"Starting cluster process {i}: shards {shard_ids} of {shard_count}")
+            shards.append(subprocess.Popen(
+                [sys.executable, script, *(["--force-sync"] if force_sync and i == 0 else [])], env=dict(env, CLUSTER_INDEX=str(i), SHARD_IDS=shard_ids), start_new_session=True,
+            ))
+            names[shards[-1].pid] = f"cluster process {i}"
+        while storage.poll() is None and all(p.poll() is None for p in shards):
+            time.sleep(1)
+        exited = next(p for p in [storage, *shards] if p.poll() is not None)
+        print(f"The {names[exited.pid]} exited with {exited.returncode}; stopping the cluster")
+        return exited.returncode or 1
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        for group in (shards, [storage]):
+            for p in group:
+                if p.poll() is None:
+                    p.send_signal(signal.SIGINT)
+            for p in group:
+                try:
+                    p.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+                    p.wait()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Packify bot.")
+    parser.add_argument("--cluster", type=int, metavar="N", help="run N bot processes sharing one storage service")
+    parser.add_argument("--force-sync", action="store_true", help="sync slash commands even if they look unchanged")
+    parser.add_argument("--storage", action="store_true", help=argparse.SUPPRESS)  # the cluster's storage service
+    args = parser.parse_args()
+    if args.storage:
+        asyncio.run(run_storage_service())
+        raise SystemExit(0)
+
     if not TOKEN:
         print("Missing DISCORD_TOKEN in .env")
         raise SystemExit(1)
 
+    if args.cluster:
+        raise SystemExit(run_cluster(args.cluster, args.force_sync))
+    bot.force_sync = args.force_sync
     bot.run(TOKEN)
 